@@ -0,0 +1,192 @@
+import hashlib
+import ipaddress
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional, Self
+from urllib.parse import parse_qs, urlparse
+
+_COUNTRIES = [
+    ("Poland", "PL", "14", "Mazovia", "Warsaw", "Europe/Warsaw"),
+    ("Germany", "DE", "BE", "Berlin", "Berlin", "Europe/Berlin"),
+    ("United States", "US", "CA", "California", "Los Angeles", "America/Los_Angeles"),
+    ("Japan", "JP", "13", "Tokyo", "Tokyo", "Asia/Tokyo"),
+    ("Brazil", "BR", "SP", "Sao Paulo", "Sao Paulo", "America/Sao_Paulo")
+]
+_ISPS = ["Orange Polska", "Deutsche Telekom AG", "Comcast Cable", "NTT Communications", "Claro S.A."]
+
+def _digest(host: str) -> bytes:
+    return hashlib.blake2b(host.encode(), digest_size=8).digest()
+
+def fake_record(host: str) -> dict[str, Any]:
+    # Records are derived from the address, so every run and every server sees the same data
+    digest = _digest(host)
+    country, code, region, region_name, city, timezone = _COUNTRIES[digest[0] % len(_COUNTRIES)]
+    isp = _ISPS[digest[1] % len(_ISPS)]
+    asn = 1000 + int.from_bytes(digest[2:4], "big")
+    return {
+        "country": country,
+        "countryCode": code,
+        "region": region,
+        "regionName": region_name,
+        "city": city,
+        "zip": f"{digest[4]:02d}-{digest[5]:03d}",
+        "lat": round(digest[6] / 2.55 - 50, 4),
+        "lon": round(digest[7] / 1.42 - 90, 4),
+        "timezone": timezone,
+        "isp": isp,
+        "org": isp,
+        "as": f"AS{asn} {isp}",
+        "mobile": digest[4] % 7 == 0,
+        "proxy": digest[5] % 11 == 0,
+        "hosting": digest[6] % 5 == 0
+    }
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "FakeIPAPIServer"
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, Nagle's algorithm would delay the body until the client ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.startswith("/json/"):
+            return self.__send(404, {"message": "not found"})
+
+        self.server.respond("json", [url.path[len("/json/"):]], parse_qs(url.query), self.__send, single=True)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if url.path != "/batch":
+            return self.__send(404, {"message": "not found"})
+
+        try:
+            hosts = [x["query"] if isinstance(x, dict) else x for x in json.loads(body)]
+        except (ValueError, KeyError, TypeError):
+            return self.__send(400, {"message": "invalid batch"})
+
+        self.server.respond("batch", hosts, parse_qs(url.query), self.__send)
+
+    def __send(self, status: int, body: Any, headers: Optional[dict[str, str]] = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+class FakeIPAPIServer(ThreadingHTTPServer):
+    """Offline stand-in for ip-api.com implementing /json/<ip> and /batch.
+
+    latency is added to every request, plus up to jitter more. A fail_rate share of
+    addresses always answers with a fail status, and an error_rate share of requests
+    is answered with HTTP 503. rate_limits holds (requests, window seconds) per bucket
+    and is reported through X-Rl and X-Ttl like ip-api does, with 429 once exceeded.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, jitter: float = 0.0, fail_rate: float = 0.0, error_rate: float = 0.0, rate_limits: Optional[dict[str, tuple[int, float]]] = None, max_batch_size: int = 100, seed: int = 0) -> Self:
+        super().__init__((host, port), _Handler)
+        self._latency = latency
+        self._jitter = jitter
+        self._fail_rate = fail_rate
+        self._error_rate = error_rate
+        self._rate_limits = rate_limits or {}
+        self._max_batch_size = max_batch_size
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._thread = None
+        self.reset_stats()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> Self:
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-ipapi", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {"json_requests": 0, "batch_requests": 0, "hosts": 0, "throttled": 0, "errors": 0}
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {**self._stats}
+
+    def __take(self, bucket: str) -> tuple[bool, Optional[dict[str, str]]]:
+        # Called with the lock held, returns whether the request may proceed and the headers to send
+        if bucket not in self._rate_limits:
+            return True, None
+
+        limit, window = self._rate_limits[bucket]
+        now = time.monotonic()
+        remaining, reset_at = self._windows.get(bucket, (limit, now + window))
+        if now >= reset_at:
+            remaining, reset_at = limit, now + window
+
+        allowed = remaining > 0
+        if allowed:
+            remaining -= 1
+        self._windows[bucket] = (remaining, reset_at)
+        return allowed, {"X-Rl": str(remaining), "X-Ttl": str(max(0, round(reset_at - now)))}
+
+    def __answer(self, host: str, fields: Optional[set[str]]) -> dict[str, Any]:
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return {"status": "fail", "message": "invalid query", "query": host}
+
+        if not address.is_global:
+            return {"status": "fail", "message": "private range", "query": host}
+        if int.from_bytes(_digest(host)[:4], "big") / 2 ** 32 < self._fail_rate:
+            return {"status": "fail", "message": "reserved range", "query": host}
+
+        record = {"status": "success", **fake_record(host), "query": host}
+        if fields:
+            record = {k:v for k,v in record.items() if k in fields}
+        return record
+
+    def respond(self, bucket: str, hosts: list[str], params: dict[str, list[str]], send: Callable[..., Any], single: bool = False):
+        with self._lock:
+            self._stats[f"{bucket}_requests"] += 1
+            allowed, headers = self.__take(bucket)
+            failed = allowed and self._random.random() < self._error_rate
+            delay = self._latency + self._random.random() * self._jitter
+            if not allowed:
+                self._stats["throttled"] += 1
+            elif failed:
+                self._stats["errors"] += 1
+            else:
+                self._stats["hosts"] += len(hosts)
+
+        if not allowed:
+            return send(429, {"message": "rate limit exceeded"}, headers)
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            return send(503, {"message": "service unavailable"}, headers)
+        if not single and len(hosts) > self._max_batch_size:
+            return send(422, {"message": "too many queries"}, headers)
+
+        fields = params.get("fields")
+        fields = set(fields[0].split(",")) if fields else None
+        answers = [self.__answer(x, fields) for x in hosts]
+        send(200, answers[0] if single else answers, headers)
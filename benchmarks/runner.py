@@ -0,0 +1,321 @@
+import argparse
+import datetime
+import ipaddress
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Any, Optional
+from benchmarks.fake_ipapi import FakeIPAPIServer
+
+# Client-side budget used when the fake server does not enforce a rate limit
+_UNLIMITED = {"json": (1000000, 1.0), "batch": (1000000, 1.0)}
+
+def parse_rate_limits(values: list[str]) -> dict[str, tuple[int, float]]:
+    limits = {}
+    for value in values:
+        name, _, limit = value.partition("=")
+        requests, window = limit.split("/")
+        limits[name.strip()] = (int(requests), float(window))
+
+    return limits
+
+def parse_list(value: str, kind: type) -> list[Any]:
+    return [kind(x) for x in value.split(",") if x.strip()]
+
+def scenario_name(scenario: dict[str, Any]) -> str:
+    return f"hit{round(scenario['hit_ratio'] * 100)}-batch{scenario['batch_size']}-c{scenario['concurrency']}"
+
+def is_success(status: str) -> bool:
+    return status.startswith("2")
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    if len(values) == 1:
+        return {"mean": values[0], "p50": values[0], "p90": values[0], "p99": values[0], "max": values[0]}
+
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "mean": statistics.fmean(values),
+        "p50": cuts[49],
+        "p90": cuts[89],
+        "p99": cuts[98],
+        "max": max(values)
+    }
+
+def random_host(rng: random.Random) -> str:
+    while True:
+        address = ipaddress.IPv4Address(rng.getrandbits(32))
+        if address.is_global:
+            return str(address)
+
+def generate_workload(scenario: dict[str, Any], options: dict[str, Any]) -> tuple[list[str], list[list[str]]]:
+    rng = random.Random(f"{options['seed']}-{scenario_name(scenario)}")
+    warm = [random_host(rng) for _ in range(options["warm_hosts"])] if scenario["hit_ratio"] > 0 else []
+    workload = []
+    for _ in range(options["requests"]):
+        workload.append([
+            rng.choice(warm) if warm and rng.random() < scenario["hit_ratio"] else random_host(rng)
+            for _ in range(scenario["batch_size"])
+        ])
+
+    return warm, workload
+
+def import_app(mongo_uri: Optional[str]):
+    if mongo_uri:
+        from iptracker.app import create_app
+        return create_app()
+
+    try:
+        import mongomock
+    except ImportError:
+        raise RuntimeError("mongomock is required for the in-memory MongoDB stand-in, install it or pass --mongo-uri")
+
+    # The client is created on first use, so the patch covers the import and building the services
+    with mongomock.patch(servers=(("localhost", 27017),)):
+        from iptracker.app import create_app
+        application = create_app()
+        application.extensions["iptracker"].get()
+    return application
+
+def run_scenario(scenario: dict[str, Any], options: dict[str, Any]) -> dict[str, Any]:
+    # Runs in a fresh process, so the app, its caches and its metrics start empty for every scenario
+    server = FakeIPAPIServer(
+        latency=options["latency"],
+        jitter=options["jitter"],
+        fail_rate=options["fail_rate"],
+        error_rate=options["error_rate"],
+        rate_limits=options["rate_limits"],
+        seed=options["seed"]
+    ).start()
+    workdir = tempfile.mkdtemp(prefix="iptracker-bench-")
+    database = f"iptracker_bench_{uuid.uuid4().hex[:12]}"
+    mongo_uri = options["mongo_uri"]
+    limits = {**_UNLIMITED, **options["rate_limits"]}
+
+    os.environ.update({
+        "IPAPI_URL": server.url,
+        "IPAPI_RATE_LIMIT_FILE": os.path.join(workdir, "ratelimit"),
+        "IPAPI_RATE_LIMITS": ",".join(f"{k}={v[0]}/{v[1]}" for k, v in limits.items()),
+        "MONGO_URI": f"{(mongo_uri or 'mongodb://localhost:27017').rstrip('/')}/{database}",
+        "MEMORY_CACHE_SIZE": str(options["memory_cache_size"]),
+        "LOG_LEVEL": "WARNING",
+        **options["env"]
+    })
+
+    try:
+        app = import_app(mongo_uri)
+        services = app.extensions["iptracker"].get()
+        fields = f"?fields={options['fields']}" if options["fields"] else ""
+        warm, workload = generate_workload(scenario, options)
+
+        client = app.test_client()
+        warmup_statuses = Counter()
+        for i in range(0, len(warm), 100):
+            response = client.post(f"/batch{fields}", json=warm[i:i + 100])
+            warmup_statuses[str(response.status_code)] += 1
+        if services.ds and not services.ds.flush(options["flush_timeout"]):
+            # Pending write-behind records would otherwise land in the measured phase
+            raise RuntimeError(f"Warm-up writes were not flushed within {options['flush_timeout']} seconds")
+        server.reset_stats()
+
+        pending = queue.Queue()
+        for hosts in workload:
+            pending.put(hosts)
+
+        latencies = []
+        statuses = Counter()
+        lock = threading.Lock()
+
+        def worker():
+            client = app.test_client()
+            while True:
+                try:
+                    hosts = pending.get_nowait()
+                except queue.Empty:
+                    return
+
+                started = time.perf_counter()
+                if len(hosts) == 1:
+                    response = client.get(f"/json/{hosts[0]}{fields}")
+                else:
+                    response = client.post(f"/batch{fields}", json=hosts)
+                response.get_data()
+                elapsed = time.perf_counter() - started
+
+                with lock:
+                    latencies.append(elapsed * 1000)
+                    statuses[str(response.status_code)] += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(scenario["concurrency"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started
+
+        hosts = sum(len(x) for x in workload)
+        failed = sum(v for k, v in statuses.items() if not is_success(k))
+        warmup_failed = sum(v for k, v in warmup_statuses.items() if not is_success(k))
+        return {
+            "name": scenario_name(scenario),
+            **scenario,
+            # Throughput and latency of failed requests say nothing about the app, such results are not comparable
+            "valid": failed == 0 and warmup_failed == 0,
+            "requests": len(workload),
+            "hosts": hosts,
+            "duration_s": duration,
+            "throughput_rps": len(workload) / duration,
+            "hosts_per_s": hosts / duration,
+            "latency_ms": percentiles(latencies),
+            "status_codes": dict(statuses),
+            "warmup_status_codes": dict(warmup_statuses),
+            "upstream": server.stats()
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+        if mongo_uri:
+            from pymongo import MongoClient
+            MongoClient(mongo_uri).drop_database(database)
+
+def describe_environment() -> dict[str, Any]:
+    try:
+        revision = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        "revision": revision,
+        "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+def run(args: argparse.Namespace) -> int:
+    options = {
+        "requests": args.requests,
+        "warm_hosts": args.warm_hosts,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "fail_rate": args.fail_rate,
+        "error_rate": args.error_rate,
+        "rate_limits": parse_rate_limits(args.rate_limit),
+        "memory_cache_size": args.memory_cache_size,
+        "fields": args.fields,
+        "mongo_uri": args.mongo_uri,
+        "env": dict(x.split("=", 1) for x in args.env),
+        "flush_timeout": args.flush_timeout,
+        "seed": args.seed
+    }
+
+    scenarios = [
+        {"hit_ratio": hit_ratio, "batch_size": batch_size, "concurrency": concurrency}
+        for hit_ratio, batch_size, concurrency in itertools.product(args.hit_ratios, args.batch_sizes, args.concurrency)
+    ]
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for scenario in scenarios:
+        print(f"Running {scenario_name(scenario)}...", file=sys.stderr)
+        with context.Pool(1) as pool:
+            result = pool.apply(run_scenario, (scenario, options))
+
+        latency = result["latency_ms"]
+        print(f"  {result['throughput_rps']:.1f} req/s, {result['hosts_per_s']:.1f} hosts/s, p50 {latency['p50']:.2f} ms, p99 {latency['p99']:.2f} ms, {result['upstream']['hosts']} hosts upstream", file=sys.stderr)
+        if not result["valid"]:
+            print(f"  INVALID: non-2xx responses, measured {result['status_codes']}, warm-up {result['warmup_status_codes']}", file=sys.stderr)
+        results.append(result)
+
+    report = {"environment": describe_environment(), "options": options, "results": results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    invalid = [x["name"] for x in results if not x["valid"]]
+    if invalid:
+        print(f"{len(invalid)} scenario(s) got non-2xx responses, their numbers are not valid: {', '.join(invalid)}", file=sys.stderr)
+        return 1
+
+    return 0
+
+def compare(args: argparse.Namespace) -> int:
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    def change(old: float, new: float) -> str:
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    baseline = {x["name"]: x for x in base["results"]}
+    print(f"{'scenario':<24} {'req/s':>20} {'p50 ms':>20} {'p99 ms':>20} {'upstream hosts':>16}")
+    for result in head["results"]:
+        old = baseline.get(result["name"])
+        if not old:
+            print(f"{result['name']:<24} (not in base)")
+            continue
+        if not old.get("valid", True) or not result.get("valid", True):
+            print(f"{result['name']:<24} (got non-2xx responses, not compared)")
+            continue
+
+        columns = [
+            (old["throughput_rps"], result["throughput_rps"]),
+            (old["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            (old["latency_ms"]["p99"], result["latency_ms"]["p99"])
+        ]
+        cells = [f"{new:.1f} ({change(old_value, new)})" for old_value, new in columns]
+        upstream = f"{old['upstream']['hosts']} -> {result['upstream']['hosts']}"
+        print(f"{result['name']:<24} {cells[0]:>20} {cells[1]:>20} {cells[2]:>20} {upstream:>16}")
+
+    return 0
+
+def main(args: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Offline load tests for the iptracker Flask app")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runner = commands.add_parser("run", help="Run a grid of scenarios and write a JSON report")
+    runner.add_argument("--hit-ratios", type=lambda x: parse_list(x, float), default=[0.0, 0.5, 0.9], help="Share of hosts already known locally, comma separated")
+    runner.add_argument("--batch-sizes", type=lambda x: parse_list(x, int), default=[1, 100], help="Hosts per request, 1 uses /json, comma separated")
+    runner.add_argument("--concurrency", type=lambda x: parse_list(x, int), default=[1, 8], help="Concurrent clients, comma separated")
+    runner.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    runner.add_argument("--warm-hosts", type=int, default=1000, help="Hosts resolved before measuring, hits are drawn from these")
+    runner.add_argument("--latency", type=float, default=0.02, help="Fake ip-api latency in seconds")
+    runner.add_argument("--jitter", type=float, default=0.0, help="Extra random fake ip-api latency in seconds")
+    runner.add_argument("--fail-rate", type=float, default=0.0, help="Share of addresses the fake ip-api reports as failed")
+    runner.add_argument("--error-rate", type=float, default=0.0, help="Share of fake ip-api requests answered with HTTP 503")
+    runner.add_argument("--rate-limit", action="append", default=[], metavar="BUCKET=REQUESTS/SECONDS", help="Rate limit enforced by the fake ip-api, e.g. batch=15/60")
+    runner.add_argument("--memory-cache-size", type=int, default=10000, help="MEMORY_CACHE_SIZE for the app, 0 sends every hit to MongoDB")
+    runner.add_argument("--fields", help="fields= query parameter sent with every request")
+    runner.add_argument("--mongo-uri", help="MongoDB server to use instead of mongomock, a scratch database is created and dropped per scenario")
+    runner.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra app configuration, e.g. PREFIX_CACHE=1")
+    runner.add_argument("--flush-timeout", type=float, default=60.0, help="Seconds to wait for warm-up writes to reach the database")
+    runner.add_argument("--seed", type=int, default=0)
+    runner.add_argument("--output", "-o", help="Write the report here instead of stdout")
+
+    comparer = commands.add_parser("compare", help="Compare two reports scenario by scenario")
+    comparer.add_argument("base")
+    comparer.add_argument("head")
+
+    args = parser.parse_args(args)
+    if args.command == "run":
+        return run(args)
+    return compare(args)
@@ -1,19 +1,31 @@
+import asyncio
 import ipaddress
 import json
 import logging
 import time
 import datetime
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
-from typing import Any, Generator, Optional, Self
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Generator, Iterable, Optional, Self
 import requests
+from requests.adapters import HTTPAdapter
 from iptracker.host import HostData, HostDataSource
-from iptracker.constants import IPAPI_SYSTEM_FIELDS, IPAPI_URL, IPAPI_DEFAULT_FIELDS, IPAPI_USER_AGENT, IPAPI_BATCH_SIZE
+from iptracker.constants import IPAPI_SYSTEM_FIELDS, IPAPI_URL, IPAPI_DEFAULT_FIELDS, IPAPI_USER_AGENT, IPAPI_BATCH_SIZE, IPAPI_MAX_RETRIES, IPAPI_MAX_WORKERS, IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT, HOST_PARSE_CACHE_SIZE
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+
+if TYPE_CHECKING:
+    # Metrics itself depends on this module
+    from iptracker.metrics import Metrics
 
 class QueryResult(Enum):
     Success = 0
     Fail = 1
 
 class QueryResponse:
+    __slots__ = ("_result", "_host", "_error", "_data")
+    
     def __init__(self, result: QueryResult, host: str, error: Optional[str], data: Optional[HostData]) -> Self:
         self._result = result
         self._host = host
@@ -98,106 +110,312 @@ def response_to_dict(response, include_fetch_date: bool, include_data_source: bo
         response_object = {
             "query": response.host,
             "status": "fail",
-            "messasge": response.error_message
+            "message": response.error_message
         }
         
         return response_object
     
-def find_host_errors(host: str) -> Optional[str]:
+@lru_cache(maxsize=HOST_PARSE_CACHE_SIZE)
+def _parse_host(host: str) -> tuple[Optional[str], Optional[str]]:
     try:
         address = ipaddress.ip_address(host)
-        if not address.is_global:
-            return "private range"
-    except Exception:
-        return "invalid query"
+    except ValueError:
+        return None, "invalid query"
+    
+    if not address.is_global:
+        return None, "private range"
+    
+    return str(address), None
+
+def normalize_host(host: Any) -> tuple[Optional[str], Optional[str]]:
+    # Returns the canonical spelling of an address, or the reason it cannot be queried
+    if not isinstance(host, str):
+        return None, "invalid query"
+    
+    return _parse_host(host)
+
+def find_host_errors(host: str) -> Optional[str]:
+    return normalize_host(host)[1]
+
+def respell_response(response: QueryResponse, host: str) -> QueryResponse:
+    # Reports a response under the spelling the caller used for the address
+    if response.host == host:
+        return response
+    if response.status != QueryResult.Success:
+        return QueryResponse.fail(host, response.error_message)
+    
+    data = response.result
+    return QueryResponse.success(HostData(host, data.fetched_at, data.source, data.fields))
+
+def normalize_hosts(hosts: list[Any]) -> tuple[list[QueryResponse], dict[str, list[str]]]:
+    # Splits off invalid entries and groups the rest by canonical address, keeping every spelling
+    invalid = []
+    spellings = {}
+    for x in hosts:
+        host, host_error = normalize_host(x)
+        if host_error:
+            invalid.append(QueryResponse.fail(x, host_error))
+            continue
+        
+        spellings.setdefault(host, []).append(x)
+    
+    return invalid, spellings
+
+def expand_responses(responses: list[QueryResponse], spellings: dict[str, list[str]]) -> list[QueryResponse]:
+    return [respell_response(x, host) for x in responses for host in spellings.get(x.host, [x.host])]
+
+def plan_batches(hosts: list[Any], batch_size: int) -> tuple[list[Optional[QueryResponse]], dict[str, list[int]], list[list[str]]]:
+    # Each distinct address is sent upstream once, however many times and spellings it appears in
+    results = [None] * len(hosts)
+    positions = {}
+    for i, x in enumerate(hosts):
+        host, host_error = normalize_host(x)
+        if host_error:
+            results[i] = QueryResponse.fail(x, host_error)
+            continue
+        
+        positions.setdefault(host, []).append(i)
+    
+    return results, positions, list(generate_splits(list(positions), batch_size))
+
+def assemble_batches(hosts: list[Any], results: list[Optional[QueryResponse]], positions: dict[str, list[int]], batches: list[list[str]], batch_results: Iterable[list[QueryResponse]]) -> list[QueryResponse]:
+    # ip-api answers a batch in request order
+    for batch, batch_result in zip(batches, batch_results):
+        for host, result in zip(batch, batch_result):
+            for i in positions[host]:
+                results[i] = respell_response(result, hosts[i])
     
-    return None
+    return results
 
-class IPAPI:
-    def __init__(self, api_url: Optional[str] = None, batch_size: Optional[int] = None, user_agent: Optional[str] = None) -> Self:
+def read_rate_limit(rate_limiter: RateLimiter, bucket: str, response: Any) -> Optional[int]:
+    # Updates the shared budget from ip-api's headers, and returns how long to wait when the request was refused
+    headers = response.headers
+    if "X-Rl" in headers and "X-Ttl" in headers:
+        rate_limiter.update(bucket, int(headers["X-Rl"]), int(headers["X-Ttl"]))
+    
+    if response.status_code != 429:
+        return None
+    
+    wait_time = int(headers.get("X-Ttl", 0)) + 1
+    logging.getLogger().info("Rate limit reached, retrying in %d seconds", wait_time)
+    rate_limiter.update(bucket, 0, wait_time)
+    return wait_time
+
+def read_payload(response: Any) -> Any:
+    if response.status_code != 200:
+        logging.getLogger().error("IPAPI remote error: %d, %s", response.status_code, response.text)
+        raise Exception(f"Remote error: {response.status_code}")
+    
+    return response.json()
+
+class Provider(ABC):
+    # An upstream source of host data. Results always use ip-api field names.
+    
+    @property
+    @abstractmethod
+    def name(self) -> str:
+        ...
+    
+    @property
+    @abstractmethod
+    def rate_limiter(self) -> Optional[RateLimiter]:
+        ...
+    
+    @abstractmethod
+    def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
+        ...
+    
+    @abstractmethod
+    def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None) -> Generator[list[QueryResponse], None, None]:
+        ...
+    
+    def supports(self, fields: list[str]) -> bool:
+        return True
+    
+class AsyncProvider(ABC):
+    # The Provider contract for the asyncio stack
+    
+    @property
+    @abstractmethod
+    def name(self) -> str:
+        ...
+    
+    @property
+    @abstractmethod
+    def rate_limiter(self) -> Optional[RateLimiter]:
+        ...
+    
+    @abstractmethod
+    async def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
+        ...
+    
+    @abstractmethod
+    def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None) -> AsyncGenerator[list[QueryResponse], None]:
+        ...
+    
+    def supports(self, fields: list[str]) -> bool:
+        return True
+    
+    async def close(self):
+        pass
+    
+class ThreadedProvider(AsyncProvider):
+    # Runs a blocking provider on worker threads, so that any Provider (e.g. a ProviderChain
+    # with HTTP fallbacks) can serve the asyncio stack
+    def __init__(self, provider: Provider) -> Self:
+        self._provider = provider
+    
+    @property
+    def name(self) -> str:
+        return self._provider.name
+    
+    @property
+    def rate_limiter(self) -> Optional[RateLimiter]:
+        return self._provider.rate_limiter
+    
+    def supports(self, fields: list[str]) -> bool:
+        return self._provider.supports(fields)
+    
+    async def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
+        return await asyncio.to_thread(self._provider.query, hosts, fields)
+    
+    async def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None) -> AsyncGenerator[list[QueryResponse], None]:
+        chunks = self._provider.query_stream(hosts, fields)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            chunks.close()
+    
+class IPAPI(Provider):
+    def __init__(self, api_url: Optional[str] = None, batch_size: Optional[int] = None, user_agent: Optional[str] = None, rate_limiter: Optional[RateLimiter] = None, max_workers: Optional[int] = None, timeout: Optional[tuple[float, float]] = None, metrics: Optional["Metrics"] = None) -> Self:
         self._logger = logging.getLogger()
         self._api_url = (api_url or IPAPI_URL).strip("/")
         self._batch_size = batch_size or IPAPI_BATCH_SIZE
         self._user_agent = user_agent or IPAPI_USER_AGENT
+        self._rate_limiter = rate_limiter or RateLimiter()
+        self._max_workers = max_workers or IPAPI_MAX_WORKERS
+        self._metrics = metrics
+        self._timeout = timeout or (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT)
+        self._executor = ThreadPoolExecutor(self._max_workers, thread_name_prefix="iptracker-ipapi")
         
+        # Keep-alive connection pool shared by request threads and batch workers
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._max_workers * 4)
+        self._session = requests.Session()
+        self._session.headers["User-Agent"] = self._user_agent
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        
+    @property
+    def name(self) -> str:
+        return "ip-api"
+    
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self._rate_limiter
+    
     def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
         fields = generate_fields(fields or IPAPI_DEFAULT_FIELDS)
         if isinstance(hosts, str):
             # validate host address
-            host_error = find_host_errors(hosts)
+            host, host_error = normalize_host(hosts)
             if host_error:
                 return QueryResponse.fail(hosts, host_error)
             
-            return self.__query_one(hosts, fields)
+            return respell_response(self.__query_one(host, fields), hosts)
         elif isinstance(hosts, list):
-            results = []
-            def validate_hosts():
-                for x in hosts:
-                    host_error = find_host_errors(x)
-                    if host_error:
-                        results.append(QueryResponse.fail(x, host_error))
-                        continue
-                    
-                    yield x
+            results, positions, batches = plan_batches(hosts, self._batch_size)
+            if len(batches) > 1:
+                # map() yields batch results in submission order
+                batch_results = self._executor.map(lambda batch: self.__query_batch(batch, fields), batches)
+            else:
+                batch_results = [self.__query_batch(batch, fields) for batch in batches]
             
-            for batch in generate_splits(list(validate_hosts()), self._batch_size):
-                results.extend(self.__query_batch(batch, fields))
-            return results
+            return assemble_batches(hosts, results, positions, batches, batch_results)
         else:
             raise TypeError("Invalid input type")
     
+    def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None) -> Generator[list[QueryResponse], None, None]:
+        fields = generate_fields(fields or IPAPI_DEFAULT_FIELDS)
+        invalid, spellings = normalize_hosts(hosts)
+        if invalid:
+            yield invalid
+        
+        # Batches are yielded as soon as each one completes, not in input order
+        futures = [self._executor.submit(self.__query_batch, batch, fields) for batch in generate_splits(list(spellings), self._batch_size)]
+        try:
+            for future in as_completed(futures):
+                yield expand_responses(future.result(), spellings)
+        finally:
+            for future in futures:
+                future.cancel()
+    
+    def __acquire(self, bucket: str):
+        try:
+            waited = self._rate_limiter.acquire(bucket)
+        except RateLimitExceeded:
+            if self._metrics:
+                self._metrics.submit_rate_limit_exceeded(bucket)
+            raise
+        
+        if self._metrics:
+            self._metrics.submit_rate_limit_wait(bucket, waited)
+    
+    def __submit_request(self, bucket: str, status: int | str, start_time: float):
+        if self._metrics:
+            self._metrics.submit_upstream_request(bucket, status, time.perf_counter() - start_time)
+    
+    def __request(self, bucket: str, method: str, url: str, **kwargs) -> requests.Response:
+        for _ in range(IPAPI_MAX_RETRIES + 1):
+            # Waits for budget shared with other workers, or fails fast with RateLimitExceeded
+            self.__acquire(bucket)
+            start_time = time.perf_counter()
+            try:
+                response = self._session.request(method, url, timeout=self._timeout, **kwargs)
+            except Exception:
+                self.__submit_request(bucket, "error", start_time)
+                raise
+            self.__submit_request(bucket, response.status_code, start_time)
+            
+            wait_time = read_rate_limit(self._rate_limiter, bucket, response)
+            if wait_time is None:
+                return response
+        
+        if self._metrics:
+            self._metrics.submit_rate_limit_exceeded(bucket)
+        raise RateLimitExceeded(wait_time)
+    
     def __query_one(self, host: str, fields: str) -> QueryResponse:
         self._logger.info("Resolving host %s", host)
         
         request_url = f"{self._api_url}/json/{host}"
-        response = requests.get(
+        response = self.__request(
+            "json",
+            "GET",
             request_url,
-            params={"fields": fields},
-            headers={"User-Agent": self._user_agent}
+            params={"fields": fields}
         )
         
-        headers = response.headers
-        if response.status_code == 429 or "X-Rl" in headers and int(headers["X-Rl"]) == 0:
-            wait_time = int(headers["X-Ttl"]) + 1
-            self._logger.info("Rate limit reached, waiting for %d seconds", wait_time)
-            time.sleep(wait_time)
-            # Retry request
-            return self.__query_one(host, fields)
-        
-        if response.status_code != 200:
-            self._logger.error("IPAPI remote error: %d, %s", response.status_code, response.text)
-            raise Exception(f"Remote error: {response.status_code}")
-        
-        return dict_to_response(response.json())
+        return dict_to_response(read_payload(response))
     
     def __query_batch(self, hosts: list[str], fields: str) -> list[QueryResponse]:
         if len(hosts) > self._batch_size:
             raise ValueError(f"Invalid batch size: {len(hosts)}, maximum allowed size is {self._batch_size}")
         
-        results = []
-                
         self._logger.info("Resolving %d hosts", len(hosts))
+        if self._metrics:
+            self._metrics.submit_batch_size("upstream", len(hosts))
         request_url = f"{self._api_url}/batch"
-        response = requests.post(
+        response = self.__request(
+            "batch",
+            "POST",
             request_url,
             params={"fields": fields},
-            headers={"User-Agent": self._user_agent, "Content-Type": "application/json"},
+            headers={"Content-Type": "application/json"},
             data=json.dumps(hosts)
         )
         
-        headers = response.headers
-        if response.status_code == 429 or "X-Rl" in headers and int(headers["X-Rl"]) == 0:
-            wait_time = int(headers["X-Ttl"]) + 1
-            self._logger.info("Rate limit reached, waiting for %d seconds", wait_time)
-            time.sleep(wait_time)
-            # Retry request
-            return self.__query_batch(hosts, fields)
-        
-        if response.status_code != 200:
-            self._logger.error("IPAPI remote error: %d, %s", response.status_code, response.text)
-            raise Exception(f"Remote error: {response.status_code}")
-        
-        for host in response.json():
-            results.append(dict_to_response(host))
-            
-        return results
\ No newline at end of file
+        return [dict_to_response(host) for host in read_payload(response)]
\ No newline at end of file
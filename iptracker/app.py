@@ -1,77 +1,386 @@
+import atexit
 import json
+import logging
+import math
 import os
-from flask import Flask, request
+import threading
+import time
+from typing import Any, Optional, Self
+from flask import Flask, current_app, request, stream_with_context
 from pymongo import MongoClient
-from iptracker.api import IPAPI, response_to_dict
+from iptracker.api import IPAPI
+from iptracker.batching import MicroBatcher
+from iptracker.cache import HostCache
 from iptracker.db import HostDataStore
+from iptracker.encoder import ResponseEncoder, negotiate_stream
+from iptracker.jobs import JobRunner, JobStore, JobTooLarge
+from iptracker.prefix import PrefixCache
+from iptracker.providers import ProviderChain, build_providers, load_provider_config
+from iptracker.rangedb import RangeDatabase
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+from iptracker.refresh import RefreshQueue
 from iptracker.resolver import HostResolver
-from iptracker.constants import DEFAULT_APP_HOST, DEFAULT_APP_PORT, DEFAULT_METRICS_PORT
+from iptracker.snapshot import CacheSnapshots
+from iptracker.sqlite_db import SQLiteHostDataStore
+from iptracker.streaming import iter_json_array
+from iptracker.constants import DS_CACHE_EXPIRATION, DS_SETUP_RETRY_INTERVAL, NDJSON_MIMETYPE, STREAM_READ_SIZE
+from iptracker.config import DS_BACKEND, MONGO_URI, SQLITE_PATH, RANGE_DB_PATH, CACHE_EXPIRATION_TIME, CACHE_SOFT_EXPIRATION_TIME, REFRESH_BATCH_SIZE, REFRESH_INTERVAL, REFRESH_QUEUE_SIZE, REFRESH_RATE_LIMIT_RESERVE, JOB_WORKER, JOB_CHUNK_SIZE, JOB_MAX_SIZE, JOB_PAGE_SIZE, JOB_LEASE_TIME, JOB_MAX_ATTEMPTS, JOB_EXPIRATION, JOB_POLL_INTERVAL, JOB_RATE_LIMIT_RESERVE, COLLECTED_FIELDS, IPAPI_USER_AGENT, IPAPI_URL, IPAPI_BATCH_SIZE, IPAPI_BATCH_WINDOW, IPAPI_RATE_LIMIT_FILE, IPAPI_RATE_LIMITS, IPAPI_RATE_LIMIT_MAX_WAIT, IPAPI_MAX_WORKERS, IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT, PROVIDERS_FILE, PROVIDER_HEDGE_DELAY, PROVIDER_MAX_WORKERS, LOG_LEVEL, WRITE_BEHIND, MEMORY_CACHE_SIZE, MEMORY_CACHE_EXPIRATION, MEMORY_CACHE_NEGATIVE_EXPIRATION, MEMORY_CACHE_SNAPSHOT, PREFIX_CACHE, PREFIX_CACHE_IPV4_LENGTH, PREFIX_CACHE_IPV6_LENGTH, PREFIX_CACHE_FIELDS, PREFIX_CACHE_SIZE, PREFIX_CACHE_EXPIRATION, PREFIX_CACHE_VERIFY_RATE, ENCODER_CACHE_SIZE, RESPONSE_COMPRESS_MIN_SIZE, HEALTH_CHECK_TIMEOUT, APP_HOST, METRICS_PORT
 from iptracker.metrics import Metrics
 
-MONGO_URI = os.getenv("MONGO_URI")
-CACHE_EXPIRATION_TIME = os.getenv("CACHE_EXPIRATION_TIME")
-COLLECTED_FIELDS = os.getenv("COLLECTED_FIELDS")
-COLLECTED_FIELDS = COLLECTED_FIELDS.split(",") if COLLECTED_FIELDS else None
-IPAPI_USER_AGENT = os.getenv("USER_AGENT")
-IPAPI_URL = os.getenv("IPAPI_URL")
-IPAPI_BATCH_SIZE = os.getenv("IPAPI_BATCH_SIZE")
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+_metrics = None
 
-APP_HOST = os.getenv("APP_HOST", DEFAULT_APP_HOST)
-APP_PORT = int(os.getenv("APP_PORT", DEFAULT_APP_PORT))
-METRICS_PORT = int(os.getenv("METRICS_PORT", DEFAULT_METRICS_PORT))
-
-app = Flask(__name__)
-app.logger.setLevel(LOG_LEVEL)
-
-api = IPAPI(IPAPI_URL, IPAPI_BATCH_SIZE, IPAPI_USER_AGENT)
-metrics = Metrics()
-ds = None
+def get_metrics() -> Metrics:
+    # Collectors are registered globally, so every app in the process shares one instance
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    
+    return _metrics
 
-if MONGO_URI:
-    app.logger.info("Connecting to MongoDB server...")
-    connection = MongoClient(MONGO_URI)
-    server_info = connection.server_info()
-    app.logger.info(f"Connected to MongoDB v{server_info['version']}")
-    ds = HostDataStore(connection, CACHE_EXPIRATION_TIME, metrics)
-else:
-    app.logger.warning("MongoDB URI not set. Queries will not be cached locally.")
+class Services:
+    # Connections, thread pools and background threads do not survive a fork, so they are built
+    # on first use in each process. With gunicorn --preload the master only imports the code and
+    # loads read-only data, and every worker starts without touching the database.
+    def __init__(self, provider_config: list[dict[str, Any]], offline_db: Optional[RangeDatabase] = None, metrics_server: Optional[tuple[str, int]] = None) -> Self:
+        # Same logger as app.logger, which carries LOG_LEVEL
+        self._logger = logging.getLogger(__name__)
+        self._provider_config = provider_config
+        self._metrics_server = metrics_server
+        self._lock = threading.Lock()
+        self._pid = None
+        self._setup_status = "pending"
+        self.offline_db = offline_db
+        self.rate_limiter = None
+        self.api = None
+        self.connection = None
+        self.ds = None
+        self.cache = None
+        self.prefix_cache = None
+        self.refresh_queue = None
+        self.batcher = None
+        self.resolver = None
+        self.jobs = None
+        self.job_runner = None
+    
+    def get(self) -> Self:
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self.__build()
+                    self._pid = pid
+        
+        return self
+    
+    def __build(self):
+        metrics = get_metrics()
+        if self._metrics_server:
+            host, port = self._metrics_server
+            metrics.start_server(host=host, port=port)
+        
+        fallback_providers = any(x.get("type", "http") != "ip-api" for x in self._provider_config)
+        
+        # With fallback providers, an exhausted ip-api budget fails over instead of waiting
+        self.rate_limiter = RateLimiter(IPAPI_RATE_LIMIT_FILE, IPAPI_RATE_LIMITS, 0 if fallback_providers else IPAPI_RATE_LIMIT_MAX_WAIT)
+        self.api = IPAPI(IPAPI_URL, IPAPI_BATCH_SIZE, IPAPI_USER_AGENT, self.rate_limiter, IPAPI_MAX_WORKERS, (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT), metrics)
+        if fallback_providers:
+            providers = build_providers(self._provider_config, self.api, IPAPI_RATE_LIMIT_FILE, IPAPI_USER_AGENT, (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT), metrics)
+            self.api = ProviderChain(providers, PROVIDER_HEDGE_DELAY, PROVIDER_MAX_WORKERS, metrics, self.rate_limiter)
+            self._logger.info(f"Upstream providers in priority order: {self.api.name}")
+        
+        if MONGO_URI:
+            # The client connects in the background, the first query waits for the server instead of startup
+            self.connection = MongoClient(MONGO_URI)
+        
+        if DS_BACKEND == "sqlite":
+            # Embedded store for single nodes, jobs still need MongoDB
+            self.ds = SQLiteHostDataStore(SQLITE_PATH, CACHE_EXPIRATION_TIME, metrics, write_behind=WRITE_BEHIND, defer_setup=True)
+            atexit.register(self.ds.close)
+            self._logger.info(f"Using SQLite database {SQLITE_PATH}")
+        elif self.connection:
+            self.ds = HostDataStore(self.connection, CACHE_EXPIRATION_TIME, metrics, write_behind=WRITE_BEHIND, defer_setup=True)
+            atexit.register(self.ds.close)
+        else:
+            self._logger.warning("MongoDB URI not set. Queries will not be cached locally.")
+        
+        if MEMORY_CACHE_SIZE > 0:
+            self.cache = HostCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_EXPIRATION, MEMORY_CACHE_NEGATIVE_EXPIRATION, metrics)
+            if MEMORY_CACHE_SNAPSHOT:
+                # The hottest hosts are written on shutdown and loaded by the next start
+                snapshots = CacheSnapshots(MEMORY_CACHE_SNAPSHOT)
+                preloaded = self.cache.preload(snapshots.load(MEMORY_CACHE_SIZE, CACHE_EXPIRATION_TIME or DS_CACHE_EXPIRATION))
+                if preloaded:
+                    self._logger.info(f"Preloaded {preloaded} hosts into the in-memory cache from {MEMORY_CACHE_SNAPSHOT}")
+                cache = self.cache
+                atexit.register(lambda: snapshots.write(cache.hot_entries()))
+        else:
+            self._logger.info("In-memory cache disabled.")
+        
+        if PREFIX_CACHE:
+            self.prefix_cache = PrefixCache(PREFIX_CACHE_IPV4_LENGTH, PREFIX_CACHE_IPV6_LENGTH, PREFIX_CACHE_FIELDS, PREFIX_CACHE_SIZE, PREFIX_CACHE_EXPIRATION, PREFIX_CACHE_VERIFY_RATE)
+            self._logger.info(f"Prefix cache enabled for fields: {', '.join(sorted(self.prefix_cache.fields))}")
+        
+        if CACHE_SOFT_EXPIRATION_TIME:
+            self.refresh_queue = RefreshQueue(CACHE_SOFT_EXPIRATION_TIME, REFRESH_BATCH_SIZE, REFRESH_INTERVAL, REFRESH_QUEUE_SIZE, REFRESH_RATE_LIMIT_RESERVE, metrics)
+            self._logger.info(f"Refreshing entries older than {CACHE_SOFT_EXPIRATION_TIME} seconds in the background")
+            atexit.register(self.refresh_queue.close)
+        
+        if IPAPI_BATCH_WINDOW > 0:
+            self.batcher = MicroBatcher(self.api, IPAPI_BATCH_WINDOW, IPAPI_BATCH_SIZE)
+        
+        self.resolver = HostResolver(self.api, self.ds, metrics, self.cache, self.batcher, self.offline_db, self.prefix_cache, self.refresh_queue)
+        
+        if self.connection:
+            self.jobs = JobStore(self.connection, JOB_CHUNK_SIZE, JOB_MAX_SIZE, JOB_LEASE_TIME, JOB_EXPIRATION, defer_setup=True, max_attempts=JOB_MAX_ATTEMPTS)
+            if JOB_WORKER:
+                self.job_runner = JobRunner(self.jobs, self.resolver, self.rate_limiter, JOB_POLL_INTERVAL, JOB_RATE_LIMIT_RESERVE)
+                atexit.register(self.job_runner.close)
+        
+        self._setup_status = "pending"
+        threading.Thread(target=self.__setup, name="iptracker-setup", daemon=True).start()
+    
+    def __setup(self):
+        # Index checks and the first size estimate run while requests are already being served
+        while True:
+            try:
+                if self.connection:
+                    server_info = self.connection.server_info()
+                    self._logger.info(f"Connected to MongoDB v{server_info['version']}")
+                if self.ds:
+                    self.ds.setup()
+                if self.jobs:
+                    self.jobs.setup()
+            except Exception:
+                self._setup_status = "failed"
+                self._logger.exception(f"Database setup failed, retrying in {DS_SETUP_RETRY_INTERVAL} seconds")
+                time.sleep(DS_SETUP_RETRY_INTERVAL)
+                continue
+            
+            self._setup_status = "done"
+            return
+    
+    def status(self, timeout: Optional[float] = None) -> tuple[bool, dict[str, Any]]:
+        # Ready once the local database answers, jobs and upstream budget are only reported
+        timeout = timeout or HEALTH_CHECK_TIMEOUT
+        ready = True
+        report = {"setup": self._setup_status}
+        
+        if self.ds:
+            try:
+                self.ds.ping(timeout)
+                report["storage"] = {"backend": DS_BACKEND, "status": "ok"}
+            except Exception as e:
+                ready = False
+                report["storage"] = {"backend": DS_BACKEND, "status": "fail", "message": str(e)}
+        else:
+            report["storage"] = {"backend": None, "status": "disabled"}
+        
+        if self.jobs and self.ds and DS_BACKEND == "mongodb":
+            # Same server as the storage backend, there is no need to ask twice
+            report["jobs"] = {"status": report["storage"]["status"]}
+        elif self.jobs:
+            try:
+                self.jobs.ping(timeout)
+                report["jobs"] = {"status": "ok"}
+            except Exception as e:
+                report["jobs"] = {"status": "fail", "message": str(e)}
+        else:
+            report["jobs"] = {"status": "disabled"}
+        
+        remaining, reset_in = self.rate_limiter.peek("batch")
+        report["upstream"] = {
+            "providers": [x.name for x in self.api.providers] if isinstance(self.api, ProviderChain) else [self.api.name],
+            "remaining": remaining,
+            "reset_in": round(reset_in, 3)
+        }
+        
+        report["status"] = "ok" if ready else "fail"
+        return ready, report
 
-resolver = HostResolver(api, ds, metrics)
+def wants_stream() -> bool:
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    
+    return negotiate_stream(request.headers.get("Accept"))
 
-@app.route("/json/<ip_address>", methods=["GET", "POST"])
-@metrics.time_request("/json")
-def endpoint_single(ip_address):
-    fields = request.args.get("fields", None)
-    fields = fields.split(",") if fields else COLLECTED_FIELDS
-    skip_cache = request.method == "POST"
-    result = resolver.query(ip_address, fields, skip_cache)
-    include_fetch_date = True if fields and "fetched_at" in fields else False
-    include_data_source = True if fields and "data_source" in fields else False
-    
-    return app.response_class(
-        response=json.dumps(response_to_dict(result, include_fetch_date, include_data_source), default=str),
-        status=200,
+def fail_response(message: str, status: int):
+    return current_app.response_class(
+        response=json.dumps({"status": "fail", "message": message}),
+        status=status,
         mimetype='application/json'
     )
 
-@app.route("/batch", methods=["POST"])
-@metrics.time_request("/batch")
-def endpoint_batch():
-    fields = request.args.get("fields", None)
-    fields = fields.split(",") if fields else COLLECTED_FIELDS
-    ip_addresses = request.json
-    results = resolver.query(ip_addresses, fields)
-    include_fetch_date = True if fields and "fetched_at" in fields else False
-    include_data_source = True if fields and "data_source" in fields else False
-    
-    results = [response_to_dict(x, include_fetch_date, include_data_source) for x in results]
-    return app.response_class(
-        response=json.dumps(results, default=str),
-        status=200,
-        mimetype='application/json'
-    )
+def create_app(metrics_server: Optional[tuple[str, int]] = None) -> Flask:
+    if DS_BACKEND not in ("mongodb", "sqlite"):
+        raise ValueError(f"Unknown storage backend: {DS_BACKEND}")
+    
+    app = Flask(__name__)
+    app.logger.setLevel(LOG_LEVEL)
+    
+    # Read-only data is loaded here, so a preloading master shares it with every worker
+    provider_config = load_provider_config(PROVIDERS_FILE) if PROVIDERS_FILE else []
+    offline_db = None
+    if RANGE_DB_PATH:
+        offline_db = RangeDatabase(RANGE_DB_PATH)
+        app.logger.info(f"Loaded {len(offline_db)} ranges from offline database {RANGE_DB_PATH}")
+    
+    metrics = get_metrics()
+    services = Services(provider_config, offline_db, metrics_server)
+    encoder = ResponseEncoder(ENCODER_CACHE_SIZE, RESPONSE_COMPRESS_MIN_SIZE)
+    app.extensions["iptracker"] = services
+    
+    @app.errorhandler(RateLimitExceeded)
+    def handle_rate_limit(e: RateLimitExceeded):
+        return app.response_class(
+            response=json.dumps({"status": "fail", "message": "upstream rate limit exceeded, retry later"}),
+            status=503,
+            mimetype='application/json',
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+    
+    def json_response(body: str):
+        with metrics.time_stage("compress"):
+            body, encoding = encoder.compress(body.encode(), request.headers.get("Accept-Encoding"))
+        headers = {"Vary": "Accept-Encoding"}
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        
+        return app.response_class(
+            response=body,
+            status=200,
+            mimetype='application/json',
+            headers=headers
+        )
+    
+    @app.route("/healthz", methods=["GET"])
+    def endpoint_liveness():
+        # The process is serving requests, dependencies are left to /readyz
+        return app.response_class(
+            response=json.dumps({"status": "ok"}),
+            status=200,
+            mimetype='application/json'
+        )
+    
+    @app.route("/readyz", methods=["GET"])
+    def endpoint_readiness():
+        ready, report = services.get().status()
+        return app.response_class(
+            response=json.dumps(report),
+            status=200 if ready else 503,
+            mimetype='application/json'
+        )
+    
+    @app.route("/json/<ip_address>", methods=["GET", "POST"])
+    @metrics.time_request("/json")
+    def endpoint_single(ip_address):
+        fields = request.args.get("fields", None)
+        fields = fields.split(",") if fields else COLLECTED_FIELDS
+        skip_cache = request.method == "POST"
+        resolver = services.get().resolver
+        result = resolver.query(ip_address, fields, skip_cache)
+        include_fetch_date = True if fields and "fetched_at" in fields else False
+        include_data_source = True if fields and "data_source" in fields else False
+        
+        with metrics.time_stage("encode"):
+            body = encoder.encode(result, include_fetch_date, include_data_source)
+        
+        return json_response(body)
+    
+    @app.route("/batch", methods=["POST"])
+    @metrics.time_request("/batch")
+    def endpoint_batch():
+        resolver = services.get().resolver
+        fields = request.args.get("fields", None)
+        fields = fields.split(",") if fields else COLLECTED_FIELDS
+        include_fetch_date = True if fields and "fetched_at" in fields else False
+        include_data_source = True if fields and "data_source" in fields else False
+        
+        if wants_stream():
+            # The body is parsed as it arrives and each result is sent as soon as it is resolved
+            ip_addresses = iter_json_array(iter(lambda: request.stream.read(STREAM_READ_SIZE), b""))
+            def generate():
+                for x in resolver.query_stream(ip_addresses, fields):
+                    yield encoder.encode(x, include_fetch_date, include_data_source) + "\n"
+            
+            return app.response_class(
+                response=stream_with_context(generate()),
+                status=200,
+                mimetype=NDJSON_MIMETYPE
+            )
+        
+        ip_addresses = request.json
+        results = resolver.query(ip_addresses, fields)
+        with metrics.time_stage("encode"):
+            body = encoder.encode_many(results, include_fetch_date, include_data_source)
+        
+        return json_response(body)
+    
+    @app.route("/jobs", methods=["POST"])
+    @metrics.time_request("/jobs")
+    def endpoint_job_create():
+        jobs = services.get().jobs
+        if not jobs:
+            return fail_response("jobs require a MongoDB connection", 501)
+        
+        fields = request.args.get("fields", None)
+        fields = fields.split(",") if fields else COLLECTED_FIELDS
+        # Large lists are read and stored incrementally instead of being parsed in one piece
+        ip_addresses = iter_json_array(iter(lambda: request.stream.read(STREAM_READ_SIZE), b""))
+        try:
+            job = jobs.create(ip_addresses, fields)
+        except JobTooLarge as e:
+            return fail_response(str(e), 413)
+        except ValueError:
+            return fail_response("request body must be a JSON array", 400)
+        
+        response = json_response(json.dumps(job, default=str))
+        response.status_code = 202
+        response.headers["Location"] = f"/jobs/{job['id']}"
+        return response
+    
+    @app.route("/jobs/<job_id>", methods=["GET"])
+    @metrics.time_request("/jobs/<job_id>")
+    def endpoint_job_status(job_id):
+        jobs = services.get().jobs
+        job = jobs.get(job_id) if jobs else None
+        if not job:
+            return fail_response("job not found", 404)
+        
+        return json_response(json.dumps(job, default=str))
+    
+    @app.route("/jobs/<job_id>/results", methods=["GET"])
+    @metrics.time_request("/jobs/<job_id>/results")
+    def endpoint_job_results(job_id):
+        jobs = services.get().jobs
+        job = jobs.get(job_id) if jobs else None
+        if not job:
+            return fail_response("job not found", 404)
+        
+        offset = max(request.args.get("offset", 0, type=int), 0)
+        if wants_stream():
+            # Everything resolved so far from the offset on, a job still running can be read again from where this stopped
+            def generate():
+                for x in jobs.results(job_id, offset):
+                    yield json.dumps(x) + "\n"
+            
+            return app.response_class(
+                response=stream_with_context(generate()),
+                status=200,
+                mimetype=NDJSON_MIMETYPE
+            )
+        
+        limit = min(max(request.args.get("limit", JOB_PAGE_SIZE, type=int), 1), JOB_PAGE_SIZE)
+        results = list(jobs.results(job_id, offset, limit))
+        return json_response(json.dumps({
+            **job,
+            "offset": offset,
+            "next_offset": offset + len(results),
+            "results": results
+        }, default=str))
+    
+    return app
 
 def start_server():
-    metrics.start_server(host=APP_HOST, port=METRICS_PORT)
-    return app
\ No newline at end of file
+    # Each process serves its own metrics, started with the services. With PROMETHEUS_MULTIPROC_DIR
+    # set the gunicorn master serves the aggregate instead, see gunicorn_conf.
+    return create_app((APP_HOST, METRICS_PORT))
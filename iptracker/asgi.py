@@ -0,0 +1,414 @@
+import asyncio
+import json
+import logging
+import math
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Iterator, Optional, Self
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+from iptracker.api import IPAPI, AsyncProvider, QueryResponse, ThreadedProvider
+from iptracker.async_api import AsyncIPAPI
+from iptracker.async_db import AsyncHostDataStore
+from iptracker.async_resolver import AsyncHostResolver
+from iptracker.batching import AsyncMicroBatcher
+from iptracker.cache import HostCache
+from iptracker.encoder import ResponseEncoder, negotiate_stream
+from iptracker.jobs import JobRunner, JobStore, JobTooLarge
+from iptracker.prefix import PrefixCache
+from iptracker.providers import ProviderChain, build_providers, load_provider_config
+from iptracker.rangedb import RangeDatabase
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+from iptracker.refresh import AsyncRefreshQueue
+from iptracker.snapshot import CacheSnapshots
+from iptracker.sqlite_db import SQLiteHostDataStore
+from iptracker.store import AsyncHostStore, ThreadedHostStore
+from iptracker.streaming import aiter_chunks, aiter_json_array
+from iptracker.constants import DS_CACHE_EXPIRATION, DS_SETUP_RETRY_INTERVAL, NDJSON_MIMETYPE
+from iptracker.config import DS_BACKEND, MONGO_URI, SQLITE_PATH, RANGE_DB_PATH, CACHE_EXPIRATION_TIME, CACHE_SOFT_EXPIRATION_TIME, REFRESH_BATCH_SIZE, REFRESH_INTERVAL, REFRESH_QUEUE_SIZE, REFRESH_RATE_LIMIT_RESERVE, JOB_WORKER, JOB_CHUNK_SIZE, JOB_MAX_SIZE, JOB_PAGE_SIZE, JOB_LEASE_TIME, JOB_MAX_ATTEMPTS, JOB_EXPIRATION, JOB_POLL_INTERVAL, JOB_RATE_LIMIT_RESERVE, COLLECTED_FIELDS, IPAPI_USER_AGENT, IPAPI_URL, IPAPI_BATCH_SIZE, IPAPI_BATCH_WINDOW, IPAPI_RATE_LIMIT_FILE, IPAPI_RATE_LIMITS, IPAPI_RATE_LIMIT_MAX_WAIT, IPAPI_MAX_WORKERS, IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT, PROVIDERS_FILE, PROVIDER_HEDGE_DELAY, PROVIDER_MAX_WORKERS, LOG_LEVEL, WRITE_BEHIND, MEMORY_CACHE_SIZE, MEMORY_CACHE_EXPIRATION, MEMORY_CACHE_NEGATIVE_EXPIRATION, MEMORY_CACHE_SNAPSHOT, PREFIX_CACHE, PREFIX_CACHE_IPV4_LENGTH, PREFIX_CACHE_IPV6_LENGTH, PREFIX_CACHE_FIELDS, PREFIX_CACHE_SIZE, PREFIX_CACHE_EXPIRATION, PREFIX_CACHE_VERIFY_RATE, ENCODER_CACHE_SIZE, RESPONSE_COMPRESS_MIN_SIZE, HEALTH_CHECK_TIMEOUT, APP_HOST, METRICS_PORT
+from iptracker.metrics import Metrics
+
+logger = logging.getLogger("iptracker.asgi")
+logger.setLevel(LOG_LEVEL)
+
+# Collectors are registered globally, so every app in the process shares one instance
+metrics = Metrics()
+
+class LoopResolver:
+    # JobRunner works on its own thread, its queries are run on the server's event loop
+    def __init__(self, resolver: AsyncHostResolver, loop: asyncio.AbstractEventLoop):
+        self._resolver = resolver
+        self._loop = loop
+
+    def query(self, hosts: str | list[str], fields: Optional[list[str]] = None, skip_cache: bool = False) -> QueryResponse | list[QueryResponse]:
+        return asyncio.run_coroutine_threadsafe(self._resolver.query(hosts, fields, skip_cache), self._loop).result()
+
+def iter_from_loop(items: AsyncIterator[Any], loop: asyncio.AbstractEventLoop) -> Iterator[Any]:
+    # Reads an async iterator from a worker thread, a chunk at a time to keep loop round trips down
+    chunks = aiter_chunks(items, JOB_CHUNK_SIZE)
+
+    async def next_chunk() -> Optional[list[Any]]:
+        return await anext(chunks, None)
+
+    while True:
+        chunk = asyncio.run_coroutine_threadsafe(next_chunk(), loop).result()
+        if chunk is None:
+            return
+        yield from chunk
+
+class Services:
+    # Clients, stores and background tasks belong to the event loop serving requests, so they
+    # are built by the lifespan handler, the same point at which each Flask worker builds its own.
+    # Importing the module and creating the app only load read-only data.
+    def __init__(self, provider_config: list[dict[str, Any]], offline_db: Optional[RangeDatabase] = None, metrics_server: Optional[tuple[str, int]] = None) -> Self:
+        self._provider_config = provider_config
+        self._metrics_server = metrics_server
+        self._setup_status = "pending"
+        self._setup_task: Optional[asyncio.Task] = None
+        self._snapshots: Optional[CacheSnapshots] = None
+        self.offline_db = offline_db
+        self.rate_limiter: Optional[RateLimiter] = None
+        self.api: Optional[AsyncProvider] = None
+        self.ds: Optional[AsyncHostStore] = None
+        self.cache = None
+        self.prefix_cache = None
+        self.refresh_queue = None
+        self.batcher = None
+        self.resolver: Optional[AsyncHostResolver] = None
+        self.jobs = None
+        self.job_runner = None
+
+    async def start(self):
+        if self._metrics_server:
+            host, port = self._metrics_server
+            metrics.start_server(host=host, port=port)
+
+        fallback_providers = any(x.get("type", "http") != "ip-api" for x in self._provider_config)
+
+        # With fallback providers, an exhausted ip-api budget fails over instead of waiting
+        self.rate_limiter = RateLimiter(IPAPI_RATE_LIMIT_FILE, IPAPI_RATE_LIMITS, 0 if fallback_providers else IPAPI_RATE_LIMIT_MAX_WAIT)
+        if fallback_providers:
+            # The HTTP providers and their failover are blocking, the chain runs on worker threads
+            ipapi = IPAPI(IPAPI_URL, IPAPI_BATCH_SIZE, IPAPI_USER_AGENT, self.rate_limiter, IPAPI_MAX_WORKERS, (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT), metrics)
+            providers = build_providers(self._provider_config, ipapi, IPAPI_RATE_LIMIT_FILE, IPAPI_USER_AGENT, (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT), metrics)
+            self.api = ThreadedProvider(ProviderChain(providers, PROVIDER_HEDGE_DELAY, PROVIDER_MAX_WORKERS, metrics, self.rate_limiter))
+            logger.info(f"Upstream providers in priority order: {self.api.name}")
+        else:
+            self.api = AsyncIPAPI(IPAPI_URL, IPAPI_BATCH_SIZE, IPAPI_USER_AGENT, self.rate_limiter, IPAPI_MAX_WORKERS, (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT), metrics)
+
+        if DS_BACKEND == "sqlite":
+            # Embedded store for single nodes, jobs still need MongoDB
+            self.ds = ThreadedHostStore(SQLiteHostDataStore(SQLITE_PATH, CACHE_EXPIRATION_TIME, metrics, write_behind=WRITE_BEHIND, defer_setup=True))
+            logger.info(f"Using SQLite database {SQLITE_PATH}")
+        elif MONGO_URI:
+            # Motor connects lazily, indexes are checked in the background once the server answers
+            self.ds = AsyncHostDataStore(AsyncIOMotorClient(MONGO_URI), CACHE_EXPIRATION_TIME, metrics, write_behind=WRITE_BEHIND)
+        else:
+            logger.warning("MongoDB URI not set. Queries will not be cached locally.")
+
+        if MONGO_URI:
+            # Job storage is sync, its calls run on the thread pool
+            self.jobs = JobStore(MongoClient(MONGO_URI), JOB_CHUNK_SIZE, JOB_MAX_SIZE, JOB_LEASE_TIME, JOB_EXPIRATION, defer_setup=True, max_attempts=JOB_MAX_ATTEMPTS)
+
+        if MEMORY_CACHE_SIZE > 0:
+            self.cache = HostCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_EXPIRATION, MEMORY_CACHE_NEGATIVE_EXPIRATION, metrics)
+            if MEMORY_CACHE_SNAPSHOT:
+                # The hottest hosts are written on shutdown and loaded by the next start
+                self._snapshots = CacheSnapshots(MEMORY_CACHE_SNAPSHOT)
+                preloaded = self.cache.preload(self._snapshots.load(MEMORY_CACHE_SIZE, CACHE_EXPIRATION_TIME or DS_CACHE_EXPIRATION))
+                if preloaded:
+                    logger.info(f"Preloaded {preloaded} hosts into the in-memory cache from {MEMORY_CACHE_SNAPSHOT}")
+        else:
+            logger.info("In-memory cache disabled.")
+
+        if PREFIX_CACHE:
+            self.prefix_cache = PrefixCache(PREFIX_CACHE_IPV4_LENGTH, PREFIX_CACHE_IPV6_LENGTH, PREFIX_CACHE_FIELDS, PREFIX_CACHE_SIZE, PREFIX_CACHE_EXPIRATION, PREFIX_CACHE_VERIFY_RATE)
+            logger.info(f"Prefix cache enabled for fields: {', '.join(sorted(self.prefix_cache.fields))}")
+
+        if CACHE_SOFT_EXPIRATION_TIME:
+            self.refresh_queue = AsyncRefreshQueue(CACHE_SOFT_EXPIRATION_TIME, REFRESH_BATCH_SIZE, REFRESH_INTERVAL, REFRESH_QUEUE_SIZE, REFRESH_RATE_LIMIT_RESERVE, metrics)
+            logger.info(f"Refreshing entries older than {CACHE_SOFT_EXPIRATION_TIME} seconds in the background")
+
+        if IPAPI_BATCH_WINDOW > 0:
+            self.batcher = AsyncMicroBatcher(self.api, IPAPI_BATCH_WINDOW, IPAPI_BATCH_SIZE)
+
+        self.resolver = AsyncHostResolver(self.api, self.ds, metrics, self.cache, self.batcher, self.offline_db, self.prefix_cache, self.refresh_queue)
+
+        if self.jobs and JOB_WORKER:
+            self.job_runner = JobRunner(self.jobs, LoopResolver(self.resolver, asyncio.get_running_loop()), self.rate_limiter, JOB_POLL_INTERVAL, JOB_RATE_LIMIT_RESERVE)
+
+        self._setup_status = "pending"
+        self._setup_task = asyncio.create_task(self.__setup())
+
+    async def close(self):
+        if self.job_runner:
+            # The runner may be waiting on a query that needs the loop, so it is joined from a thread
+            await asyncio.to_thread(self.job_runner.close)
+        if self._setup_task:
+            self._setup_task.cancel()
+            await asyncio.gather(self._setup_task, return_exceptions=True)
+        if self.refresh_queue:
+            await self.refresh_queue.close()
+        if self.ds:
+            await self.ds.close()
+        if self.api:
+            await self.api.close()
+        if self._snapshots:
+            self._snapshots.write(self.cache.hot_entries())
+
+    async def __setup(self):
+        # Index checks and the first size estimate run while requests are already being served
+        while True:
+            try:
+                if isinstance(self.ds, AsyncHostDataStore):
+                    server_info = await self.ds.server_info()
+                    logger.info(f"Connected to MongoDB v{server_info['version']}")
+                if self.ds:
+                    await self.ds.setup()
+                if self.jobs:
+                    await run_in_threadpool(self.jobs.setup)
+            except Exception:
+                self._setup_status = "failed"
+                logger.exception(f"Database setup failed, retrying in {DS_SETUP_RETRY_INTERVAL} seconds")
+                await asyncio.sleep(DS_SETUP_RETRY_INTERVAL)
+                continue
+
+            self._setup_status = "done"
+            return
+
+    async def status(self, timeout: Optional[float] = None) -> tuple[bool, dict[str, Any]]:
+        # Ready once the local database answers, jobs and upstream budget are only reported
+        timeout = timeout or HEALTH_CHECK_TIMEOUT
+        ready = True
+        report = {"setup": self._setup_status}
+
+        if self.ds:
+            try:
+                await self.ds.ping(timeout)
+                report["storage"] = {"backend": DS_BACKEND, "status": "ok"}
+            except Exception as e:
+                ready = False
+                report["storage"] = {"backend": DS_BACKEND, "status": "fail", "message": str(e) or type(e).__name__}
+        else:
+            report["storage"] = {"backend": None, "status": "disabled"}
+
+        if self.jobs and self.ds and DS_BACKEND == "mongodb":
+            # Same server as the storage backend, there is no need to ask twice
+            report["jobs"] = {"status": report["storage"]["status"]}
+        elif self.jobs:
+            try:
+                await run_in_threadpool(self.jobs.ping, timeout)
+                report["jobs"] = {"status": "ok"}
+            except Exception as e:
+                report["jobs"] = {"status": "fail", "message": str(e)}
+        else:
+            report["jobs"] = {"status": "disabled"}
+
+        remaining, reset_in = self.rate_limiter.peek("batch")
+        report["upstream"] = {
+            "providers": self.api.name.split(","),
+            "remaining": remaining,
+            "reset_in": round(reset_in, 3)
+        }
+
+        report["status"] = "ok" if ready else "fail"
+        return ready, report
+
+class BodyStreamingResponse(StreamingResponse):
+    # StreamingResponse listens for disconnects on receive(), which would consume
+    # request body messages that the response generator is still reading
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await self.stream_response(send)
+
+async def handle_rate_limit(request: Request, e: RateLimitExceeded):
+    return Response(
+        content=json.dumps({"status": "fail", "message": "upstream rate limit exceeded, retry later"}),
+        status_code=503,
+        media_type='application/json',
+        headers={"Retry-After": str(math.ceil(e.retry_after))}
+    )
+
+def wants_stream(request: Request) -> bool:
+    if request.query_params.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+
+    return negotiate_stream(request.headers.get("accept"))
+
+def int_param(request: Request, name: str, default: int) -> int:
+    try:
+        return int(request.query_params.get(name, default))
+    except ValueError:
+        return default
+
+def fail_response(message: str, status: int) -> Response:
+    return Response(
+        content=json.dumps({"status": "fail", "message": message}),
+        status_code=status,
+        media_type='application/json'
+    )
+
+def json_response(request: Request, body: str) -> Response:
+    with metrics.time_stage("compress"):
+        body, encoding = request.app.state.encoder.compress(body.encode(), request.headers.get("accept-encoding"))
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    return Response(
+        content=body,
+        status_code=200,
+        media_type='application/json',
+        headers=headers
+    )
+
+async def endpoint_liveness(request: Request):
+    # The process is serving requests, dependencies are left to /readyz
+    return Response(content=json.dumps({"status": "ok"}), status_code=200, media_type='application/json')
+
+async def endpoint_readiness(request: Request):
+    ready, report = await request.app.state.services.status()
+    return Response(content=json.dumps(report), status_code=200 if ready else 503, media_type='application/json')
+
+@metrics.time_request("/json")
+async def endpoint_single(request: Request):
+    resolver = request.app.state.services.resolver
+    encoder = request.app.state.encoder
+    ip_address = request.path_params["ip_address"]
+    fields = request.query_params.get("fields", None)
+    fields = fields.split(",") if fields else COLLECTED_FIELDS
+    skip_cache = request.method == "POST"
+    result = await resolver.query(ip_address, fields, skip_cache)
+    include_fetch_date = True if fields and "fetched_at" in fields else False
+    include_data_source = True if fields and "data_source" in fields else False
+
+    with metrics.time_stage("encode"):
+        body = encoder.encode(result, include_fetch_date, include_data_source)
+
+    return json_response(request, body)
+
+@metrics.time_request("/batch")
+async def endpoint_batch(request: Request):
+    resolver = request.app.state.services.resolver
+    encoder = request.app.state.encoder
+    fields = request.query_params.get("fields", None)
+    fields = fields.split(",") if fields else COLLECTED_FIELDS
+    include_fetch_date = True if fields and "fetched_at" in fields else False
+    include_data_source = True if fields and "data_source" in fields else False
+
+    if wants_stream(request):
+        ip_addresses = aiter_json_array(request.stream())
+        async def generate():
+            async for x in resolver.query_stream(ip_addresses, fields):
+                yield encoder.encode(x, include_fetch_date, include_data_source) + "\n"
+
+        return BodyStreamingResponse(generate(), status_code=200, media_type=NDJSON_MIMETYPE)
+
+    ip_addresses = await request.json()
+    results = await resolver.query(ip_addresses, fields)
+    with metrics.time_stage("encode"):
+        body = encoder.encode_many(results, include_fetch_date, include_data_source)
+
+    return json_response(request, body)
+
+@metrics.time_request("/jobs")
+async def endpoint_job_create(request: Request):
+    jobs = request.app.state.services.jobs
+    if not jobs:
+        return fail_response("jobs require a MongoDB connection", 501)
+
+    fields = request.query_params.get("fields", None)
+    fields = fields.split(",") if fields else COLLECTED_FIELDS
+    # Large lists are read and stored incrementally instead of being parsed in one piece
+    ip_addresses = iter_from_loop(aiter_json_array(request.stream()), asyncio.get_running_loop())
+    try:
+        job = await run_in_threadpool(jobs.create, ip_addresses, fields)
+    except JobTooLarge as e:
+        return fail_response(str(e), 413)
+    except ValueError:
+        return fail_response("request body must be a JSON array", 400)
+
+    response = json_response(request, json.dumps(job, default=str))
+    response.status_code = 202
+    response.headers["Location"] = f"/jobs/{job['id']}"
+    return response
+
+@metrics.time_request("/jobs/<job_id>")
+async def endpoint_job_status(request: Request):
+    jobs = request.app.state.services.jobs
+    job = await run_in_threadpool(jobs.get, request.path_params["job_id"]) if jobs else None
+    if not job:
+        return fail_response("job not found", 404)
+
+    return json_response(request, json.dumps(job, default=str))
+
+@metrics.time_request("/jobs/<job_id>/results")
+async def endpoint_job_results(request: Request):
+    jobs = request.app.state.services.jobs
+    job_id = request.path_params["job_id"]
+    job = await run_in_threadpool(jobs.get, job_id) if jobs else None
+    if not job:
+        return fail_response("job not found", 404)
+
+    offset = max(int_param(request, "offset", 0), 0)
+    if wants_stream(request):
+        # Everything resolved so far from the offset on, a job still running can be read again from where this stopped
+        async def generate():
+            async for x in iterate_in_threadpool(jobs.results(job_id, offset)):
+                yield json.dumps(x) + "\n"
+
+        return StreamingResponse(generate(), status_code=200, media_type=NDJSON_MIMETYPE)
+
+    limit = min(max(int_param(request, "limit", JOB_PAGE_SIZE), 1), JOB_PAGE_SIZE)
+    results = await run_in_threadpool(lambda: list(jobs.results(job_id, offset, limit)))
+    return json_response(request, json.dumps({
+        **job,
+        "offset": offset,
+        "next_offset": offset + len(results),
+        "results": results
+    }, default=str))
+
+def create_app(metrics_server: Optional[tuple[str, int]] = None) -> Starlette:
+    if DS_BACKEND not in ("mongodb", "sqlite"):
+        raise ValueError(f"Unknown storage backend: {DS_BACKEND}")
+
+    # Read-only data is loaded here, everything else waits for the lifespan handler
+    provider_config = load_provider_config(PROVIDERS_FILE) if PROVIDERS_FILE else []
+    offline_db = None
+    if RANGE_DB_PATH:
+        offline_db = RangeDatabase(RANGE_DB_PATH)
+        logger.info(f"Loaded {len(offline_db)} ranges from offline database {RANGE_DB_PATH}")
+
+    services = Services(provider_config, offline_db, metrics_server)
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        await services.start()
+        try:
+            yield
+        finally:
+            await services.close()
+
+    app = Starlette(
+        routes=[
+            Route("/healthz", endpoint_liveness, methods=["GET"]),
+            Route("/readyz", endpoint_readiness, methods=["GET"]),
+            Route("/json/{ip_address}", endpoint_single, methods=["GET", "POST"]),
+            Route("/batch", endpoint_batch, methods=["POST"]),
+            Route("/jobs", endpoint_job_create, methods=["POST"]),
+            Route("/jobs/{job_id}", endpoint_job_status, methods=["GET"]),
+            Route("/jobs/{job_id}/results", endpoint_job_results, methods=["GET"])
+        ],
+        exception_handlers={RateLimitExceeded: handle_rate_limit},
+        lifespan=lifespan
+    )
+    app.state.services = services
+    app.state.encoder = ResponseEncoder(ENCODER_CACHE_SIZE, RESPONSE_COMPRESS_MIN_SIZE)
+    return app
+
+# Served with `uvicorn iptracker.asgi:app`
+app = create_app((APP_HOST, METRICS_PORT))
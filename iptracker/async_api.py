@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, AsyncGenerator, Optional, Self
+import httpx
+from iptracker.api import AsyncProvider, QueryResponse, assemble_batches, dict_to_response, expand_responses, generate_fields, generate_splits, normalize_host, normalize_hosts, plan_batches, read_payload, read_rate_limit, respell_response
+from iptracker.constants import IPAPI_URL, IPAPI_DEFAULT_FIELDS, IPAPI_USER_AGENT, IPAPI_BATCH_SIZE, IPAPI_MAX_RETRIES, IPAPI_MAX_WORKERS, IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+
+if TYPE_CHECKING:
+    from iptracker.metrics import Metrics
+
+class AsyncIPAPI(AsyncProvider):
+    # Request planning, rate-limit headers and payload checks are shared with IPAPI, only the I/O differs
+    def __init__(self, api_url: Optional[str] = None, batch_size: Optional[int] = None, user_agent: Optional[str] = None, rate_limiter: Optional[RateLimiter] = None, max_workers: Optional[int] = None, timeout: Optional[tuple[float, float]] = None, metrics: Optional["Metrics"] = None) -> Self:
+        self._logger = logging.getLogger()
+        self._api_url = (api_url or IPAPI_URL).strip("/")
+        self._batch_size = batch_size or IPAPI_BATCH_SIZE
+        self._user_agent = user_agent or IPAPI_USER_AGENT
+        self._rate_limiter = rate_limiter or RateLimiter()
+        self._max_workers = max_workers or IPAPI_MAX_WORKERS
+        self._metrics = metrics
+        connect_timeout, read_timeout = timeout or (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT)
+        self._semaphore = asyncio.Semaphore(self._max_workers)
+        self._client = httpx.AsyncClient(
+            headers={"User-Agent": self._user_agent},
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=self._max_workers * 4, max_keepalive_connections=self._max_workers * 4)
+        )
+
+    @property
+    def name(self) -> str:
+        return "ip-api"
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self._rate_limiter
+
+    async def close(self):
+        await self._client.aclose()
+
+    async def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
+        fields = generate_fields(fields or IPAPI_DEFAULT_FIELDS)
+        if isinstance(hosts, str):
+            host, host_error = normalize_host(hosts)
+            if host_error:
+                return QueryResponse.fail(hosts, host_error)
+
+            return respell_response(await self.__query_one(host, fields), hosts)
+        elif isinstance(hosts, list):
+            results, positions, batches = plan_batches(hosts, self._batch_size)
+            batch_results = await asyncio.gather(*[self.__query_batch(batch, fields) for batch in batches])
+            return assemble_batches(hosts, results, positions, batches, batch_results)
+        else:
+            raise TypeError("Invalid input type")
+
+    async def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None) -> AsyncGenerator[list[QueryResponse], None]:
+        fields = generate_fields(fields or IPAPI_DEFAULT_FIELDS)
+        invalid, spellings = normalize_hosts(hosts)
+        if invalid:
+            yield invalid
+
+        tasks = [asyncio.create_task(self.__query_batch(batch, fields)) for batch in generate_splits(list(spellings), self._batch_size)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield expand_responses(await task, spellings)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __acquire(self, bucket: str):
+        try:
+            waited = await self._rate_limiter.acquire_async(bucket)
+        except RateLimitExceeded:
+            if self._metrics:
+                self._metrics.submit_rate_limit_exceeded(bucket)
+            raise
+
+        if self._metrics:
+            self._metrics.submit_rate_limit_wait(bucket, waited)
+
+    def __submit_request(self, bucket: str, status: int | str, start_time: float):
+        if self._metrics:
+            self._metrics.submit_upstream_request(bucket, status, time.perf_counter() - start_time)
+
+    async def __request(self, bucket: str, method: str, url: str, **kwargs) -> httpx.Response:
+        for _ in range(IPAPI_MAX_RETRIES + 1):
+            await self.__acquire(bucket)
+            async with self._semaphore:
+                start_time = time.perf_counter()
+                try:
+                    response = await self._client.request(method, url, **kwargs)
+                except Exception:
+                    self.__submit_request(bucket, "error", start_time)
+                    raise
+                self.__submit_request(bucket, response.status_code, start_time)
+
+            wait_time = read_rate_limit(self._rate_limiter, bucket, response)
+            if wait_time is None:
+                return response
+
+        if self._metrics:
+            self._metrics.submit_rate_limit_exceeded(bucket)
+        raise RateLimitExceeded(wait_time)
+
+    async def __query_one(self, host: str, fields: str) -> QueryResponse:
+        self._logger.info("Resolving host %s", host)
+
+        request_url = f"{self._api_url}/json/{host}"
+        response = await self.__request(
+            "json",
+            "GET",
+            request_url,
+            params={"fields": fields}
+        )
+
+        return dict_to_response(read_payload(response))
+
+    async def __query_batch(self, hosts: list[str], fields: str) -> list[QueryResponse]:
+        if len(hosts) > self._batch_size:
+            raise ValueError(f"Invalid batch size: {len(hosts)}, maximum allowed size is {self._batch_size}")
+
+        self._logger.info("Resolving %d hosts", len(hosts))
+        if self._metrics:
+            self._metrics.submit_batch_size("upstream", len(hosts))
+        request_url = f"{self._api_url}/batch"
+        response = await self.__request(
+            "batch",
+            "POST",
+            request_url,
+            params={"fields": fields},
+            headers={"Content-Type": "application/json"},
+            content=json.dumps(hosts)
+        )
+
+        return [dict_to_response(host) for host in read_payload(response)]
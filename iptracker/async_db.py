@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional, Self
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure
+from iptracker.constants import DS_CACHE_EXPIRATION, DS_BULK_CHUNK_SIZE, DS_SIZE_REFRESH_INTERVAL
+from iptracker.db import document_to_hostdata, fields_projection, hostdata_to_update, hosts_schema, ttl_index_update
+from iptracker.host import HostData
+from iptracker.metrics import Metrics
+from iptracker.store import AsyncHostStore
+
+async def run_once(db: AsyncIOMotorDatabase, name: str, version: dict[str, Any], setup: Callable[[], Awaitable[None]]) -> bool:
+    # Same marker as the sync run_once, so either stack skips indexes the other one built
+    meta = db.get_collection("iptracker_meta")
+    if await meta.find_one({"_id": name, **version}):
+        return False
+
+    await setup()
+    await meta.replace_one({"_id": name}, {"_id": name, **version}, upsert=True)
+    return True
+
+class AsyncHostDataStore(AsyncHostStore):
+    def __init__(self, connection: AsyncIOMotorClient | str, cache_expiration_seconds: Optional[int] = None, metrics: Optional[Metrics] = None, bulk_chunk_size: Optional[int] = None, write_behind: bool = False) -> Self:
+        if isinstance(connection, str):
+            self._connection = AsyncIOMotorClient(connection)
+        else:
+            self._connection = connection
+
+        self._logger = logging.getLogger()
+        self._db = self._connection.get_database()
+        self._hosts = self._db.get_collection("hosts")
+        self._metrics = metrics
+        self._cache_expiration = cache_expiration_seconds or DS_CACHE_EXPIRATION
+        self._bulk_chunk_size = bulk_chunk_size or DS_BULK_CHUNK_SIZE
+        self._write_behind = write_behind
+        self._pending_writes: set[asyncio.Task] = set()
+        self._size_updated_at = 0
+
+    @property
+    def expiration(self) -> int:
+        return self._cache_expiration
+
+    async def setup(self):
+        await run_once(self._db, "hosts", hosts_schema(self._cache_expiration), self.__create_indexes)
+        await self.__update_metrics(force=True)
+
+    async def __create_indexes(self):
+        try:
+            await self._hosts.create_index("created_at", expireAfterSeconds=self._cache_expiration)
+        except OperationFailure as e:
+            # IndexOptionsConflict, the expiration time changed since the index was built
+            if e.code != 85:
+                raise
+            await self._db.command("collMod", self._hosts.name, index=ttl_index_update(self._cache_expiration))
+        await self._hosts.create_index("host", unique=True)
+
+    async def ping(self, timeout: Optional[float] = None):
+        await asyncio.wait_for(self._connection.admin.command("ping"), timeout)
+
+    async def size(self) -> int:
+        return await self._hosts.estimated_document_count()
+
+    async def __update_metrics(self, force: bool = False):
+        if not self._metrics:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._size_updated_at < DS_SIZE_REFRESH_INTERVAL:
+            return
+
+        self._size_updated_at = now
+        self._metrics.submit_db_size(await self.size())
+
+    async def server_info(self):
+        return await self._connection.server_info()
+
+    async def close(self):
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+
+    async def get(self, address: str, fields: Optional[list[str]] = None) -> Optional[HostData]:
+        result = await self._hosts.find_one({"host": address}, fields_projection(fields))
+        if not result:
+            return None
+
+        return document_to_hostdata(result)
+
+    async def get_many(self, addresses: list[str], fields: Optional[list[str]] = None) -> dict[str, HostData]:
+        results = {}
+        projection = fields_projection(fields)
+        addresses = list(dict.fromkeys(addresses))
+        for i in range(0, len(addresses), self._bulk_chunk_size):
+            chunk = addresses[i:i + self._bulk_chunk_size]
+            async for result in self._hosts.find({"host": {"$in": chunk}}, projection):
+                results[result["host"]] = document_to_hostdata(result)
+
+        return results
+
+    async def __write_many(self, host_data: list[HostData], refresh: bool = False) -> int:
+        requests = [hostdata_to_update(x, refresh) for x in host_data]
+
+        written = 0
+        for i in range(0, len(requests), self._bulk_chunk_size):
+            result = await self._hosts.bulk_write(requests[i:i + self._bulk_chunk_size], ordered=False)
+            written += result.upserted_count + result.matched_count
+
+        if written:
+            await self.__update_metrics()
+
+        return written
+
+    async def __write_behind(self, host_data: list[HostData]):
+        try:
+            await self.__write_many(host_data)
+        except Exception:
+            self._logger.exception("Failed to flush %d records to local DB", len(host_data))
+
+    async def set_many(self, host_data: list[HostData]) -> int:
+        if not host_data:
+            return 0
+
+        if self._write_behind:
+            # Writes run as tasks on the event loop, close() waits for them to finish
+            task = asyncio.create_task(self.__write_behind(host_data))
+            self._pending_writes.add(task)
+            task.add_done_callback(self._pending_writes.discard)
+            return len(host_data)
+
+        return await self.__write_many(host_data)
+
+    async def refresh_many(self, host_data: list[HostData]) -> int:
+        if not host_data:
+            return 0
+
+        # Pending write-behind tasks hold older records, they have to land before the refresh
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+
+        return await self.__write_many(host_data, refresh=True)
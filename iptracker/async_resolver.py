@@ -0,0 +1,156 @@
+import logging
+from typing import AsyncGenerator, AsyncIterable, Iterable, Optional, Self
+from iptracker.api import AsyncProvider, QueryResponse, normalize_host, respell_response
+from iptracker.batching import AsyncMicroBatcher, AsyncSingleFlight
+from iptracker.cache import HostCache
+from iptracker.constants import IPAPI_DEFAULT_FIELDS, DS_BULK_CHUNK_SIZE
+from iptracker.host import HostData
+from iptracker.metrics import Metrics, time_stage
+from iptracker.prefix import PrefixCache
+from iptracker.rangedb import RangeDatabase
+from iptracker.ratelimit import RateLimitExceeded
+from iptracker.refresh import AsyncRefreshQueue
+from iptracker.resolver import LocalTiers, answer_many, missing_fields, filter_fields, complete_response, group_by_missing
+from iptracker.store import AsyncHostStore
+from iptracker.streaming import aiter_chunks
+
+class AsyncHostResolver:
+    # Same resolution as HostResolver, the shared LocalTiers do everything but the awaited calls
+    def __init__(self, api: AsyncProvider, local_db: Optional[AsyncHostStore] = None, metrics: Optional[Metrics] = None, cache: Optional[HostCache] = None, batcher: Optional[AsyncMicroBatcher] = None, offline_db: Optional[RangeDatabase] = None, prefix_cache: Optional[PrefixCache] = None, refresh_queue: Optional[AsyncRefreshQueue] = None) -> Self:
+        self._remote_api = api
+        self._local_db = local_db
+        self._batcher = batcher
+        self._tiers = LocalTiers(cache, offline_db, prefix_cache, refresh_queue, metrics)
+        self._inflight = AsyncSingleFlight()
+        self._logger = logging.getLogger()
+        self._metrics = metrics
+
+        if refresh_queue:
+            refresh_queue.start(self.__refresh)
+
+    async def query(self, hosts: str | list[str], fields: Optional[list[str]] = None, skip_cache: bool = False) -> QueryResponse | list[QueryResponse]:
+        fields = filter_fields(fields or IPAPI_DEFAULT_FIELDS)
+
+        if isinstance(hosts, str):
+            with time_stage(self._metrics, "validate"):
+                host, host_error = normalize_host(hosts)
+            result = QueryResponse.fail(hosts, host_error) if host_error else respell_response(await self.__query_one(host, fields, skip_cache), hosts)
+        elif isinstance(hosts, list):
+            result = await self.__query_many(hosts, fields, skip_cache)
+        else:
+            raise TypeError("Invalid input type")
+
+        if self._metrics:
+            self._metrics.submit_resolution(result)
+
+        return result
+
+    async def __query_local(self, hosts: list[str], fields: list[str], partials: dict[str, HostData]) -> tuple[list[QueryResponse], list[str]]:
+        results = []
+        hosts = self._tiers.query_before_db(hosts, fields, partials, results)
+        if self._local_db and hosts:
+            with time_stage(self._metrics, "local_db"):
+                if len(hosts) == 1:
+                    db_result = await self._local_db.get(hosts[0], self._tiers.db_fields(hosts[0], fields, partials))
+                    db_results = {hosts[0]: db_result} if db_result else {}
+                else:
+                    db_results = await self._local_db.get_many(hosts, fields)
+                hosts = self._tiers.accept_db(hosts, db_results, fields, partials, results)
+
+        return results, self._tiers.query_after_db(hosts, fields, results)
+
+    async def __store(self, remote_results: list[QueryResponse], partials: dict[str, HostData], refresh: bool = False):
+        resolved = self._tiers.accept_remote(remote_results, partials)
+        if self._local_db and resolved:
+            with time_stage(self._metrics, "local_db_write"):
+                written = await (self._local_db.refresh_many(resolved) if refresh else self._local_db.set_many(resolved))
+            self._tiers.check_written(written, len(resolved))
+
+    async def __refresh(self, hosts: list[str]):
+        self._tiers.check_refresh_budget(self._remote_api.rate_limiter)
+        db_results = await self._local_db.get_many(hosts) if self._local_db else {}
+        with time_stage(self._metrics, "refresh"):
+            for fields, group in self._tiers.refresh_groups(hosts, db_results).items():
+                refreshed = self._tiers.accept_refresh(await self._remote_api.query(group, list(fields)))
+                if self._local_db and refreshed:
+                    await self._local_db.refresh_many(refreshed)
+
+    async def __query_one(self, host: str, fields: list[str], skip_cache: bool) -> QueryResponse:
+        partials = {}
+        if (self._tiers.active or self._local_db) and not skip_cache:
+            local_results, _ = await self.__query_local([host], fields, partials)
+            if local_results:
+                return local_results[0]
+
+        partial = partials.get(host)
+        if skip_cache:
+            stored = await self._local_db.get(host) if self._local_db else None
+            missing = self._tiers.forced_fields(host, fields, {host: stored} if stored else {})
+        else:
+            missing = missing_fields(partial, fields) if partial else fields
+        remote_result = await self._inflight.do((host, tuple(missing), skip_cache), lambda: self.__query_remote_one(host, missing, partial, skip_cache))
+        return complete_response(remote_result, fields, partial)
+
+    async def __query_remote_one(self, host: str, fields: list[str], partial: Optional[HostData], refresh: bool) -> QueryResponse:
+        with time_stage(self._metrics, "upstream"):
+            if self._batcher:
+                remote_result = await self._batcher.query(host, fields)
+            else:
+                remote_result = await self._remote_api.query(host, fields)
+
+        await self.__store([remote_result], {host: partial} if partial else {}, refresh)
+        return remote_result
+
+    async def __query_local_many(self, hosts: list[str], fields: list[str], skip_cache: bool) -> tuple[list[QueryResponse], list[str], dict[str, HostData]]:
+        partials = {}
+        if (self._tiers.active or self._local_db) and not skip_cache:
+            result, queue = await self.__query_local(hosts, fields, partials)
+        else:
+            result, queue = [], hosts
+
+        return result, queue, partials
+
+    async def __upstream_groups(self, hosts: list[str], fields: list[str], partials: dict[str, HostData], skip_cache: bool) -> dict[tuple[str, ...], list[str]]:
+        if not skip_cache:
+            return group_by_missing(hosts, fields, partials)
+
+        db_results = await self._local_db.get_many(hosts) if self._local_db and hosts else {}
+        return self._tiers.forced_groups(hosts, fields, db_results)
+
+    async def __query_many(self, hosts: list[str], fields: list[str], skip_cache: bool) -> list[QueryResponse]:
+        normalized, unique = self._tiers.prepare_many(hosts)
+        local_results, queue, partials = await self.__query_local_many(unique, fields, skip_cache)
+        self._logger.debug(f"Resolved {len(local_results)} queries locally")
+
+        resolved = {x.host: x for x in local_results}
+        for missing, group in (await self.__upstream_groups(queue, fields, partials, skip_cache)).items():
+            with time_stage(self._metrics, "upstream"):
+                remote_results = await self._remote_api.query(group, list(missing))
+            await self.__store(remote_results, partials, skip_cache)
+            resolved.update(zip(group, (complete_response(x, fields, partials.get(x.host)) for x in remote_results)))
+
+        return answer_many(hosts, normalized, resolved)
+
+    async def query_stream(self, hosts: Iterable[str] | AsyncIterable[str], fields: Optional[list[str]] = None, skip_cache: bool = False, chunk_size: Optional[int] = None) -> AsyncGenerator[QueryResponse, None]:
+        fields = filter_fields(fields or IPAPI_DEFAULT_FIELDS)
+
+        async for chunk in aiter_chunks(hosts, chunk_size or DS_BULK_CHUNK_SIZE):
+            invalid, spellings = self._tiers.prepare_chunk(chunk)
+            local_results, queue, partials = await self.__query_local_many(list(spellings), fields, skip_cache)
+            for result in self._tiers.answer_local(invalid, local_results, spellings):
+                yield result
+
+            answered = set()
+            try:
+                for missing, group in (await self.__upstream_groups(queue, fields, partials, skip_cache)).items():
+                    async for remote_results in self._remote_api.query_stream(group, list(missing)):
+                        await self.__store(remote_results, partials, skip_cache)
+                        for result in self._tiers.answer_remote(remote_results, fields, partials, spellings, answered):
+                            yield result
+            except RateLimitExceeded:
+                for result in self._tiers.answer_failed(queue, answered, spellings, "upstream rate limit exceeded"):
+                    yield result
+            except Exception:
+                self._logger.exception("Upstream lookup failed while streaming %d hosts", len(queue) - len(answered))
+                for result in self._tiers.answer_failed(queue, answered, spellings, "upstream error"):
+                    yield result
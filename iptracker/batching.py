@@ -0,0 +1,221 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Hashable, Optional, Self
+from iptracker.api import AsyncProvider, Provider, QueryResponse
+from iptracker.constants import IPAPI_BATCH_SIZE, IPAPI_BATCH_WINDOW
+
+class SingleFlight:
+    def __init__(self) -> Self:
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+        return result
+
+class _PendingBatch:
+    def __init__(self) -> Self:
+        self.futures: dict[str, Future] = {}
+        self.full = threading.Event()
+
+    def add(self, host: str) -> Future:
+        future = self.futures.get(host)
+        if future is None:
+            future = Future()
+            self.futures[host] = future
+
+        return future
+
+    def abandon(self):
+        # Fails whatever the leader did not get to, so no follower waits on it forever
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(RuntimeError("Batch leader stopped before dispatching"))
+
+class MicroBatcher:
+    def __init__(self, api: Provider, window: Optional[float] = None, max_size: Optional[int] = None) -> Self:
+        self._api = api
+        self._window = window if window is not None else IPAPI_BATCH_WINDOW
+        self._max_size = max_size or IPAPI_BATCH_SIZE
+        self._lock = threading.Lock()
+        self._batches: dict[tuple[str, ...], _PendingBatch] = {}
+
+    def query(self, host: str, fields: list[str]) -> QueryResponse:
+        key = tuple(fields)
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = _PendingBatch()
+                self._batches[key] = batch
+
+            future = batch.add(host)
+            if len(batch.futures) >= self._max_size:
+                # Detach the batch so that new arrivals start the next one
+                del self._batches[key]
+                batch.full.set()
+
+        if leader:
+            # The first request of a window collects followers, then dispatches for everyone
+            try:
+                batch.full.wait(self._window)
+                self.__detach(key, batch)
+                self.__dispatch(batch, fields)
+            finally:
+                self.__detach(key, batch)
+                batch.abandon()
+
+        return future.result()
+
+    def __detach(self, key: tuple[str, ...], batch: _PendingBatch):
+        with self._lock:
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+
+    def __dispatch(self, batch: _PendingBatch, fields: list[str]):
+        hosts = list(batch.futures.keys())
+        try:
+            results = self._api.query(hosts, fields)
+        except Exception as e:
+            for future in batch.futures.values():
+                future.set_exception(e)
+            return
+
+        for result in results:
+            future = batch.futures.get(result.host)
+            if future and not future.done():
+                future.set_result(result)
+
+        for host, future in batch.futures.items():
+            if not future.done():
+                future.set_result(QueryResponse.fail(host, "no response"))
+
+class AsyncSingleFlight:
+    def __init__(self) -> Self:
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._calls.get(key)
+        if future is not None:
+            # Shielded so that a cancelled follower does not cancel the shared call
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case there were no followers
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._calls[key]
+
+        return result
+
+class _AsyncPendingBatch:
+    def __init__(self) -> Self:
+        self.futures: dict[str, asyncio.Future] = {}
+        self.full = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, host: str) -> asyncio.Future:
+        future = self.futures.get(host)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.futures[host] = future
+
+        return future
+
+    def abandon(self):
+        for future in self.futures.values():
+            if not future.done():
+                future.set_exception(RuntimeError("Batch task stopped before dispatching"))
+                future.exception()
+
+class AsyncMicroBatcher:
+    def __init__(self, api: AsyncProvider, window: Optional[float] = None, max_size: Optional[int] = None) -> Self:
+        self._api = api
+        self._window = window if window is not None else IPAPI_BATCH_WINDOW
+        self._max_size = max_size or IPAPI_BATCH_SIZE
+        self._batches: dict[tuple[str, ...], _AsyncPendingBatch] = {}
+
+    async def query(self, host: str, fields: list[str]) -> QueryResponse:
+        key = tuple(fields)
+        batch = self._batches.get(key)
+        if batch is None:
+            # Dispatch runs in its own task so that a cancelled request does not strand the batch
+            batch = _AsyncPendingBatch()
+            batch.task = asyncio.create_task(self.__run(key, batch, fields))
+            self._batches[key] = batch
+
+        future = batch.add(host)
+        if len(batch.futures) >= self._max_size:
+            del self._batches[key]
+            batch.full.set()
+
+        return await asyncio.shield(future)
+
+    async def __run(self, key: tuple[str, ...], batch: _AsyncPendingBatch, fields: list[str]):
+        try:
+            await self.__dispatch(key, batch, fields)
+        finally:
+            # Also runs when the task is cancelled, e.g. on shutdown
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+            batch.abandon()
+
+    async def __dispatch(self, key: tuple[str, ...], batch: _AsyncPendingBatch, fields: list[str]):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self._window)
+        except asyncio.TimeoutError:
+            pass
+
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+
+        hosts = list(batch.futures.keys())
+        try:
+            results = await self._api.query(hosts, fields)
+        except Exception as e:
+            for future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(e)
+                    future.exception()
+            return
+
+        for result in results:
+            future = batch.futures.get(result.host)
+            if future and not future.done():
+                future.set_result(result)
+
+        for host, future in batch.futures.items():
+            if not future.done():
+                future.set_result(QueryResponse.fail(host, "no response"))
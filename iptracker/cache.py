@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, Optional, Self
+from iptracker.api import QueryResponse, QueryResult
+from iptracker.constants import MEMORY_CACHE_SIZE, MEMORY_CACHE_EXPIRATION, MEMORY_CACHE_NEGATIVE_EXPIRATION
+from iptracker.host import HostData, HostDataSource
+from iptracker.metrics import Metrics
+
+class LRUCache:
+    def __init__(self, max_size: int, ttl: float, on_evict: Optional[Callable[[str], None]] = None) -> Self:
+        if max_size <= 0:
+            raise ValueError(f"Invalid cache size: {max_size}")
+
+        self._max_size = max_size
+        self._ttl = ttl
+        self._on_evict = on_evict
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __evict(self, reason: str):
+        if self._on_evict:
+            self._on_evict(reason)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.__evict("expired")
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (ttl if ttl is not None else self._ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.__evict("capacity")
+
+    def values(self) -> list[Any]:
+        # Live values, most recently used first
+        now = time.monotonic()
+        with self._lock:
+            return [value for expires_at, value in reversed(self._entries.values()) if expires_at > now]
+
+    def delete(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class HostCache:
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[float] = None, negative_ttl: Optional[float] = None, metrics: Optional[Metrics] = None) -> Self:
+        self._metrics = metrics
+        self._negative_ttl = negative_ttl if negative_ttl is not None else MEMORY_CACHE_NEGATIVE_EXPIRATION
+        self._entries = LRUCache(
+            max_size or MEMORY_CACHE_SIZE,
+            ttl if ttl is not None else MEMORY_CACHE_EXPIRATION,
+            self.__on_evict
+        )
+
+    def __on_evict(self, reason: str):
+        if self._metrics:
+            self._metrics.submit_cache_eviction(reason)
+
+    def __update_metrics(self):
+        if self._metrics:
+            self._metrics.submit_cache_size(len(self._entries))
+
+    def get(self, host: str) -> Optional[QueryResponse]:
+        result = self._entries.get(host)
+        if self._metrics:
+            self._metrics.submit_cache_lookup(result is not None)
+
+        return result
+
+    def set(self, response: QueryResponse):
+        if response.status == QueryResult.Success:
+            data = response.result
+            self._entries.set(response.host, QueryResponse.success(HostData(
+                data.host,
+                data.fetched_at,
+                HostDataSource.Memory,
+                data.fields
+            )))
+        else:
+            if self._negative_ttl <= 0:
+                return
+
+            self._entries.set(response.host, response, self._negative_ttl)
+
+        self.__update_metrics()
+
+    def hot_entries(self) -> list[HostData]:
+        return [x.result for x in self._entries.values() if x.status == QueryResult.Success]
+
+    def preload(self, host_data: Iterable[HostData]) -> int:
+        # Expects the hottest hosts first and inserts them last, so they are the last to be evicted
+        host_data = list(host_data)
+        for x in reversed(host_data):
+            self.set(QueryResponse.success(x))
+
+        return len(host_data)
+
+    def invalidate(self, host: str):
+        if self._entries.delete(host):
+            self.__update_metrics()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+from typing import Optional
+from iptracker.constants import DS_BACKEND, SQLITE_PATH, DEFAULT_APP_HOST, DEFAULT_APP_PORT, DEFAULT_METRICS_PORT, IPAPI_BATCH_SIZE, IPAPI_BATCH_WINDOW, IPAPI_RATE_LIMITS, IPAPI_RATE_LIMIT_MAX_WAIT, IPAPI_MAX_WORKERS, PROVIDER_HEDGE_DELAY, PROVIDER_MAX_WORKERS, IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT, REFRESH_BATCH_SIZE, REFRESH_INTERVAL, REFRESH_QUEUE_SIZE, REFRESH_RATE_LIMIT_RESERVE, JOB_CHUNK_SIZE, JOB_MAX_SIZE, JOB_PAGE_SIZE, JOB_LEASE_TIME, JOB_MAX_ATTEMPTS, JOB_EXPIRATION, JOB_POLL_INTERVAL, JOB_RATE_LIMIT_RESERVE, MEMORY_CACHE_SIZE, MEMORY_CACHE_EXPIRATION, MEMORY_CACHE_NEGATIVE_EXPIRATION, PREFIX_CACHE_IPV4_LENGTH, PREFIX_CACHE_IPV6_LENGTH, PREFIX_CACHE_SIZE, PREFIX_CACHE_EXPIRATION, PREFIX_CACHE_VERIFY_RATE, ENCODER_CACHE_SIZE, RESPONSE_COMPRESS_MIN_SIZE, HEALTH_CHECK_TIMEOUT
+
+def _parse_rate_limits(value: Optional[str], defaults: dict[str, tuple[int, float]]) -> dict[str, tuple[int, float]]:
+    # Overrides per bucket, e.g. "json=45/60,batch=15/60" for 45 requests per 60 seconds
+    limits = {**defaults}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+
+        name, _, limit = item.partition("=")
+        requests, window = limit.split("/")
+        limits[name.strip()] = (int(requests), float(window))
+
+    return limits
+
+DS_BACKEND = os.getenv("DS_BACKEND", DS_BACKEND).lower()
+MONGO_URI = os.getenv("MONGO_URI")
+SQLITE_PATH = os.getenv("SQLITE_PATH", SQLITE_PATH)
+RANGE_DB_PATH = os.getenv("RANGE_DB_PATH")
+CACHE_EXPIRATION_TIME = os.getenv("CACHE_EXPIRATION_TIME")
+CACHE_EXPIRATION_TIME = int(CACHE_EXPIRATION_TIME) if CACHE_EXPIRATION_TIME else None
+CACHE_SOFT_EXPIRATION_TIME = os.getenv("CACHE_SOFT_EXPIRATION_TIME")
+CACHE_SOFT_EXPIRATION_TIME = int(CACHE_SOFT_EXPIRATION_TIME) if CACHE_SOFT_EXPIRATION_TIME else None
+REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", REFRESH_BATCH_SIZE))
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", REFRESH_INTERVAL))
+REFRESH_QUEUE_SIZE = int(os.getenv("REFRESH_QUEUE_SIZE", REFRESH_QUEUE_SIZE))
+REFRESH_RATE_LIMIT_RESERVE = int(os.getenv("REFRESH_RATE_LIMIT_RESERVE", REFRESH_RATE_LIMIT_RESERVE))
+JOB_WORKER = os.getenv("JOB_WORKER", "true").lower() in ("1", "true", "yes")
+JOB_CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", JOB_CHUNK_SIZE))
+JOB_MAX_SIZE = int(os.getenv("JOB_MAX_SIZE", JOB_MAX_SIZE))
+JOB_PAGE_SIZE = int(os.getenv("JOB_PAGE_SIZE", JOB_PAGE_SIZE))
+JOB_LEASE_TIME = float(os.getenv("JOB_LEASE_TIME", JOB_LEASE_TIME))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", JOB_MAX_ATTEMPTS))
+JOB_EXPIRATION = int(os.getenv("JOB_EXPIRATION", JOB_EXPIRATION))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", JOB_POLL_INTERVAL))
+JOB_RATE_LIMIT_RESERVE = int(os.getenv("JOB_RATE_LIMIT_RESERVE", JOB_RATE_LIMIT_RESERVE))
+COLLECTED_FIELDS = os.getenv("COLLECTED_FIELDS")
+COLLECTED_FIELDS = COLLECTED_FIELDS.split(",") if COLLECTED_FIELDS else None
+IPAPI_USER_AGENT = os.getenv("USER_AGENT")
+IPAPI_URL = os.getenv("IPAPI_URL")
+IPAPI_BATCH_SIZE = int(os.getenv("IPAPI_BATCH_SIZE", IPAPI_BATCH_SIZE))
+IPAPI_BATCH_WINDOW = float(os.getenv("IPAPI_BATCH_WINDOW", IPAPI_BATCH_WINDOW))
+IPAPI_RATE_LIMIT_FILE = os.getenv("IPAPI_RATE_LIMIT_FILE", os.path.join(tempfile.gettempdir(), "iptracker-ratelimit"))
+IPAPI_RATE_LIMITS = _parse_rate_limits(os.getenv("IPAPI_RATE_LIMITS"), IPAPI_RATE_LIMITS)
+IPAPI_RATE_LIMIT_MAX_WAIT = float(os.getenv("IPAPI_RATE_LIMIT_MAX_WAIT", IPAPI_RATE_LIMIT_MAX_WAIT))
+IPAPI_MAX_WORKERS = int(os.getenv("IPAPI_MAX_WORKERS", IPAPI_MAX_WORKERS))
+IPAPI_CONNECT_TIMEOUT = float(os.getenv("IPAPI_CONNECT_TIMEOUT", IPAPI_CONNECT_TIMEOUT))
+IPAPI_READ_TIMEOUT = float(os.getenv("IPAPI_READ_TIMEOUT", IPAPI_READ_TIMEOUT))
+PROVIDERS_FILE = os.getenv("PROVIDERS_FILE")
+PROVIDER_HEDGE_DELAY = float(os.getenv("PROVIDER_HEDGE_DELAY", PROVIDER_HEDGE_DELAY))
+PROVIDER_MAX_WORKERS = int(os.getenv("PROVIDER_MAX_WORKERS", PROVIDER_MAX_WORKERS))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", HEALTH_CHECK_TIMEOUT))
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", MEMORY_CACHE_SIZE))
+MEMORY_CACHE_EXPIRATION = float(os.getenv("MEMORY_CACHE_EXPIRATION", MEMORY_CACHE_EXPIRATION))
+MEMORY_CACHE_NEGATIVE_EXPIRATION = float(os.getenv("MEMORY_CACHE_NEGATIVE_EXPIRATION", MEMORY_CACHE_NEGATIVE_EXPIRATION))
+MEMORY_CACHE_SNAPSHOT = os.getenv("MEMORY_CACHE_SNAPSHOT")
+PREFIX_CACHE = os.getenv("PREFIX_CACHE", "false").lower() in ("1", "true", "yes")
+PREFIX_CACHE_IPV4_LENGTH = int(os.getenv("PREFIX_CACHE_IPV4_LENGTH", PREFIX_CACHE_IPV4_LENGTH))
+PREFIX_CACHE_IPV6_LENGTH = int(os.getenv("PREFIX_CACHE_IPV6_LENGTH", PREFIX_CACHE_IPV6_LENGTH))
+PREFIX_CACHE_FIELDS = os.getenv("PREFIX_CACHE_FIELDS")
+PREFIX_CACHE_FIELDS = PREFIX_CACHE_FIELDS.split(",") if PREFIX_CACHE_FIELDS else None
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", PREFIX_CACHE_SIZE))
+PREFIX_CACHE_EXPIRATION = float(os.getenv("PREFIX_CACHE_EXPIRATION", PREFIX_CACHE_EXPIRATION))
+PREFIX_CACHE_VERIFY_RATE = float(os.getenv("PREFIX_CACHE_VERIFY_RATE", PREFIX_CACHE_VERIFY_RATE))
+ENCODER_CACHE_SIZE = int(os.getenv("ENCODER_CACHE_SIZE", ENCODER_CACHE_SIZE))
+RESPONSE_COMPRESS_MIN_SIZE = int(os.getenv("RESPONSE_COMPRESS_MIN_SIZE", RESPONSE_COMPRESS_MIN_SIZE))
+
+APP_HOST = os.getenv("APP_HOST", DEFAULT_APP_HOST)
+APP_PORT = int(os.getenv("APP_PORT", DEFAULT_APP_PORT))
+METRICS_PORT = int(os.getenv("METRICS_PORT", DEFAULT_METRICS_PORT))
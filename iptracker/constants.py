@@ -1,9 +1,63 @@
 __version__ = "0.1.0"
 
 DS_CACHE_EXPIRATION = 2592000
+DS_BULK_CHUNK_SIZE = 1000
+DS_WRITE_BATCH_SIZE = 500
+DS_WRITE_FLUSH_INTERVAL = 1.0
+DS_WRITE_QUEUE_SIZE = 10000
+DS_SIZE_REFRESH_INTERVAL = 30
+DS_SCHEMA_VERSION = 1
+DS_SETUP_RETRY_INTERVAL = 10.0
+DS_BACKEND = "mongodb"
+SQLITE_PATH = "iptracker.sqlite3"
+SQLITE_BULK_CHUNK_SIZE = 500
+SQLITE_BUSY_TIMEOUT = 10.0
+SQLITE_PURGE_INTERVAL = 300
+SNAPSHOT_BATCH_SIZE = 5000
+SNAPSHOT_COMPRESS_LEVEL = 3
+REFRESH_BATCH_SIZE = 100
+REFRESH_INTERVAL = 5.0
+REFRESH_QUEUE_SIZE = 10000
+REFRESH_RATE_LIMIT_RESERVE = 5
+JOB_CHUNK_SIZE = 1000
+JOB_MAX_SIZE = 1000000
+JOB_PAGE_SIZE = 1000
+JOB_LEASE_TIME = 300
+JOB_MAX_ATTEMPTS = 5
+JOB_EXPIRATION = 604800
+JOB_POLL_INTERVAL = 1.0
+JOB_RATE_LIMIT_RESERVE = 5
+MEMORY_CACHE_SIZE = 10000
+MEMORY_CACHE_EXPIRATION = 300
+MEMORY_CACHE_NEGATIVE_EXPIRATION = 60
+PREFIX_CACHE_IPV4_LENGTH = 24
+PREFIX_CACHE_IPV6_LENGTH = 48
+PREFIX_CACHE_FIELDS = ["country", "countryCode", "timezone", "isp", "org", "as"]
+PREFIX_CACHE_SIZE = 100000
+PREFIX_CACHE_EXPIRATION = 86400
+PREFIX_CACHE_VERIFY_RATE = 0.05
 IPAPI_URL = "http://ip-api.com"
 IPAPI_BATCH_SIZE = 100
+IPAPI_BATCH_WINDOW = 0.0
+IPAPI_MAX_RETRIES = 3
+IPAPI_MAX_WORKERS = 4
+IPAPI_CONNECT_TIMEOUT = 5
+IPAPI_READ_TIMEOUT = 30
+# Bucket name: (requests per window, window length in seconds)
+IPAPI_RATE_LIMITS = {
+    "json": (45, 60),
+    "batch": (15, 60)
+}
+IPAPI_RATE_LIMIT_MAX_WAIT = 30
+PROVIDER_HEDGE_DELAY = 0.0
+PROVIDER_MAX_WORKERS = 32
+PROVIDER_STREAM_CHUNK_SIZE = 400
+HOST_PARSE_CACHE_SIZE = 65536
+HOSTDATA_SCHEMA_CACHE_SIZE = 4096
+HOSTDATA_PROJECTION_CACHE_SIZE = 256
 IPAPI_SYSTEM_FIELDS = ["status", "message", "query"]
+# Fields that describe the record itself and are never requested upstream
+META_FIELDS = ["fetched_at", "data_source"]
 IPAPI_DEFAULT_FIELDS = [
     "country", "countryCode", "region", 
     "regionName", "city", "zip", "lat", "lon", "timezone",
@@ -11,6 +65,17 @@ IPAPI_DEFAULT_FIELDS = [
 ]
 IPAPI_USER_AGENT = f"iptracker/{__version__}"
 
+STREAM_READ_SIZE = 65536
+NDJSON_MIMETYPE = "application/x-ndjson"
+HEALTH_CHECK_TIMEOUT = 2.0
+ENCODER_CACHE_SIZE = 65536
+RESPONSE_COMPRESS_MIN_SIZE = 4096
+RESPONSE_COMPRESS_LEVEL = 6
+
+# Stages range from microsecond cache lookups to upstream calls waiting on the rate limit
+METRICS_STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
 DEFAULT_APP_HOST = "0.0.0.0"
 DEFAULT_APP_PORT = 8080
 DEFAULT_METRICS_PORT = 9090
\ No newline at end of file
@@ -1,11 +1,73 @@
-from typing import Optional
-from pymongo import MongoClient
-from iptracker.constants import DS_CACHE_EXPIRATION
+import datetime
+import time
+from typing import Any, Callable, Iterator, Optional
+import pymongo
+from pymongo import MongoClient, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, OperationFailure
+from iptracker.constants import DS_CACHE_EXPIRATION, DS_BULK_CHUNK_SIZE, DS_SIZE_REFRESH_INTERVAL, DS_SCHEMA_VERSION
 from iptracker.host import HostData, HostDataSource
 from iptracker.metrics import Metrics
+from iptracker.store import HostStore
+from iptracker.writer import HostDataWriter
 
-class HostDataStore:
-    def __init__(self, connection: MongoClient | str, cache_expiration_seconds: Optional[int] = None, metrics: Optional[Metrics] = None):        
+def document_to_hostdata(document: dict) -> HostData:
+    host = document["host"]
+    date = document["created_at"]
+    fields = document.get("fields", {})
+    
+    # MongoDB stores UTC but returns naive datetimes unless the client is tz_aware
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.UTC)
+    
+    return HostData(host, date, HostDataSource.Local, fields)
+
+def fields_projection(fields: Optional[list[str]]) -> dict[str, int]:
+    if fields is None:
+        return { "_id": 0 }
+    
+    projection = { "_id": 0, "host": 1, "created_at": 1 }
+    for field in fields:
+        # Names that would be read as a path or an operator cannot exist in stored documents
+        if "." in field or field.startswith("$"):
+            continue
+        projection[f"fields.{field}"] = 1
+    
+    return projection
+
+def hostdata_to_update(host_data: HostData, refresh: bool = False) -> UpdateOne:
+    # Fields are merged one by one so records fetched with different field sets add up,
+    # and created_at tracks the oldest field so none outlives the expiration time.
+    # A refresh, in the background or forced by a POST, re-fetches every stored field,
+    # so the whole record becomes fresh.
+    update = {"$set" if refresh else "$min": {"created_at": host_data.fetched_at}}
+    if host_data.fields and refresh:
+        update["$set"].update({f"fields.{k}": v for k,v in host_data.fields.items()})
+    elif host_data.fields:
+        update["$set"] = {f"fields.{k}": v for k,v in host_data.fields.items()}
+    
+    return UpdateOne({"host": host_data.host}, update, upsert=True)
+
+def hosts_schema(expiration: int) -> dict[str, Any]:
+    # The marker run_once compares, indexes are checked again when either value changes
+    return {"version": DS_SCHEMA_VERSION, "expiration": expiration}
+
+def ttl_index_update(expiration: int) -> dict[str, Any]:
+    # collMod argument that changes the expiration of the existing TTL index in place
+    return {"keyPattern": {"created_at": 1}, "expireAfterSeconds": expiration}
+
+def run_once(db: Database, name: str, version: dict[str, Any], setup: Callable[[], None]) -> bool:
+    # Index builds run once per deployment and settings, later processes only read the marker
+    meta = db.get_collection("iptracker_meta")
+    if meta.find_one({"_id": name, **version}):
+        return False
+    
+    setup()
+    meta.replace_one({"_id": name}, {"_id": name, **version}, upsert=True)
+    return True
+
+class HostDataStore(HostStore):
+    def __init__(self, connection: MongoClient | str, cache_expiration_seconds: Optional[int] = None, metrics: Optional[Metrics] = None, bulk_chunk_size: Optional[int] = None, write_behind: bool = False, write_batch_size: Optional[int] = None, write_flush_interval: Optional[float] = None, defer_setup: bool = False):
         if isinstance(connection, str):
             self._connection = MongoClient(connection)
         else:
@@ -17,47 +79,152 @@ class HostDataStore:
         self._db = db
         self._hosts = hosts
         self._metrics = metrics
+        self._bulk_chunk_size = bulk_chunk_size or DS_BULK_CHUNK_SIZE
+        self._expiration = cache_expiration_seconds or DS_CACHE_EXPIRATION
+        self._size_updated_at = 0
+        self._writer = None
         
-        hosts.create_index("created_at", expireAfterSeconds=cache_expiration_seconds or DS_CACHE_EXPIRATION)
-        hosts.create_index("host", unique=True)
-        self.__update_metrics()
+        # The client connects in the background, nothing here waits for the server
+        if not defer_setup:
+            self.setup()
         
-    def __update_metrics(self):
+        if write_behind:
+            self._writer = HostDataWriter(
+                self.__write_many,
+                write_batch_size,
+                write_flush_interval,
+                on_idle=self.__update_metrics
+            )
+        
+    def __update_metrics(self, force: bool = False):
         if not self._metrics:
             return
         
-        db_size = self._hosts.count_documents({})
-        self._metrics.submit_db_size(db_size)
+        # estimated_document_count reads collection metadata instead of scanning,
+        # and is refreshed at most once per interval
+        now = time.monotonic()
+        if not force and now - self._size_updated_at < DS_SIZE_REFRESH_INTERVAL:
+            return
+        
+        self._size_updated_at = now
+        self._metrics.submit_db_size(self.size())
             
+    def setup(self):
+        run_once(self._db, "hosts", hosts_schema(self._expiration), self.__create_indexes)
+        self.__update_metrics(force=True)
+    
+    def __create_indexes(self):
+        try:
+            self._hosts.create_index("created_at", expireAfterSeconds=self._expiration)
+        except OperationFailure as e:
+            # IndexOptionsConflict, the expiration time changed since the index was built
+            if e.code != 85:
+                raise
+            self._db.command("collMod", self._hosts.name, index=ttl_index_update(self._expiration))
+        self._hosts.create_index("host", unique=True)
+    
+    def ping(self, timeout: Optional[float] = None):
+        with pymongo.timeout(timeout):
+            self._connection.admin.command("ping")
+    
     def server_info(self):
         return self._connection.server_info()
     
-    def get(self, address: str) -> Optional[HostData]:
-        result = self._hosts.find_one({"host": address}, { "_id": 0 })
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        if self._writer:
+            return self._writer.flush(timeout)
+        
+        return True
+    
+    def close(self, timeout: Optional[float] = None):
+        if self._writer:
+            self._writer.close(timeout)
+    
+    def size(self) -> int:
+        return self._hosts.estimated_document_count()
+    
+    @property
+    def expiration(self) -> int:
+        return self._expiration
+    
+    def scan(self) -> Iterator[HostData]:
+        # The TTL monitor only runs once a minute, so expired documents may still be around
+        cutoff = datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=self._expiration)
+        for document in self._hosts.find({"created_at": {"$gte": cutoff}}, {"_id": 0}, batch_size=self._bulk_chunk_size):
+            yield document_to_hostdata(document)
+    
+    def import_many(self, host_data: list[HostData]) -> int:
+        # Plain inserts are much faster than upserts on an empty collection. Hosts that
+        # already exist fail on the unique index and are merged with a regular write instead.
+        documents = [{"host": x.host, "created_at": x.fetched_at, "fields": dict(x.fields)} for x in host_data]
+        if not documents:
+            return 0
+        
+        try:
+            inserted = len(self._hosts.insert_many(documents, ordered=False).inserted_ids)
+            existing = []
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(x["code"] != 11000 for x in errors):
+                raise
+            
+            inserted = e.details["nInserted"]
+            existing = [host_data[x["index"]] for x in errors]
+        
+        written = inserted + (self.__write_many(existing) if existing else 0)
+        self.__update_metrics()
+        return written
+    
+    def get(self, address: str, fields: Optional[list[str]] = None) -> Optional[HostData]:
+        result = self._hosts.find_one({"host": address}, fields_projection(fields))
         if not result:
             return None
         
-        host = result["host"]
-        date = result["created_at"]
-        fields = result["fields"]
-        
-        return HostData(host, date, HostDataSource.Local, fields)
+        return document_to_hostdata(result)
+    
+    def get_many(self, addresses: list[str], fields: Optional[list[str]] = None) -> dict[str, HostData]:
+        results = {}
+        projection = fields_projection(fields)
+        addresses = list(dict.fromkeys(addresses))
+        for i in range(0, len(addresses), self._bulk_chunk_size):
+            chunk = addresses[i:i + self._bulk_chunk_size]
+            for result in self._hosts.find({"host": {"$in": chunk}}, projection):
+                results[result["host"]] = document_to_hostdata(result)
+                
+        return results
     
-    def set(self, host_data: HostData) -> bool:
-        obj = {
-            "host": host_data.host,
-            "created_at": host_data.fetched_at,
-            "fields": host_data.fields
-        }
+    def __write_many(self, host_data: list[HostData], refresh: bool = False) -> int:
+        requests = [hostdata_to_update(x, refresh) for x in host_data]
         
-        result = self._hosts.update_one(
-            {"host": host_data.host},
-            {"$set": obj},
-            upsert=True
-        )
+        written = 0
+        for i in range(0, len(requests), self._bulk_chunk_size):
+            result = self._hosts.bulk_write(requests[i:i + self._bulk_chunk_size], ordered=False)
+            written += result.upserted_count + result.matched_count
         
-        result = result.upserted_id is not None or result.modified_count == 1
-        if result:
+        if written:
             self.__update_metrics()
             
-        return result
\ No newline at end of file
+        return written
+    
+    def set_many(self, host_data: list[HostData]) -> int:
+        if not host_data:
+            return 0
+        
+        if self._writer:
+            for x in host_data:
+                self._writer.submit(x)
+            return len(host_data)
+        
+        return self.__write_many(host_data)
+    
+    def refresh_many(self, host_data: list[HostData]) -> int:
+        if not host_data:
+            return 0
+        
+        # Queued writes for the same hosts are older, writing around them would let them undo the refresh
+        if self._writer:
+            for x in host_data:
+                self._writer.submit(x, refresh=True)
+            return len(host_data)
+        
+        return self.__write_many(host_data, refresh=True)
@@ -0,0 +1,81 @@
+import gzip
+import json
+import zlib
+from functools import lru_cache
+from typing import Iterable, Optional, Self
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from iptracker.api import QueryResponse, QueryResult
+from iptracker.host import HostFields
+from iptracker.constants import ENCODER_CACHE_SIZE, NDJSON_MIMETYPE, RESPONSE_COMPRESS_MIN_SIZE, RESPONSE_COMPRESS_LEVEL
+
+# Same output as json.dumps(..., default=str), without the per-call encoder setup
+_encode = json.JSONEncoder(default=str).encode
+_ENCODINGS = ("gzip", "deflate")
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    qualities = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.partition(";")
+        params = params.strip()
+        try:
+            qualities[name.strip().lower()] = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            continue
+
+    # An explicit entry overrides the wildcard, ties go to the first of _ENCODINGS
+    wildcard = qualities.get("*", 0.0)
+    best = max(_ENCODINGS, key=lambda x: qualities.get(x, wildcard))
+    return best if qualities.get(best, wildcard) > 0 else None
+
+def negotiate_stream(accept: Optional[str]) -> bool:
+    # Flask's request.accept_mimetypes, so both stacks pick the same format for the same header
+    return parse_accept_header(accept, MIMEAccept).best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+class ResponseEncoder:
+    def __init__(self, cache_size: Optional[int] = None, compress_min_size: Optional[int] = None, compress_level: Optional[int] = None) -> Self:
+        self._compress_min_size = compress_min_size if compress_min_size is not None else RESPONSE_COMPRESS_MIN_SIZE
+        self._compress_level = compress_level or RESPONSE_COMPRESS_LEVEL
+        self.__fields = lru_cache(maxsize=cache_size or ENCODER_CACHE_SIZE)(self.__encode_fields)
+
+    def __encode_fields(self, names: tuple[str, ...], row: tuple) -> str:
+        return _encode(dict(zip(names, row)))[1:-1]
+
+    def __fragment(self, fields: HostFields) -> str:
+        # Hot records are encoded once per field set and value combination. Values of a
+        # field always have the same type, so equal keys also mean equal JSON.
+        try:
+            return self.__fields(fields.names, fields.row)
+        except TypeError:
+            return _encode(dict(fields))[1:-1]
+
+    def encode(self, response: QueryResponse, include_fetch_date: bool, include_data_source: bool) -> str:
+        if response.status != QueryResult.Success:
+            return f'{{"query": {_encode(response.host)}, "status": "fail", "message": {_encode(response.error_message)}}}'
+
+        data = response.result
+        parts = [f'{{"query": {_encode(response.host)}, "status": "success"']
+        fields = self.__fragment(data.fields)
+        if fields:
+            parts.append(fields)
+        if include_fetch_date:
+            parts.append(f'"fetched_at": {_encode(str(data.fetched_at))}')
+        if include_data_source:
+            parts.append(f'"data_source": {_encode(str(data.source))}')
+
+        return ", ".join(parts) + "}"
+
+    def encode_many(self, responses: Iterable[QueryResponse], include_fetch_date: bool, include_data_source: bool) -> str:
+        return "[" + ", ".join(self.encode(x, include_fetch_date, include_data_source) for x in responses) + "]"
+
+    def compress(self, body: bytes, accept_encoding: Optional[str]) -> tuple[bytes, Optional[str]]:
+        if self._compress_min_size <= 0 or len(body) < self._compress_min_size:
+            return body, None
+
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding == "gzip":
+            return gzip.compress(body, self._compress_level), encoding
+        if encoding == "deflate":
+            return zlib.compress(body, self._compress_level), encoding
+
+        return body, None
@@ -0,0 +1,37 @@
+import glob
+import os
+from iptracker.config import APP_HOST, METRICS_PORT
+from iptracker.metrics import mark_process_dead, multiprocess_enabled, start_multiprocess_server
+
+# Used with gunicorn -c python:iptracker.gunicorn_conf. With PROMETHEUS_MULTIPROC_DIR set,
+# workers write their metrics to that directory and the master serves the aggregate.
+# With --preload the app is built once in the master, workers only open their own connections.
+
+# A preloading master builds the app, and with it the collectors, before on_starting runs
+if multiprocess_enabled():
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+def on_starting(server):
+    if not multiprocess_enabled():
+        return
+
+    # Files left behind by a previous run would be counted again
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    for file in glob.glob(os.path.join(path, "*.db")):
+        os.remove(file)
+
+def when_ready(server):
+    if not multiprocess_enabled():
+        return
+
+    # The only place the multiprocess server is started, workers leave it to the master
+    start_multiprocess_server(METRICS_PORT, APP_HOST)
+
+def post_worker_init(worker):
+    # Connects before the first request instead of during it
+    services = getattr(worker.wsgi, "extensions", {}).get("iptracker")
+    if services:
+        services.get()
+
+def child_exit(server, worker):
+    mark_process_dead(worker.pid)
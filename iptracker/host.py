@@ -1,47 +1,167 @@
+from collections.abc import Mapping
 from datetime import datetime
 from enum import Enum
-from typing import Any
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Callable, Iterable, Iterator, Self
+from iptracker.constants import HOSTDATA_SCHEMA_CACHE_SIZE, HOSTDATA_PROJECTION_CACHE_SIZE
 
 class HostDataSource(Enum):
     Local = 0
     Remote = 1
+    Memory = 2
+    Offline = 3
+    Prefix = 4
     
     def __str__(self) -> str:
         if self == HostDataSource.Local:
             return "local"
         elif self == HostDataSource.Remote:
             return "remote"
+        elif self == HostDataSource.Memory:
+            return "memory"
+        elif self == HostDataSource.Offline:
+            return "offline"
+        elif self == HostDataSource.Prefix:
+            return "prefix"
         else:
             raise NotImplementedError()
 
+def _row_getter(indices: list[int]) -> Callable[[tuple], tuple]:
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda row: (row[index],)
+    if not indices:
+        return lambda row: ()
+    
+    return itemgetter(*indices)
+
+class FieldSchema:
+    # Key layout shared by every record with the same fields in the same order
+    __slots__ = ("_names", "_index", "_projections")
+    
+    def __init__(self, names: tuple[str, ...]) -> Self:
+        self._names = names
+        self._index = {x: i for i, x in enumerate(names)}
+        self._projections: dict[tuple[str, ...], tuple["FieldSchema", Callable[[tuple], tuple]]] = {}
+        
+    @property
+    def names(self) -> tuple[str, ...]:
+        return self._names
+    
+    def position(self, name: str) -> int:
+        return self._index[name]
+    
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+    
+    def project(self, fields: Iterable[str]) -> tuple["FieldSchema", Callable[[tuple], tuple]]:
+        # Picks the requested fields out of a row, keeping the stored order
+        key = tuple(fields)
+        projection = self._projections.get(key)
+        if projection is None:
+            wanted = set(key)
+            names = tuple(x for x in self._names if x in wanted)
+            projection = (field_schema(names), _row_getter([self._index[x] for x in names]))
+            if len(self._projections) < HOSTDATA_PROJECTION_CACHE_SIZE:
+                self._projections[key] = projection
+        
+        return projection
+    
+@lru_cache(maxsize=HOSTDATA_SCHEMA_CACHE_SIZE)
+def field_schema(names: tuple[str, ...]) -> FieldSchema:
+    return FieldSchema(names)
+
+class HostFields(Mapping):
+    # Read-only view over a row of values, records never own a dict of their own
+    __slots__ = ("_schema", "_row")
+    
+    def __init__(self, schema: FieldSchema, row: tuple) -> Self:
+        self._schema = schema
+        self._row = row
+        
+    @staticmethod
+    def from_mapping(fields: Mapping[str, Any]) -> "HostFields":
+        if isinstance(fields, HostFields):
+            return fields
+        
+        return HostFields(field_schema(tuple(fields)), tuple(fields.values()))
+    
+    @property
+    def schema(self) -> FieldSchema:
+        return self._schema
+    
+    @property
+    def names(self) -> tuple[str, ...]:
+        return self._schema.names
+    
+    @property
+    def row(self) -> tuple:
+        return self._row
+    
+    def __getitem__(self, field: str) -> Any:
+        return self._row[self._schema.position(field)]
+    
+    def __contains__(self, field: object) -> bool:
+        return field in self._schema
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._schema.names)
+    
+    def __len__(self) -> int:
+        return len(self._row)
+    
+    def __repr__(self) -> str:
+        return f"HostFields({dict(self)!r})"
+    
+    def select(self, fields: Iterable[str]) -> "HostFields":
+        schema, getter = self._schema.project(fields)
+        if schema is self._schema:
+            return self
+        
+        return HostFields(schema, getter(self._row))
+
 class HostData:
-    def __init__(self, host: str, fetch_date: datetime, source: HostDataSource, fields: dict[str, Any]) -> None:
+    __slots__ = ("_host", "_source", "_date", "_fields")
+    
+    def __init__(self, host: str, fetch_date: datetime, source: HostDataSource, fields: Mapping[str, Any]) -> Self:
         self._host = host
         self._source = source
         self._date = fetch_date
-        self._fields = fields
+        self._fields = HostFields.from_mapping(fields)
         
     @property
-    def host(self):
+    def host(self) -> str:
         return self._host
     
     @property
-    def source(self):
+    def source(self) -> HostDataSource:
         return self._source
     
     @property
-    def fetched_at(self):
+    def fetched_at(self) -> datetime:
         return self._date
     
     @property
-    def fields(self):
+    def fields(self) -> HostFields:
         return self._fields
         
     def __getitem__(self, field: str):
         return self._fields[field]
     
     def __setitem__(self, field: str, value: Any):
-        self._fields[field] = value
+        self._fields = HostFields.from_mapping({**self._fields, field: value})
         
     def __delitem__(self, field: str):
-        del self._fields[field]
\ No newline at end of file
+        fields = dict(self._fields)
+        del fields[field]
+        self._fields = HostFields.from_mapping(fields)
+        
+def merge_hostdata(base: HostData, update: HostData) -> HostData:
+    # A merged record is only as fresh as its oldest part
+    return HostData(
+        update.host,
+        min(base.fetched_at, update.fetched_at),
+        update.source,
+        {**base.fields, **update.fields}
+    )
@@ -0,0 +1,278 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+import uuid
+from enum import Enum
+from typing import Any, Generator, Iterable, Optional, Self
+import pymongo
+from pymongo import ASCENDING, MongoClient, ReturnDocument
+from iptracker.api import QueryResponse, response_to_dict
+from iptracker.db import run_once
+from iptracker.constants import JOB_CHUNK_SIZE, JOB_MAX_SIZE, JOB_LEASE_TIME, JOB_MAX_ATTEMPTS, JOB_EXPIRATION, JOB_POLL_INTERVAL, JOB_RATE_LIMIT_RESERVE
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+from iptracker.resolver import HostResolver
+from iptracker.streaming import iter_chunks
+
+class JobStatus(Enum):
+    Submitting = "submitting"
+    Pending = "pending"
+    Running = "running"
+    Done = "done"
+
+    def __str__(self) -> str:
+        return self.value
+
+class JobTooLarge(Exception):
+    def __init__(self, max_size: int) -> Self:
+        super().__init__(f"Job exceeds the maximum of {max_size} hosts")
+        self.max_size = max_size
+
+def _as_utc(date: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    # MongoDB stores UTC but returns naive datetimes unless the client is tz_aware
+    if date and date.tzinfo is None:
+        return date.replace(tzinfo=datetime.UTC)
+
+    return date
+
+def job_to_dict(job: dict) -> dict[str, Any]:
+    return {
+        "id": job["_id"],
+        "status": job["status"],
+        "total": job["total"],
+        "processed": job["processed"],
+        "created_at": _as_utc(job["created_at"]),
+        "finished_at": _as_utc(job.get("finished_at"))
+    }
+
+class JobStore:
+    def __init__(self, connection: MongoClient | str, chunk_size: Optional[int] = None, max_size: Optional[int] = None, lease_time: Optional[float] = None, expiration: Optional[int] = None, defer_setup: bool = False, max_attempts: Optional[int] = None) -> Self:
+        if isinstance(connection, str):
+            connection = MongoClient(connection)
+
+        db = connection.get_database()
+        self._jobs = db.get_collection("jobs")
+        self._items = db.get_collection("job_items")
+        self._chunk_size = chunk_size or JOB_CHUNK_SIZE
+        self._max_size = max_size or JOB_MAX_SIZE
+        self._lease_time = datetime.timedelta(seconds=lease_time or JOB_LEASE_TIME)
+        self._max_attempts = max_attempts or JOB_MAX_ATTEMPTS
+        self._connection = connection
+        self._db = db
+        self._expiration = expiration or JOB_EXPIRATION
+        if not defer_setup:
+            self.setup()
+
+    @property
+    def max_attempts(self) -> int:
+        return self._max_attempts
+
+    def setup(self):
+        run_once(self._db, "jobs", {"version": 1, "expiration": self._expiration}, self.__create_indexes)
+
+    def __create_indexes(self):
+        # Jobs and their items expire together, counted from submission
+        self._jobs.create_index("created_at", expireAfterSeconds=self._expiration)
+        self._items.create_index("created_at", expireAfterSeconds=self._expiration)
+        self._items.create_index([("job_id", ASCENDING), ("chunk", ASCENDING)], unique=True)
+        self._items.create_index([("ready", ASCENDING), ("done", ASCENDING), ("lease_expires_at", ASCENDING)])
+
+    def ping(self, timeout: Optional[float] = None):
+        with pymongo.timeout(timeout):
+            self._connection.admin.command("ping")
+
+    def create(self, hosts: Iterable[Any], fields: Optional[list[str]] = None) -> dict[str, Any]:
+        # Hosts are written chunk by chunk as they are read, so the list never has to fit in memory.
+        # Chunks only become claimable once the whole list is stored.
+        now = datetime.datetime.now(datetime.UTC)
+        job_id = uuid.uuid4().hex
+        job = {"_id": job_id, "status": str(JobStatus.Submitting), "fields": fields, "chunk_size": self._chunk_size, "total": 0, "processed": 0, "created_at": now}
+        self._jobs.insert_one(job)
+
+        total = 0
+        try:
+            for i, chunk in enumerate(iter_chunks(hosts, self._chunk_size)):
+                total += len(chunk)
+                if total > self._max_size:
+                    raise JobTooLarge(self._max_size)
+
+                self._items.insert_one({"job_id": job_id, "chunk": i, "hosts": chunk, "count": len(chunk), "ready": False, "done": False, "lease_expires_at": None, "created_at": now})
+        except Exception:
+            self.delete(job_id)
+            raise
+
+        status = JobStatus.Pending if total else JobStatus.Done
+        job = self._jobs.find_one_and_update(
+            {"_id": job_id},
+            {"$set": {"status": str(status), "total": total, **({"finished_at": now} if not total else {})}},
+            return_document=ReturnDocument.AFTER
+        )
+        self._items.update_many({"job_id": job_id}, {"$set": {"ready": True}})
+        return job_to_dict(job)
+
+    def delete(self, job_id: str):
+        self._items.delete_many({"job_id": job_id})
+        self._jobs.delete_one({"_id": job_id})
+
+    def get(self, job_id: str) -> Optional[dict[str, Any]]:
+        job = self._jobs.find_one({"_id": job_id})
+        return job_to_dict(job) if job else None
+
+    def claim(self, owner: str) -> Optional[tuple[dict, dict]]:
+        # A lease that was not completed in time belongs to a worker that died, so its chunk is handed out again.
+        # Every claim counts as an attempt, the runner gives up on chunks that keep failing.
+        now = datetime.datetime.now(datetime.UTC)
+        item = self._items.find_one_and_update(
+            {"ready": True, "done": False, "$or": [{"lease_expires_at": None}, {"lease_expires_at": {"$lt": now}}]},
+            {"$set": {"lease_owner": owner, "lease_expires_at": now + self._lease_time}, "$inc": {"attempts": 1}},
+            sort=[("created_at", ASCENDING), ("chunk", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if not item:
+            return None
+
+        job = self._jobs.find_one_and_update(
+            {"_id": item["job_id"], "status": str(JobStatus.Pending)},
+            {"$set": {"status": str(JobStatus.Running)}},
+            return_document=ReturnDocument.AFTER
+        ) or self._jobs.find_one({"_id": item["job_id"]})
+        if not job:
+            # The job expired while the chunk was waiting
+            self._items.delete_one({"_id": item["_id"]})
+            return None
+
+        return job, item
+
+    def release(self, item: dict, owner: str):
+        # Handing a chunk back, e.g. on an exhausted rate limit, is not a failed attempt
+        self._items.update_one({"_id": item["_id"], "lease_owner": owner}, {"$set": {"lease_expires_at": None}, "$inc": {"attempts": -1}})
+
+    def complete(self, item: dict, owner: str, results: list[dict[str, Any]]) -> bool:
+        # Only the current lease holder may complete a chunk, so progress is counted exactly once
+        updated = self._items.update_one(
+            {"_id": item["_id"], "lease_owner": owner, "done": False},
+            {"$set": {"done": True, "results": results, "lease_expires_at": None}, "$unset": {"hosts": ""}}
+        )
+        if not updated.modified_count:
+            return False
+
+        job = self._jobs.find_one_and_update(
+            {"_id": item["job_id"]},
+            {"$inc": {"processed": item["count"]}},
+            return_document=ReturnDocument.AFTER
+        )
+        if job and job["processed"] >= job["total"]:
+            self._jobs.update_one(
+                {"_id": job["_id"], "status": {"$ne": str(JobStatus.Done)}},
+                {"$set": {"status": str(JobStatus.Done), "finished_at": datetime.datetime.now(datetime.UTC)}}
+            )
+
+        return True
+
+    def results(self, job_id: str, offset: int = 0, limit: Optional[int] = None) -> Generator[dict[str, Any], None, None]:
+        # Results come in submission order and stop at the first chunk that is not done yet
+        job = self._jobs.find_one({"_id": job_id}, {"chunk_size": 1})
+        if not job:
+            return
+
+        chunk_size = job["chunk_size"]
+        first_chunk, skip = divmod(offset, chunk_size)
+        items = self._items.find({"job_id": job_id, "chunk": {"$gte": first_chunk}}, {"results": 1, "chunk": 1, "done": 1}).sort("chunk", ASCENDING)
+
+        expected_chunk = first_chunk
+        for item in items:
+            if item["chunk"] != expected_chunk or not item["done"]:
+                return
+
+            for result in item["results"][skip:]:
+                if limit is not None and limit <= 0:
+                    return
+
+                yield result
+                if limit is not None:
+                    limit -= 1
+
+            skip = 0
+            expected_chunk += 1
+
+class JobRunner:
+    def __init__(self, store: JobStore, resolver: HostResolver, rate_limiter: Optional[RateLimiter] = None, poll_interval: Optional[float] = None, rate_limit_reserve: Optional[int] = None) -> Self:
+        self._logger = logging.getLogger()
+        self._store = store
+        self._resolver = resolver
+        self._rate_limiter = rate_limiter
+        self._poll_interval = poll_interval or JOB_POLL_INTERVAL
+        self._rate_limit_reserve = rate_limit_reserve if rate_limit_reserve is not None else JOB_RATE_LIMIT_RESERVE
+        self._owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self.__run, name="iptracker-jobs", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: Optional[float] = None):
+        self._closed.set()
+        self._thread.join(timeout)
+
+    def __budget_wait(self) -> float:
+        # Jobs only spend upstream budget beyond the reserve kept for interactive queries
+        if not self._rate_limiter:
+            return 0.0
+
+        remaining, reset_in = self._rate_limiter.peek("batch")
+        return reset_in if remaining <= self._rate_limit_reserve else 0.0
+
+    def __process(self, job: dict, item: dict):
+        fields = job["fields"]
+        include_fetch_date = True if fields and "fetched_at" in fields else False
+        include_data_source = True if fields and "data_source" in fields else False
+        results = [response_to_dict(x, include_fetch_date, include_data_source) for x in self._resolver.query(item["hosts"], fields)]
+        if include_fetch_date:
+            # Stored as text so that results read back match the live endpoints
+            for result in results:
+                if "fetched_at" in result:
+                    result["fetched_at"] = str(result["fetched_at"])
+
+        self._store.complete(item, self._owner, results)
+
+    def __give_up(self, job: dict, item: dict):
+        # The job still finishes, every host in the chunk is answered with a failure
+        self._logger.error("Giving up on chunk %d of job %s after %d attempts", item["chunk"], job["_id"], item["attempts"] - 1)
+        results = [response_to_dict(QueryResponse.fail(x, "lookup failed"), False, False) for x in item["hosts"]]
+        self._store.complete(item, self._owner, results)
+
+    def __run(self):
+        while not self._closed.wait(self._poll_interval):
+            while not self._closed.is_set():
+                wait_time = self.__budget_wait()
+                if wait_time > 0:
+                    self._closed.wait(wait_time)
+                    break
+
+                try:
+                    claimed = self._store.claim(self._owner)
+                except Exception:
+                    self._logger.exception("Failed to claim a job chunk")
+                    break
+
+                if not claimed:
+                    break
+
+                job, item = claimed
+                if item["attempts"] > self._store.max_attempts:
+                    try:
+                        self.__give_up(job, item)
+                    except Exception:
+                        self._logger.exception("Failed to close chunk %d of job %s", item["chunk"], job["_id"])
+                        break
+                    continue
+
+                try:
+                    self.__process(job, item)
+                except RateLimitExceeded as e:
+                    self._store.release(item, self._owner)
+                    self._closed.wait(e.retry_after)
+                    break
+                except Exception:
+                    # The lease runs out and the chunk is retried, by this or another worker
+                    self._logger.exception("Failed to process chunk %d of job %s", item["chunk"], job["_id"])
+                    break
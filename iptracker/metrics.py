@@ -1,8 +1,26 @@
+import inspect
+import os
 import time
+from contextlib import contextmanager, nullcontext
 from functools import wraps
-from typing import Self
-from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from typing import ContextManager, Optional, Self
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess, start_http_server
 from iptracker.api import QueryResponse, QueryResult
+from iptracker.constants import METRICS_STAGE_BUCKETS, METRICS_BATCH_SIZE_BUCKETS
+
+def multiprocess_enabled() -> bool:
+    # prometheus_client picks its value storage when it is imported, based on this variable
+    return bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+def start_multiprocess_server(port: int, host: str = "0.0.0.0"):
+    # Serves the metrics of every process writing to PROMETHEUS_MULTIPROC_DIR
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return start_http_server(port, host, registry)
+
+def mark_process_dead(pid: int):
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
 
 class Metrics:
     def __init__(self) -> Self:
@@ -10,9 +28,29 @@ class Metrics:
         self._request_time = Histogram("geoip_request_time_seconds", "Request processing time in seconds", labelnames=["path"])
         self._resolved_total = Counter("geoip_resolved_total", "Total number of successfully resolved IPs by source", labelnames=["source"])
         self._queried_total = Counter("geoip_queried_total", "Total number of IP addresses queried")
-        self._local_db_size = Gauge("geoip_local_db_size", "Current number of cached IPs")
+        self._local_db_size = Gauge("geoip_local_db_size", "Current number of cached IPs", multiprocess_mode="mostrecent")
+        self._memory_cache_total = Counter("geoip_memory_cache_total", "Total number of in-memory cache lookups by result", labelnames=["result"])
+        self._memory_cache_evictions_total = Counter("geoip_memory_cache_evictions_total", "Total number of in-memory cache evictions by reason", labelnames=["reason"])
+        self._memory_cache_size = Gauge("geoip_memory_cache_size", "Current number of entries in the in-memory cache", multiprocess_mode="livesum")
+        self._stage_time = Histogram("geoip_stage_time_seconds", "Time spent in each request processing stage in seconds", labelnames=["stage"], buckets=METRICS_STAGE_BUCKETS)
+        self._lookups_total = Counter("geoip_lookups_total", "Total number of host lookups by local tier and result", labelnames=["tier", "result"])
+        self._batch_size = Histogram("geoip_batch_size", "Number of hosts per batch", labelnames=["kind"], buckets=METRICS_BATCH_SIZE_BUCKETS)
+        self._upstream_requests_total = Counter("geoip_upstream_requests_total", "Total number of upstream API requests by endpoint and HTTP status", labelnames=["endpoint", "status"])
+        self._upstream_request_time = Histogram("geoip_upstream_request_time_seconds", "Upstream API request time in seconds", labelnames=["endpoint"])
+        self._rate_limit_wait = Histogram("geoip_rate_limit_wait_seconds", "Time spent waiting for upstream rate limit budget in seconds", labelnames=["bucket"], buckets=METRICS_STAGE_BUCKETS)
+        self._refresh_total = Counter("geoip_refresh_total", "Total number of stale hosts handled by the background refresh by result", labelnames=["result"])
+        self._refresh_queue_size = Gauge("geoip_refresh_queue_size", "Current number of stale hosts waiting for a background refresh", multiprocess_mode="livesum")
+        self._rate_limit_exceeded_total = Counter("geoip_rate_limit_exceeded_total", "Total number of upstream requests refused by the rate limiter", labelnames=["bucket"])
+        self._provider_requests_total = Counter("geoip_provider_requests_total", "Total number of upstream provider calls by provider and result", labelnames=["provider", "result"])
+        self._provider_request_time = Histogram("geoip_provider_request_time_seconds", "Upstream provider call time in seconds", labelnames=["provider"], buckets=METRICS_STAGE_BUCKETS)
+        self._provider_hedges_total = Counter("geoip_provider_hedges_total", "Total number of hedged calls sent to a provider because an earlier one was slow", labelnames=["provider"])
         
     def start_server(self, port: int, host: str = "0.0.0.0"):
+        # In multiprocess mode workers only write to PROMETHEUS_MULTIPROC_DIR,
+        # the gunicorn master serves the aggregate from its when_ready hook
+        if multiprocess_enabled():
+            return None
+        
         return start_http_server(port, host)
     
     def submit_request(self, path: str, time: float):
@@ -24,6 +62,19 @@ class Metrics:
         
     def time_request(self, path: str):
         def decorator(f):
+            if inspect.iscoroutinefunction(f):
+                @wraps(f)
+                async def wrapped_async(*args, **kwargs):
+                    start_time = time.time()
+                    try:
+                        response = await f(*args, **kwargs)
+                    finally:
+                        end_time = time.time()
+                        elapsed_time = end_time - start_time
+                        self.submit_request(path, elapsed_time)
+                    return response
+                return wrapped_async
+            
             @wraps(f)
             def wrapped(*args, **kwargs):
                 start_time = time.time()
@@ -55,4 +106,62 @@ class Metrics:
         if new_size < 0:
             raise ValueError("Out of range")
         
-        self._local_db_size.set(new_size)
\ No newline at end of file
+        self._local_db_size.set(new_size)
+    
+    def submit_cache_lookup(self, hit: bool):
+        self._memory_cache_total.labels("hit" if hit else "miss").inc()
+        
+    def submit_cache_eviction(self, reason: str):
+        self._memory_cache_evictions_total.labels(reason).inc()
+        
+    def submit_cache_size(self, new_size: int):
+        if new_size < 0:
+            raise ValueError("Out of range")
+        
+        self._memory_cache_size.set(new_size)
+        
+    @contextmanager
+    def time_stage(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stage_time.labels(stage).observe(time.perf_counter() - start_time)
+    
+    def submit_lookups(self, tier: str, hits: int, misses: int):
+        if hits:
+            self._lookups_total.labels(tier, "hit").inc(hits)
+        if misses:
+            self._lookups_total.labels(tier, "miss").inc(misses)
+    
+    def submit_batch_size(self, kind: str, size: int):
+        self._batch_size.labels(kind).observe(size)
+        
+    def submit_upstream_request(self, endpoint: str, status: int | str, time: float):
+        self._upstream_requests_total.labels(endpoint, str(status)).inc()
+        self._upstream_request_time.labels(endpoint).observe(time)
+    
+    def submit_rate_limit_wait(self, bucket: str, time: float):
+        self._rate_limit_wait.labels(bucket).observe(time)
+    
+    def submit_rate_limit_exceeded(self, bucket: str):
+        self._rate_limit_exceeded_total.labels(bucket).inc()
+
+    def submit_provider_request(self, provider: str, result: str, time: float):
+        self._provider_requests_total.labels(provider, result).inc()
+        self._provider_request_time.labels(provider).observe(time)
+    
+    def submit_provider_hedge(self, provider: str):
+        self._provider_hedges_total.labels(provider).inc()
+
+    def submit_refresh(self, result: str, count: int):
+        self._refresh_total.labels(result).inc(count)
+    
+    def submit_refresh_queue_size(self, new_size: int):
+        if new_size < 0:
+            raise ValueError("Out of range")
+        
+        self._refresh_queue_size.set(new_size)
+
+def time_stage(metrics: Optional[Metrics], stage: str) -> ContextManager:
+    return metrics.time_stage(stage) if metrics else nullcontext()
\ No newline at end of file
@@ -0,0 +1,98 @@
+import datetime
+import ipaddress
+import random
+import threading
+from typing import Any, Optional, Self
+from iptracker.cache import LRUCache
+from iptracker.constants import PREFIX_CACHE_IPV4_LENGTH, PREFIX_CACHE_IPV6_LENGTH, PREFIX_CACHE_FIELDS, PREFIX_CACHE_SIZE, PREFIX_CACHE_EXPIRATION, PREFIX_CACHE_VERIFY_RATE
+from iptracker.host import HostData, HostDataSource
+
+class _PrefixEntry:
+    def __init__(self, fetched_at: datetime.datetime, fields: dict[str, Any]) -> Self:
+        self.fetched_at = fetched_at
+        self.fields = fields
+        self.conflicts: set[str] = set()
+
+class PrefixCache:
+    def __init__(self, ipv4_length: Optional[int] = None, ipv6_length: Optional[int] = None, fields: Optional[list[str]] = None, max_size: Optional[int] = None, ttl: Optional[float] = None, verify_rate: Optional[float] = None) -> Self:
+        self._ipv4_length = ipv4_length or PREFIX_CACHE_IPV4_LENGTH
+        self._ipv6_length = ipv6_length or PREFIX_CACHE_IPV6_LENGTH
+        if not 0 < self._ipv4_length <= 32 or not 0 < self._ipv6_length <= 128:
+            raise ValueError("Invalid prefix length")
+        self._verify_rate = verify_rate if verify_rate is not None else PREFIX_CACHE_VERIFY_RATE
+        if not 0 <= self._verify_rate <= 1:
+            raise ValueError("Invalid verification rate")
+        self._fields = frozenset(fields or PREFIX_CACHE_FIELDS)
+        self._entries = LRUCache(max_size or PREFIX_CACHE_SIZE, ttl or PREFIX_CACHE_EXPIRATION)
+        self._lock = threading.Lock()
+
+    @property
+    def fields(self) -> frozenset[str]:
+        return self._fields
+
+    def __key(self, host: str) -> Optional[tuple[int, int]]:
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return None
+
+        length = self._ipv4_length if address.version == 4 else self._ipv6_length
+        shift = address.max_prefixlen - length
+        return address.version, int(address) >> shift
+
+    def get(self, host: str, fields: list[str]) -> Optional[HostData]:
+        # Only fields assumed to be stable across the whole prefix can be answered
+        if not self._fields.issuperset(fields):
+            return None
+
+        key = self.__key(host)
+        if key is None:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        with self._lock:
+            for field in fields:
+                if field not in entry.fields:
+                    return None
+
+            # Prefix answers are never written back, so conflicts would only be seen when two hosts
+            # happen to be fetched for other reasons. A share of the hits is passed on upstream
+            # instead, and the fetched record goes through set() like any other.
+            if self._verify_rate and random.random() < self._verify_rate:
+                return None
+
+            return HostData(
+                host,
+                entry.fetched_at,
+                HostDataSource.Prefix,
+                {k:v for k,v in entry.fields.items() if k in fields}
+            )
+
+    def set(self, host_data: HostData):
+        key = self.__key(host_data.host)
+        if key is None:
+            return
+
+        fields = {k:v for k,v in host_data.fields.items() if k in self._fields}
+        if not fields:
+            return
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries.set(key, _PrefixEntry(host_data.fetched_at, fields))
+                return
+
+            # A field that differs between two hosts of the same prefix is not stable there,
+            # so stop answering it for this prefix
+            for k, v in fields.items():
+                if k in entry.conflicts:
+                    continue
+                if k not in entry.fields:
+                    entry.fields[k] = v
+                elif entry.fields[k] != v:
+                    del entry.fields[k]
+                    entry.conflicts.add(k)
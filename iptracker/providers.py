@@ -0,0 +1,292 @@
+import datetime
+import json
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Generator, Optional, Self
+import requests
+from requests.adapters import HTTPAdapter
+from iptracker.api import Provider, QueryResponse, generate_splits, normalize_host, respell_response
+from iptracker.constants import IPAPI_DEFAULT_FIELDS, IPAPI_MAX_WORKERS, IPAPI_USER_AGENT, IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT, PROVIDER_HEDGE_DELAY, PROVIDER_MAX_WORKERS, PROVIDER_STREAM_CHUNK_SIZE
+from iptracker.host import HostData, HostDataSource
+from iptracker.metrics import Metrics
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+
+def _lookup(data: Any, path: str) -> Any:
+    # Dotted paths reach into nested objects, e.g. "connection.isp"
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+
+    return data
+
+def load_provider_config(path: str) -> list[dict[str, Any]]:
+    # A JSON list in priority order. {"type": "ip-api"} places ip-api, which otherwise goes first.
+    with open(path) as f:
+        entries = json.load(f)
+
+    if not isinstance(entries, list):
+        raise ValueError(f"Invalid provider configuration in {path}: expected a list")
+
+    names = set()
+    for entry in entries:
+        kind = entry.get("type", "http")
+        if kind == "ip-api":
+            continue
+        if kind != "http":
+            raise ValueError(f"Unknown provider type: {kind}")
+        for key in ("name", "url", "fields"):
+            if not entry.get(key):
+                raise ValueError(f"Provider is missing {key}: {entry}")
+        if entry["name"] in names or entry["name"] == "ip-api":
+            raise ValueError(f"Duplicate provider name: {entry['name']}")
+        names.add(entry["name"])
+
+    return entries
+
+def build_providers(entries: list[dict[str, Any]], ipapi: Provider, rate_limit_file: Optional[str] = None, user_agent: Optional[str] = None, timeout: Optional[tuple[float, float]] = None, metrics: Optional[Metrics] = None) -> list[Provider]:
+    providers = []
+    for entry in entries:
+        if entry.get("type", "http") == "ip-api":
+            providers.append(ipapi)
+            continue
+
+        rate_limiter = None
+        if entry.get("rate_limit"):
+            requests_per_window, window = entry["rate_limit"].split("/")
+            # Providers never wait for budget, the next one is asked instead
+            rate_limiter = RateLimiter(
+                f"{rate_limit_file}-{entry['name']}" if rate_limit_file else None,
+                {"json": (int(requests_per_window), float(window))},
+                0
+            )
+
+        providers.append(HTTPProvider(
+            entry["name"],
+            entry["url"],
+            entry["fields"],
+            rate_limiter,
+            user_agent,
+            entry.get("max_workers"),
+            timeout,
+            metrics,
+            entry.get("status_field"),
+            entry.get("message_field"),
+            entry.get("headers")
+        ))
+
+    if ipapi not in providers:
+        providers.insert(0, ipapi)
+    return providers
+
+class HTTPProvider(Provider):
+    # Any JSON API answering one address per GET request. field_map maps ip-api field names to
+    # paths in the provider's response, fields without a mapping cannot be served by it.
+    def __init__(self, name: str, url: str, field_map: dict[str, str], rate_limiter: Optional[RateLimiter] = None, user_agent: Optional[str] = None, max_workers: Optional[int] = None, timeout: Optional[tuple[float, float]] = None, metrics: Optional[Metrics] = None, status_field: Optional[str] = None, message_field: Optional[str] = None, headers: Optional[dict[str, str]] = None) -> Self:
+        if "{host}" not in url:
+            raise ValueError(f"Provider URL must contain {{host}}: {url}")
+
+        self._logger = logging.getLogger()
+        self._name = name
+        self._url = url
+        self._field_map = field_map
+        self._rate_limiter = rate_limiter
+        self._max_workers = max_workers or IPAPI_MAX_WORKERS
+        self._timeout = timeout or (IPAPI_CONNECT_TIMEOUT, IPAPI_READ_TIMEOUT)
+        self._metrics = metrics
+        self._status_field = status_field
+        self._message_field = message_field
+        self._executor = ThreadPoolExecutor(self._max_workers, thread_name_prefix=f"iptracker-{name}")
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._max_workers * 4)
+        self._session = requests.Session()
+        self._session.headers.update({"User-Agent": user_agent or IPAPI_USER_AGENT, **(headers or {})})
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def rate_limiter(self) -> Optional[RateLimiter]:
+        return self._rate_limiter
+
+    def supports(self, fields: list[str]) -> bool:
+        return all(x in self._field_map for x in fields)
+
+    def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
+        fields = [x for x in fields or IPAPI_DEFAULT_FIELDS if x in self._field_map]
+        if isinstance(hosts, str):
+            host, host_error = normalize_host(hosts)
+            if host_error:
+                return QueryResponse.fail(hosts, host_error)
+
+            return respell_response(self.__query_one(host, fields), hosts)
+        elif isinstance(hosts, list):
+            return list(self.__query_many(hosts, fields))
+        else:
+            raise TypeError("Invalid input type")
+
+    def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None) -> Generator[list[QueryResponse], None, None]:
+        fields = [x for x in fields or IPAPI_DEFAULT_FIELDS if x in self._field_map]
+        for chunk in generate_splits(hosts, self._max_workers * 4):
+            yield list(self.__query_many(chunk, fields))
+
+    def __query_many(self, hosts: list[str], fields: list[str]) -> Generator[QueryResponse, None, None]:
+        normalized = [normalize_host(x) for x in hosts]
+        unique = list(dict.fromkeys(host for host, host_error in normalized if not host_error))
+        resolved = dict(zip(unique, self._executor.map(lambda x: self.__query_one(x, fields), unique)))
+        for x, (host, host_error) in zip(hosts, normalized):
+            yield QueryResponse.fail(x, host_error) if host_error else respell_response(resolved[host], x)
+
+    def __query_one(self, host: str, fields: list[str]) -> QueryResponse:
+        if self._rate_limiter:
+            self._rate_limiter.acquire("json")
+
+        start_time = time.perf_counter()
+        try:
+            response = self._session.get(self._url.format(host=host), timeout=self._timeout)
+        except Exception:
+            if self._metrics:
+                self._metrics.submit_upstream_request(self._name, "error", time.perf_counter() - start_time)
+            raise
+        if self._metrics:
+            self._metrics.submit_upstream_request(self._name, response.status_code, time.perf_counter() - start_time)
+
+        if response.status_code == 429:
+            retry_after = float(response.headers.get("Retry-After", 60))
+            if self._rate_limiter:
+                self._rate_limiter.update("json", 0, retry_after)
+            raise RateLimitExceeded(retry_after)
+        if response.status_code != 200:
+            self._logger.error("%s remote error: %d, %s", self._name, response.status_code, response.text)
+            raise Exception(f"Remote error: {response.status_code}")
+
+        data = response.json()
+        if self._status_field and not _lookup(data, self._status_field):
+            message = _lookup(data, self._message_field) if self._message_field else None
+            return QueryResponse.fail(host, str(message or "fail"))
+
+        values = {}
+        for field in fields:
+            value = _lookup(data, self._field_map[field])
+            if value is not None:
+                values[field] = value
+
+        return QueryResponse.success(HostData(host, datetime.datetime.now(datetime.UTC), HostDataSource.Remote, values))
+
+class ProviderChain(Provider):
+    # Asks providers in priority order and moves on to the next one when a provider fails or is
+    # out of budget. With a hedge delay, the next provider is also asked when the current one has
+    # not answered in time, and whichever answers first wins.
+    def __init__(self, providers: list[Provider], hedge_delay: Optional[float] = None, max_workers: Optional[int] = None, metrics: Optional[Metrics] = None, rate_limiter: Optional[RateLimiter] = None) -> Self:
+        if not providers:
+            raise ValueError("At least one provider is required")
+
+        self._logger = logging.getLogger()
+        self._providers = providers
+        self._hedge_delay = hedge_delay if hedge_delay is not None else PROVIDER_HEDGE_DELAY
+        self._metrics = metrics
+        self._rate_limiter = rate_limiter or providers[0].rate_limiter
+        self._executor = ThreadPoolExecutor(max_workers or PROVIDER_MAX_WORKERS, thread_name_prefix="iptracker-providers") if self._hedge_delay > 0 else None
+
+    @property
+    def name(self) -> str:
+        return ",".join(x.name for x in self._providers)
+
+    @property
+    def providers(self) -> list[Provider]:
+        return self._providers
+
+    @property
+    def rate_limiter(self) -> Optional[RateLimiter]:
+        # Budget checked by background work before it spends any, normally ip-api's
+        return self._rate_limiter
+
+    def supports(self, fields: list[str]) -> bool:
+        return any(x.supports(fields) for x in self._providers)
+
+    def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
+        return self.__call(fields, lambda x: x.query(hosts, fields))
+
+    def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None) -> Generator[list[QueryResponse], None, None]:
+        # Chunks fail over independently, each one is still spread over the provider's own workers
+        for chunk in generate_splits(hosts, PROVIDER_STREAM_CHUNK_SIZE):
+            yield self.__call(fields, lambda x: x.query(chunk, fields))
+
+    def __eligible(self, fields: Optional[list[str]]) -> list[Provider]:
+        # Providers that cannot serve every requested field are skipped, the first one is the last resort
+        return [x for x in self._providers if x.supports(fields or IPAPI_DEFAULT_FIELDS)] or self._providers[:1]
+
+    def __attempt(self, provider: Provider, call: Callable[[Provider], Any]) -> Any:
+        start_time = time.perf_counter()
+        try:
+            result = call(provider)
+        except RateLimitExceeded:
+            self.__submit(provider, "rate_limited", start_time)
+            raise
+        except Exception:
+            self.__submit(provider, "error", start_time)
+            self._logger.warning("Provider %s failed", provider.name, exc_info=True)
+            raise
+
+        self.__submit(provider, "success", start_time)
+        return result
+
+    def __submit(self, provider: Provider, result: str, start_time: float):
+        if self._metrics:
+            self._metrics.submit_provider_request(provider.name, result, time.perf_counter() - start_time)
+
+    def __failure(self, errors: list[Exception]) -> Exception:
+        # Only report a rate limit when every provider is out of budget
+        if all(isinstance(x, RateLimitExceeded) for x in errors):
+            return RateLimitExceeded(min(x.retry_after for x in errors))
+
+        return next(x for x in reversed(errors) if not isinstance(x, RateLimitExceeded))
+
+    def __call(self, fields: Optional[list[str]], call: Callable[[Provider], Any]) -> Any:
+        providers = self.__eligible(fields)
+        errors = []
+        if not self._executor or len(providers) == 1:
+            for provider in providers:
+                try:
+                    return self.__attempt(provider, call)
+                except Exception as e:
+                    errors.append(e)
+
+            raise self.__failure(errors)
+
+        waiting = list(providers)
+        pending = {}
+
+        def launch(hedge: bool):
+            provider = waiting.pop(0)
+            if hedge and self._metrics:
+                self._metrics.submit_provider_hedge(provider.name)
+            pending[self._executor.submit(self.__attempt, provider, call)] = provider
+
+        launch(False)
+        try:
+            while pending:
+                done, _ = wait(pending, self._hedge_delay if waiting else None, FIRST_COMPLETED)
+                if not done:
+                    launch(True)
+                    continue
+
+                for future in done:
+                    del pending[future]
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        errors.append(e)
+
+                if not pending and waiting:
+                    launch(False)
+        finally:
+            # Calls already running finish in the background, their results are dropped
+            for future in pending:
+                future.cancel()
+
+        raise self.__failure(errors)
@@ -0,0 +1,192 @@
+import argparse
+import csv
+import datetime
+import ipaddress
+import json
+import mmap
+import struct
+import sys
+import time
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Any, Optional, Self
+
+# magic, range count, record count, build time (UNIX timestamp), field list length
+_HEADER = struct.Struct("<8sQQdI")
+_MAGIC = b"IPTRDB01"
+_KEY_SIZE = 16
+_RECORD_ID = struct.Struct("<I")
+_RECORD_OFFSET = struct.Struct("<Q")
+# IPv4 addresses are stored in the IPv4-mapped IPv6 range so both families share one index
+_IPV4_MAPPED = 0xFFFF00000000
+
+# Columns that do not hold strings in ip-api responses
+FIELD_TYPES = {
+    "lat": float,
+    "lon": float,
+    "offset": int,
+    "mobile": lambda x: x.lower() in ("1", "true", "yes"),
+    "proxy": lambda x: x.lower() in ("1", "true", "yes"),
+    "hosting": lambda x: x.lower() in ("1", "true", "yes")
+}
+
+def address_to_key(address: ipaddress.IPv4Address | ipaddress.IPv6Address) -> bytes:
+    value = int(address)
+    if address.version == 4:
+        value |= _IPV4_MAPPED
+
+    return value.to_bytes(_KEY_SIZE, "big")
+
+def _align(size: int) -> int:
+    return (size + _KEY_SIZE - 1) // _KEY_SIZE * _KEY_SIZE
+
+class _KeyView:
+    def __init__(self, buffer: mmap.mmap, offset: int, count: int) -> Self:
+        self._buffer = buffer
+        self._offset = offset
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> bytes:
+        offset = self._offset + i * _KEY_SIZE
+        return self._buffer[offset:offset + _KEY_SIZE]
+
+class RangeDatabase:
+    def __init__(self, path: str, record_cache_size: int = 4096) -> Self:
+        # Read-only shared mapping, every worker that opens the file shares the same page cache
+        with open(path, "rb") as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, range_count, record_count, built_at, fields_length = _HEADER.unpack_from(self._buffer, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"Not a range database: {path}")
+
+        offset = _HEADER.size
+        self._fields = json.loads(self._buffer[offset:offset + fields_length])
+        offset = _align(offset + fields_length)
+
+        self._range_count = range_count
+        self._built_at = datetime.datetime.fromtimestamp(built_at, datetime.UTC)
+        self._starts = _KeyView(self._buffer, offset, range_count)
+        self._ends = _KeyView(self._buffer, offset + range_count * _KEY_SIZE, range_count)
+        self._record_ids = offset + 2 * range_count * _KEY_SIZE
+        self._record_offsets = self._record_ids + range_count * _RECORD_ID.size
+        self._records = self._record_offsets + (record_count + 1) * _RECORD_OFFSET.size
+        self.__record = lru_cache(maxsize=record_cache_size)(self.__read_record)
+
+    def __len__(self) -> int:
+        return self._range_count
+
+    @property
+    def fields(self) -> list[str]:
+        return self._fields
+
+    @property
+    def built_at(self) -> datetime.datetime:
+        return self._built_at
+
+    def close(self):
+        self._buffer.close()
+
+    def __read_record(self, record_id: int) -> dict[str, Any]:
+        start, = _RECORD_OFFSET.unpack_from(self._buffer, self._record_offsets + record_id * _RECORD_OFFSET.size)
+        end, = _RECORD_OFFSET.unpack_from(self._buffer, self._record_offsets + (record_id + 1) * _RECORD_OFFSET.size)
+        return json.loads(self._buffer[self._records + start:self._records + end])
+
+    def lookup(self, host: str) -> Optional[dict[str, Any]]:
+        try:
+            key = address_to_key(ipaddress.ip_address(host))
+        except ValueError:
+            return None
+
+        i = bisect_right(self._starts, key) - 1
+        if i < 0 or self._ends[i] < key:
+            return None
+
+        record_id, = _RECORD_ID.unpack_from(self._buffer, self._record_ids + i * _RECORD_ID.size)
+        # Cached records are shared, callers must copy before modifying
+        return self.__record(record_id)
+
+    @staticmethod
+    def build(csv_path: str, output_path: str) -> int:
+        ranges = []
+        records = {}
+        fields = set()
+
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            columns = reader.fieldnames or []
+            if "network" in columns:
+                value_columns = [x for x in columns if x != "network"]
+            elif "start" in columns and "end" in columns:
+                value_columns = [x for x in columns if x not in ("start", "end")]
+            else:
+                raise ValueError("CSV must have either a 'network' column or 'start' and 'end' columns")
+
+            for row in reader:
+                if "network" in columns:
+                    network = ipaddress.ip_network(row["network"], strict=False)
+                    start, end = network[0], network[-1]
+                else:
+                    start, end = ipaddress.ip_address(row["start"]), ipaddress.ip_address(row["end"])
+
+                values = {}
+                for column in value_columns:
+                    value = row[column]
+                    if value is None or value == "":
+                        continue
+                    values[column] = FIELD_TYPES[column](value) if column in FIELD_TYPES else value
+                    fields.add(column)
+
+                # Identical records are stored once and shared between ranges
+                record = json.dumps(values, separators=(",", ":"), sort_keys=True).encode()
+                record_id = records.setdefault(record, len(records))
+                ranges.append((address_to_key(start), address_to_key(end), record_id))
+
+        ranges.sort()
+        for previous, current in zip(ranges, ranges[1:]):
+            if current[0] <= previous[1]:
+                raise ValueError(f"Overlapping ranges starting at {ipaddress.ip_address(int.from_bytes(current[0], 'big'))}")
+
+        fields = json.dumps(sorted(fields)).encode()
+        with open(output_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(ranges), len(records), time.time(), len(fields)))
+            f.write(fields)
+            f.write(b"\0" * (_align(_HEADER.size + len(fields)) - _HEADER.size - len(fields)))
+            f.write(b"".join(x[0] for x in ranges))
+            f.write(b"".join(x[1] for x in ranges))
+            f.write(b"".join(_RECORD_ID.pack(x[2]) for x in ranges))
+
+            offset = 0
+            f.write(_RECORD_OFFSET.pack(offset))
+            for record in records:
+                offset += len(record)
+                f.write(_RECORD_OFFSET.pack(offset))
+            for record in records:
+                f.write(record)
+
+        return len(ranges)
+
+def main(args: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m iptracker.rangedb", description="Build and query offline IP range databases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Build a range database from a CSV file")
+    build.add_argument("csv_path")
+    build.add_argument("output_path")
+    lookup = commands.add_parser("lookup", help="Look up addresses in a range database")
+    lookup.add_argument("path")
+    lookup.add_argument("hosts", nargs="+")
+    args = parser.parse_args(args)
+
+    if args.command == "build":
+        count = RangeDatabase.build(args.csv_path, args.output_path)
+        print(f"Wrote {count} ranges to {args.output_path}")
+    else:
+        db = RangeDatabase(args.path)
+        for host in args.hosts:
+            print(json.dumps({"query": host, **(db.lookup(host) or {})}))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Self
+from iptracker.constants import IPAPI_RATE_LIMITS, IPAPI_RATE_LIMIT_MAX_WAIT
+
+# Per bucket: remaining requests in the current window, window reset time (UNIX timestamp)
+_SLOT = struct.Struct("<dd")
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float) -> Self:
+        super().__init__(f"Upstream rate limit exceeded, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+class RateLimiter:
+    def __init__(self, path: Optional[str] = None, limits: Optional[dict[str, tuple[int, float]]] = None, max_wait: Optional[float] = None) -> Self:
+        self._limits = limits or IPAPI_RATE_LIMITS
+        self._slots = {name: i * _SLOT.size for i, name in enumerate(sorted(self._limits))}
+        self._max_wait = max_wait if max_wait is not None else IPAPI_RATE_LIMIT_MAX_WAIT
+        self._lock = threading.Lock()
+
+        # A file-backed budget is shared by every process that maps the same path,
+        # otherwise the budget is only shared between threads of this process
+        size = _SLOT.size * len(self._slots)
+        if path:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._buffer = mmap.mmap(self._fd, size)
+        else:
+            self._fd = None
+            self._buffer = bytearray(size)
+
+    @contextmanager
+    def __locked(self):
+        # flock() does not exclude threads sharing a descriptor, so both locks are needed
+        with self._lock:
+            if self._fd is None:
+                yield
+                return
+
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def __read(self, bucket: str) -> tuple[float, float]:
+        return _SLOT.unpack_from(self._buffer, self._slots[bucket])
+
+    def __write(self, bucket: str, remaining: float, reset_at: float):
+        _SLOT.pack_into(self._buffer, self._slots[bucket], remaining, reset_at)
+
+    def reserve(self, bucket: str) -> float:
+        with self.__locked():
+            now = time.time()
+            remaining, reset_at = self.__read(bucket)
+            if now >= reset_at:
+                limit, window = self._limits[bucket]
+                remaining, reset_at = limit, now + window
+
+            if remaining >= 1:
+                self.__write(bucket, remaining - 1, reset_at)
+                return 0.0
+
+            self.__write(bucket, remaining, reset_at)
+            return reset_at - now
+
+    def peek(self, bucket: str) -> tuple[float, float]:
+        # Remaining budget and seconds until the window resets, without reserving anything
+        with self.__locked():
+            now = time.time()
+            remaining, reset_at = self.__read(bucket)
+
+        if now >= reset_at:
+            return self._limits[bucket][0], 0.0
+
+        return remaining, reset_at - now
+
+    def acquire(self, bucket: str, max_wait: Optional[float] = None) -> float:
+        max_wait = max_wait if max_wait is not None else self._max_wait
+        waited = 0.0
+        while True:
+            wait_time = self.reserve(bucket)
+            if wait_time <= 0:
+                return waited
+
+            if waited + wait_time > max_wait:
+                raise RateLimitExceeded(wait_time)
+
+            time.sleep(wait_time)
+            waited += wait_time
+
+    async def acquire_async(self, bucket: str, max_wait: Optional[float] = None) -> float:
+        max_wait = max_wait if max_wait is not None else self._max_wait
+        waited = 0.0
+        while True:
+            wait_time = self.reserve(bucket)
+            if wait_time <= 0:
+                return waited
+
+            if waited + wait_time > max_wait:
+                raise RateLimitExceeded(wait_time)
+
+            await asyncio.sleep(wait_time)
+            waited += wait_time
+
+    def update(self, bucket: str, remaining: int, ttl: float):
+        with self.__locked():
+            now = time.time()
+            reset_at = now + ttl
+            stored_remaining, stored_reset_at = self.__read(bucket)
+            # Responses to concurrent requests may arrive out of order, so within
+            # the same window trust whichever count is lower
+            if now < stored_reset_at and abs(reset_at - stored_reset_at) <= 1.5:
+                remaining = min(remaining, stored_remaining)
+
+            self.__write(bucket, remaining, reset_at)
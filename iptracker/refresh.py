@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Optional, Self
+from iptracker.api import QueryResponse, QueryResult
+from iptracker.constants import REFRESH_BATCH_SIZE, REFRESH_INTERVAL, REFRESH_QUEUE_SIZE, REFRESH_RATE_LIMIT_RESERVE
+from iptracker.host import HostDataSource
+from iptracker.metrics import Metrics
+from iptracker.ratelimit import RateLimitExceeded
+
+class _Backlog:
+    def __init__(self, max_size: int) -> Self:
+        self._max_size = max_size
+        self._hits: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._hits)
+
+    def add(self, host: str, hits: int = 1) -> bool:
+        with self._lock:
+            previous = self._hits.get(host)
+            if previous is None and len(self._hits) >= self._max_size:
+                return False
+
+            self._hits[host] = (previous or 0) + hits
+            return True
+
+    def take(self, count: int) -> dict[str, int]:
+        # The most requested hosts go first
+        with self._lock:
+            hosts = heapq.nlargest(count, self._hits, key=self._hits.__getitem__)
+            return {x: self._hits.pop(x) for x in hosts}
+
+    def restore(self, batch: dict[str, int]):
+        for host, hits in batch.items():
+            self.add(host, hits)
+
+class RefreshQueue:
+    def __init__(self, soft_ttl: float, batch_size: Optional[int] = None, interval: Optional[float] = None, max_size: Optional[int] = None, rate_limit_reserve: Optional[int] = None, metrics: Optional[Metrics] = None) -> Self:
+        if soft_ttl <= 0:
+            raise ValueError(f"Invalid soft TTL: {soft_ttl}")
+
+        self._logger = logging.getLogger()
+        self._soft_ttl = datetime.timedelta(seconds=soft_ttl)
+        self._batch_size = batch_size or REFRESH_BATCH_SIZE
+        self._interval = interval or REFRESH_INTERVAL
+        self._rate_limit_reserve = rate_limit_reserve if rate_limit_reserve is not None else REFRESH_RATE_LIMIT_RESERVE
+        self._backlog = _Backlog(max_size or REFRESH_QUEUE_SIZE)
+        self._metrics = metrics
+        self._refresh: Optional[Callable[[list[str]], Any]] = None
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._backlog)
+
+    @property
+    def rate_limit_reserve(self) -> int:
+        # Upstream requests per window left for foreground queries
+        return self._rate_limit_reserve
+
+    def start(self, refresh: Callable[[list[str]], Any]):
+        if self._refresh:
+            raise RuntimeError("Refresh queue already started")
+
+        self._refresh = refresh
+        self._thread = threading.Thread(target=self.__run, name="iptracker-refresh", daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: Optional[float] = None):
+        self._closed.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def submit(self, host: str):
+        added = self._backlog.add(host)
+        if self._metrics:
+            if not added:
+                self._metrics.submit_refresh("dropped", 1)
+            self._metrics.submit_refresh_queue_size(len(self._backlog))
+
+    def submit_stale(self, responses: list[QueryResponse]):
+        # Records past the soft TTL are still served, and queued to be re-resolved in the background
+        stale_before = datetime.datetime.now(datetime.UTC) - self._soft_ttl
+        for response in responses:
+            if response.status != QueryResult.Success:
+                continue
+
+            data = response.result
+            if data.source in (HostDataSource.Local, HostDataSource.Memory) and data.fetched_at < stale_before:
+                self.submit(response.host)
+
+    def _take(self) -> dict[str, int]:
+        batch = self._backlog.take(self._batch_size)
+        if self._metrics and batch:
+            self._metrics.submit_refresh_queue_size(len(self._backlog))
+
+        return batch
+
+    def _defer(self, batch: dict[str, int], e: RateLimitExceeded) -> float:
+        # Deferred hosts keep their access counts
+        self._backlog.restore(batch)
+        if self._metrics:
+            self._metrics.submit_refresh("deferred", len(batch))
+            self._metrics.submit_refresh_queue_size(len(self._backlog))
+
+        return max(e.retry_after, self._interval)
+
+    def __run(self):
+        while not self._closed.wait(self._interval):
+            batch = self._take()
+            if not batch:
+                continue
+
+            try:
+                self._refresh(list(batch))
+            except RateLimitExceeded as e:
+                self._closed.wait(self._defer(batch, e))
+            except Exception:
+                self._logger.exception("Failed to refresh %d hosts", len(batch))
+
+class AsyncRefreshQueue(RefreshQueue):
+    def __init__(self, soft_ttl: float, batch_size: Optional[int] = None, interval: Optional[float] = None, max_size: Optional[int] = None, rate_limit_reserve: Optional[int] = None, metrics: Optional[Metrics] = None) -> Self:
+        super().__init__(soft_ttl, batch_size, interval, max_size, rate_limit_reserve, metrics)
+        self._async_refresh: Optional[Callable[[list[str]], Awaitable[Any]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, refresh: Callable[[list[str]], Awaitable[Any]]):
+        if self._async_refresh:
+            raise RuntimeError("Refresh queue already started")
+
+        self._async_refresh = refresh
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def submit(self, host: str):
+        super().submit(host)
+        # The loop only exists once requests are being served, so the worker starts with the first stale hit
+        if self._task is None and self._async_refresh:
+            self._task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            batch = self._take()
+            if not batch:
+                continue
+
+            try:
+                await self._async_refresh(list(batch))
+            except RateLimitExceeded as e:
+                await asyncio.sleep(self._defer(batch, e))
+            except Exception:
+                self._logger.exception("Failed to refresh %d hosts", len(batch))
@@ -1,10 +1,17 @@
 import logging
-from typing import Optional, Self
-from iptracker.api import IPAPI, QueryResponse, QueryResult, find_host_errors
-from iptracker.constants import IPAPI_DEFAULT_FIELDS, IPAPI_SYSTEM_FIELDS
-from iptracker.db import HostDataStore
-from iptracker.host import HostData
-from iptracker.metrics import Metrics
+from typing import Generator, Iterable, Optional, Self
+from iptracker.api import IPAPI, Provider, QueryResponse, QueryResult, expand_responses, normalize_host, normalize_hosts, respell_response
+from iptracker.batching import MicroBatcher, SingleFlight
+from iptracker.cache import HostCache
+from iptracker.constants import IPAPI_DEFAULT_FIELDS, IPAPI_SYSTEM_FIELDS, META_FIELDS, DS_BULK_CHUNK_SIZE
+from iptracker.host import HostData, HostDataSource, merge_hostdata
+from iptracker.metrics import Metrics, time_stage
+from iptracker.prefix import PrefixCache
+from iptracker.rangedb import RangeDatabase
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+from iptracker.refresh import RefreshQueue
+from iptracker.store import HostStore
+from iptracker.streaming import iter_chunks
 
 def has_all_fields(host: HostData, fields: list[str]) -> bool:
     for field in fields:
@@ -13,34 +20,297 @@ def has_all_fields(host: HostData, fields: list[str]) -> bool:
     
     return True
 
+def missing_fields(host: HostData, fields: list[str]) -> list[str]:
+    return [x for x in fields if x not in host.fields]
+
 def filter_hostdata(host: HostData, fields: list[str]) -> HostData:
+    # The filtered record shares the row when nothing has to be dropped
     return HostData(
         host.host,
         host.fetched_at,
         host.source,
-        {k:v for k,v in host.fields.items() if k in fields}
+        host.fields.select(fields)
     )
     
 def filter_fields(fields: list[str]) -> list[str]:
     filtered_fields = [*fields]
-    for field in IPAPI_SYSTEM_FIELDS:
+    for field in [*IPAPI_SYSTEM_FIELDS, *META_FIELDS]:
         if field in filtered_fields:
             filtered_fields.remove(field)
             
     return filtered_fields
 
+def complete_response(response: QueryResponse, fields: list[str], partial: Optional[HostData]) -> QueryResponse:
+    # Fills in the fields that were already known locally and only the missing ones went upstream.
+    # Forced refreshes fetch more fields than were asked for, which are dropped from the answer.
+    if response.status != QueryResult.Success:
+        return response
+    if partial:
+        return QueryResponse.success(filter_hostdata(merge_hostdata(partial, response.result), fields))
+    if len(response.result.fields) > len(fields):
+        return QueryResponse.success(filter_hostdata(response.result, fields))
+    
+    return response
+
+def group_by_missing(hosts: list[str], fields: list[str], partials: dict[str, HostData]) -> dict[tuple[str, ...], list[str]]:
+    groups = {}
+    for host in hosts:
+        partial = partials.get(host)
+        missing = missing_fields(partial, fields) if partial else fields
+        groups.setdefault(tuple(missing), []).append(host)
+    
+    return groups
+
+def answer_many(hosts: list[str], normalized: list[tuple[Optional[str], Optional[str]]], resolved: dict[str, QueryResponse]) -> list[QueryResponse]:
+    return [
+        QueryResponse.fail(x, host_error) if host_error else respell_response(resolved[host], x)
+        for x, (host, host_error) in zip(hosts, normalized)
+    ]
+
+class LocalTiers:
+    # The part of resolving shared by HostResolver and AsyncHostResolver that never waits on I/O:
+    # the in-process tiers, how database and upstream results are merged, and what is written back.
+    # The resolvers only add the database and upstream calls around it.
+    def __init__(self, cache: Optional[HostCache] = None, offline_db: Optional[RangeDatabase] = None, prefix_cache: Optional[PrefixCache] = None, refresh_queue: Optional[RefreshQueue] = None, metrics: Optional[Metrics] = None) -> Self:
+        self._cache = cache
+        self._offline_db = offline_db
+        self._prefix_cache = prefix_cache
+        self._refresh_queue = refresh_queue
+        self._metrics = metrics
+        self._logger = logging.getLogger()
+    
+    @property
+    def active(self) -> bool:
+        return bool(self._cache or self._offline_db or self._prefix_cache)
+    
+    def __query_memory(self, host: str, fields: list[str], partials: dict[str, HostData]) -> Optional[QueryResponse]:
+        cached = self._cache.get(host)
+        if not cached:
+            return None
+        if cached.status != QueryResult.Success:
+            return cached
+        if has_all_fields(cached.result, fields):
+            return QueryResponse.success(filter_hostdata(cached.result, fields))
+        
+        # Known fields are kept so that only the missing ones have to be fetched
+        partials[host] = cached.result
+        return None
+    
+    def __query_offline(self, host: str, fields: list[str]) -> Optional[QueryResponse]:
+        record = self._offline_db.lookup(host)
+        if not record:
+            return None
+        
+        # The offline database only answers when it covers every requested field
+        for field in fields:
+            if field not in record:
+                return None
+        
+        return QueryResponse.success(HostData(
+            host,
+            self._offline_db.built_at,
+            HostDataSource.Offline,
+            {k:v for k,v in record.items() if k in fields}
+        ))
+    
+    def __query_prefix(self, host: str, fields: list[str]) -> Optional[QueryResponse]:
+        prefix_result = self._prefix_cache.get(host, fields)
+        return QueryResponse.success(prefix_result) if prefix_result else None
+    
+    def __accept_db_result(self, db_result: HostData, fields: list[str], partials: dict[str, HostData]) -> Optional[QueryResponse]:
+        partial = partials.get(db_result.host)
+        if partial:
+            db_result = merge_hostdata(partial, db_result)
+        if not db_result.fields:
+            return None
+        
+        if self._cache:
+            self._cache.set(QueryResponse.success(db_result))
+        if self._prefix_cache:
+            self._prefix_cache.set(db_result)
+        if has_all_fields(db_result, fields):
+            return QueryResponse.success(filter_hostdata(db_result, fields))
+        
+        partials[db_result.host] = db_result
+        return None
+    
+    def __collect(self, tier: str, hosts: list[str], tier_results: list[Optional[QueryResponse]], results: list[QueryResponse]) -> list[str]:
+        # Adds what a tier answered to results and returns the hosts it could not answer
+        unresolved = []
+        for host, tier_result in zip(hosts, tier_results):
+            if tier_result:
+                results.append(tier_result)
+            else:
+                unresolved.append(host)
+        
+        if self._metrics:
+            self._metrics.submit_lookups(tier, len(hosts) - len(unresolved), len(unresolved))
+        return unresolved
+    
+    def query_before_db(self, hosts: list[str], fields: list[str], partials: dict[str, HostData], results: list[QueryResponse]) -> list[str]:
+        # Each tier only sees the hosts that the tiers before it could not answer
+        if self._cache and hosts:
+            with time_stage(self._metrics, "memory"):
+                tier_results = [self.__query_memory(x, fields, partials) for x in hosts]
+            hosts = self.__collect("memory", hosts, tier_results, results)
+        if self._offline_db and hosts:
+            with time_stage(self._metrics, "offline"):
+                tier_results = [self.__query_offline(x, fields) for x in hosts]
+            hosts = self.__collect("offline", hosts, tier_results, results)
+        
+        return hosts
+    
+    def db_fields(self, host: str, fields: list[str], partials: dict[str, HostData]) -> list[str]:
+        partial = partials.get(host)
+        return missing_fields(partial, fields) if partial else fields
+    
+    def accept_db(self, hosts: list[str], db_results: dict[str, HostData], fields: list[str], partials: dict[str, HostData], results: list[QueryResponse]) -> list[str]:
+        tier_results = [self.__accept_db_result(db_results[x], fields, partials) if x in db_results else None for x in hosts]
+        return self.__collect("local_db", hosts, tier_results, results)
+    
+    def query_after_db(self, hosts: list[str], fields: list[str], results: list[QueryResponse]) -> list[str]:
+        if self._prefix_cache and hosts:
+            # Hosts missing from every exact-match tier may still share a prefix with a known one
+            with time_stage(self._metrics, "prefix"):
+                tier_results = [self.__query_prefix(x, fields) for x in hosts]
+            hosts = self.__collect("prefix", hosts, tier_results, results)
+        if self._refresh_queue and results:
+            self._refresh_queue.submit_stale(results)
+        
+        return hosts
+    
+    def accept_remote(self, remote_results: list[QueryResponse], partials: dict[str, HostData]) -> list[HostData]:
+        # Updates the in-process tiers and returns the records to write to the local database
+        resolved = []
+        for remote_result in remote_results:
+            partial = partials.get(remote_result.host)
+            if remote_result.status != QueryResult.Success:
+                # Negative results are only kept in memory, and never replace what is known about a host
+                if self._cache and not partial:
+                    self._cache.set(remote_result)
+                continue
+            
+            if self._cache:
+                self._cache.set(QueryResponse.success(merge_hostdata(partial, remote_result.result)) if partial else remote_result)
+            if self._prefix_cache:
+                self._prefix_cache.set(remote_result.result)
+            # Only the fetched fields are written, the store merges them into the existing record
+            resolved.append(remote_result.result)
+        
+        return resolved
+    
+    def check_written(self, written: int, total: int):
+        if written < total:
+            self._logger.warning(f"Failed to push {total - written} of {total} hosts to local DB")
+    
+    def check_refresh_budget(self, rate_limiter: Optional[RateLimiter]):
+        # Background refreshes only spend budget beyond the reserve kept for foreground queries
+        if not rate_limiter:
+            return
+        
+        remaining, reset_in = rate_limiter.peek("batch")
+        if remaining <= self._refresh_queue.rate_limit_reserve:
+            raise RateLimitExceeded(reset_in)
+    
+    def __known_record(self, host: str, db_results: dict[str, HostData]) -> Optional[HostData]:
+        if host in db_results:
+            return db_results[host]
+        
+        cached = self._cache.get(host) if self._cache else None
+        return cached.result if cached and cached.status == QueryResult.Success else None
+    
+    def refresh_groups(self, hosts: list[str], db_results: dict[str, HostData]) -> dict[tuple[str, ...], list[str]]:
+        # Every stored field is fetched again, so the refreshed record is fresh as a whole
+        groups = {}
+        for host in hosts:
+            record = self.__known_record(host, db_results)
+            if record and record.fields:
+                groups.setdefault(tuple(sorted(record.fields)), []).append(host)
+        
+        return groups
+    
+    def forced_fields(self, host: str, fields: list[str], db_results: dict[str, HostData]) -> list[str]:
+        # A forced refresh resets the record's fetch time, so the fields already stored are
+        # fetched again along with the requested ones and none of them outlives the expiration time
+        record = self.__known_record(host, db_results)
+        if not record:
+            return fields
+        
+        return fields + sorted(x for x in record.fields if x not in fields)
+    
+    def forced_groups(self, hosts: list[str], fields: list[str], db_results: dict[str, HostData]) -> dict[tuple[str, ...], list[str]]:
+        groups = {}
+        for host in hosts:
+            groups.setdefault(tuple(self.forced_fields(host, fields, db_results)), []).append(host)
+        
+        return groups
+    
+    def accept_refresh(self, remote_results: list[QueryResponse]) -> list[HostData]:
+        refreshed = [x.result for x in remote_results if x.status == QueryResult.Success]
+        for x in refreshed:
+            if self._cache:
+                self._cache.set(QueryResponse.success(x))
+            if self._prefix_cache:
+                self._prefix_cache.set(x)
+        
+        if self._metrics:
+            self._metrics.submit_refresh("refreshed", len(refreshed))
+            self._metrics.submit_refresh("failed", len(remote_results) - len(refreshed))
+        return refreshed
+    
+    def prepare_many(self, hosts: list[str]) -> tuple[list[tuple[Optional[str], Optional[str]]], list[str]]:
+        # Every distinct address is resolved once, then answered under each position and spelling it was given in
+        with time_stage(self._metrics, "validate"):
+            normalized = [normalize_host(x) for x in hosts]
+            unique = list(dict.fromkeys(host for host, host_error in normalized if not host_error))
+        self._logger.debug(f"Querying {len(unique)} distinct hosts out of {len(hosts)}")
+        if self._metrics:
+            self._metrics.submit_batch_size("request", len(hosts))
+            self._metrics.submit_batch_size("distinct", len(unique))
+        
+        return normalized, unique
+    
+    def prepare_chunk(self, chunk: list[str]) -> tuple[list[QueryResponse], dict[str, list[str]]]:
+        with time_stage(self._metrics, "validate"):
+            return normalize_hosts(chunk)
+    
+    def __submit(self, results: list[QueryResponse]) -> list[QueryResponse]:
+        if self._metrics:
+            self._metrics.submit_resolution(results)
+        return results
+    
+    def answer_local(self, invalid: list[QueryResponse], local_results: list[QueryResponse], spellings: dict[str, list[str]]) -> list[QueryResponse]:
+        return self.__submit(invalid + expand_responses(local_results, spellings))
+    
+    def answer_remote(self, remote_results: list[QueryResponse], fields: list[str], partials: dict[str, HostData], spellings: dict[str, list[str]], answered: set[str]) -> list[QueryResponse]:
+        remote_results = [complete_response(x, fields, partials.get(x.host)) for x in remote_results]
+        answered.update(x.host for x in remote_results)
+        return self.__submit(expand_responses(remote_results, spellings))
+    
+    def answer_failed(self, queue: list[str], answered: set[str], spellings: dict[str, list[str]], message: str) -> list[QueryResponse]:
+        # Headers are already sent, so the hosts that did not make it are reported in-band
+        return self.__submit([QueryResponse.fail(host, message) for x in queue if x not in answered for host in spellings[x]])
+
 class HostResolver:
-    def __init__(self, api: Optional[IPAPI] = None, local_db: Optional[HostDataStore] = None, metrics: Optional[Metrics] = None) -> Self:
+    def __init__(self, api: Optional[Provider] = None, local_db: Optional[HostStore] = None, metrics: Optional[Metrics] = None, cache: Optional[HostCache] = None, batcher: Optional[MicroBatcher] = None, offline_db: Optional[RangeDatabase] = None, prefix_cache: Optional[PrefixCache] = None, refresh_queue: Optional[RefreshQueue] = None) -> Self:
         self._remote_api = api or IPAPI()
         self._local_db = local_db
+        self._batcher = batcher
+        self._tiers = LocalTiers(cache, offline_db, prefix_cache, refresh_queue, metrics)
+        self._inflight = SingleFlight()
         self._logger = logging.getLogger()
         self._metrics = metrics
     
+        if refresh_queue:
+            refresh_queue.start(self.__refresh)
+    
     def query(self, hosts: str | list[str], fields: Optional[list[str]] = None, skip_cache: bool = False) -> QueryResponse | list[QueryResponse]:
         fields = filter_fields(fields or IPAPI_DEFAULT_FIELDS)
         
         if isinstance(hosts, str):
-            result = self.__query_one(hosts, fields, skip_cache)
+            with time_stage(self._metrics, "validate"):
+                host, host_error = normalize_host(hosts)
+            result = QueryResponse.fail(hosts, host_error) if host_error else respell_response(self.__query_one(host, fields, skip_cache), hosts)
         elif isinstance(hosts, list):
             result = self.__query_many(hosts, fields, skip_cache)
         else:
@@ -51,53 +321,110 @@ class HostResolver:
             
         return result
     
+    def __query_local(self, hosts: list[str], fields: list[str], partials: dict[str, HostData]) -> tuple[list[QueryResponse], list[str]]:
+        results = []
+        hosts = self._tiers.query_before_db(hosts, fields, partials, results)
+        if self._local_db and hosts:
+            with time_stage(self._metrics, "local_db"):
+                if len(hosts) == 1:
+                    db_result = self._local_db.get(hosts[0], self._tiers.db_fields(hosts[0], fields, partials))
+                    db_results = {hosts[0]: db_result} if db_result else {}
+                else:
+                    db_results = self._local_db.get_many(hosts, fields)
+                hosts = self._tiers.accept_db(hosts, db_results, fields, partials, results)
+        
+        return results, self._tiers.query_after_db(hosts, fields, results)
+    
+    def __store(self, remote_results: list[QueryResponse], partials: dict[str, HostData], refresh: bool = False):
+        resolved = self._tiers.accept_remote(remote_results, partials)
+        if self._local_db and resolved:
+            with time_stage(self._metrics, "local_db_write"):
+                written = self._local_db.refresh_many(resolved) if refresh else self._local_db.set_many(resolved)
+            self._tiers.check_written(written, len(resolved))
+    
+    def __refresh(self, hosts: list[str]):
+        self._tiers.check_refresh_budget(self._remote_api.rate_limiter)
+        db_results = self._local_db.get_many(hosts) if self._local_db else {}
+        with time_stage(self._metrics, "refresh"):
+            for fields, group in self._tiers.refresh_groups(hosts, db_results).items():
+                refreshed = self._tiers.accept_refresh(self._remote_api.query(group, list(fields)))
+                if self._local_db and refreshed:
+                    self._local_db.refresh_many(refreshed)
+    
     def __query_one(self, host: str, fields: list[str], skip_cache: bool) -> QueryResponse:
-        if self._local_db and not skip_cache:
-            host_error = find_host_errors(host)
-            if host_error:
-                return QueryResponse.fail(host, host_error)
+        partials = {}
+        if (self._tiers.active or self._local_db) and not skip_cache:
+            local_results, _ = self.__query_local([host], fields, partials)
+            if local_results:
+                return local_results[0]
+        
+        partial = partials.get(host)
+        if skip_cache:
+            stored = self._local_db.get(host) if self._local_db else None
+            missing = self._tiers.forced_fields(host, fields, {host: stored} if stored else {})
+        else:
+            missing = missing_fields(partial, fields) if partial else fields
+        # Concurrent misses for the same host and field set share one upstream lookup
+        remote_result = self._inflight.do((host, tuple(missing), skip_cache), lambda: self.__query_remote_one(host, missing, partial, skip_cache))
+        return complete_response(remote_result, fields, partial)
+    
+    def __query_remote_one(self, host: str, fields: list[str], partial: Optional[HostData], refresh: bool) -> QueryResponse:
+        with time_stage(self._metrics, "upstream"):
+            if self._batcher:
+                remote_result = self._batcher.query(host, fields)
+            else:
+                remote_result = self._remote_api.query(host, fields)
             
-            db_result = self._local_db.get(host)
-            if db_result and has_all_fields(db_result, fields):
-                return QueryResponse.success(filter_hostdata(db_result, fields))
+        self.__store([remote_result], {host: partial} if partial else {}, refresh)
+        return remote_result
+    
+    def __query_local_many(self, hosts: list[str], fields: list[str], skip_cache: bool) -> tuple[list[QueryResponse], list[str], dict[str, HostData]]:
+        partials = {}
+        if (self._tiers.active or self._local_db) and not skip_cache:
+            result, queue = self.__query_local(hosts, fields, partials)
+        else:
+            result, queue = [], hosts
             
-        remote_result = self._remote_api.query(host, fields)
-        if remote_result.status == QueryResult.Success and self._local_db:
-            if not self._local_db.set(remote_result.result):
-                self._logger.warn(f"Failed to push host {remote_result.host} to local DB")
+        return result, queue, partials
+    
+    def __upstream_groups(self, hosts: list[str], fields: list[str], partials: dict[str, HostData], skip_cache: bool) -> dict[tuple[str, ...], list[str]]:
+        if not skip_cache:
+            return group_by_missing(hosts, fields, partials)
         
-        return remote_result
+        db_results = self._local_db.get_many(hosts) if self._local_db and hosts else {}
+        return self._tiers.forced_groups(hosts, fields, db_results)
     
     def __query_many(self, hosts: list[str], fields: list[str], skip_cache: bool) -> list[QueryResponse]:
-        queue = []
-        result = []
-        
-        self._logger.debug(f"Querying {len(hosts)} hosts")
-        if self._local_db and not skip_cache:
-            for host in hosts:
-                host_error = find_host_errors(host)
-                if host_error:
-                    result.append(QueryResponse.fail(host, host_error))
-                    continue
-                
-                db_result = self._local_db.get(host)
-                if db_result and has_all_fields(db_result, fields):
-                    result.append(QueryResponse.success(filter_hostdata(db_result, fields)))
-                    continue
-                
-                queue.append(host)
-        else:
-            queue = hosts
-                
-        self._logger.debug(f"Resolved {len(result)} queries locally")
-                
-        remote_results = self._remote_api.query(queue, fields)
-        if self._local_db:
-            for remote_result in remote_results:
-                if remote_result.status != QueryResult.Success:
-                    continue
-                if not self._local_db.set(remote_result.result):
-                    self._logger.warn(f"Failed to push host {remote_result.host} to local DB")
-                    
-        result.extend(remote_results)
-        return result
\ No newline at end of file
+        normalized, unique = self._tiers.prepare_many(hosts)
+        local_results, queue, partials = self.__query_local_many(unique, fields, skip_cache)
+        self._logger.debug(f"Resolved {len(local_results)} queries locally")
+        
+        resolved = {x.host: x for x in local_results}
+        for missing, group in self.__upstream_groups(queue, fields, partials, skip_cache).items():
+            with time_stage(self._metrics, "upstream"):
+                remote_results = self._remote_api.query(group, list(missing))
+            self.__store(remote_results, partials, skip_cache)
+            resolved.update(zip(group, (complete_response(x, fields, partials.get(x.host)) for x in remote_results)))
+        
+        return answer_many(hosts, normalized, resolved)
+    
+    def query_stream(self, hosts: Iterable[str], fields: Optional[list[str]] = None, skip_cache: bool = False, chunk_size: Optional[int] = None) -> Generator[QueryResponse, None, None]:
+        fields = filter_fields(fields or IPAPI_DEFAULT_FIELDS)
+        
+        # Input is consumed in chunks so that memory use does not grow with the request size
+        for chunk in iter_chunks(hosts, chunk_size or DS_BULK_CHUNK_SIZE):
+            invalid, spellings = self._tiers.prepare_chunk(chunk)
+            local_results, queue, partials = self.__query_local_many(list(spellings), fields, skip_cache)
+            yield from self._tiers.answer_local(invalid, local_results, spellings)
+            
+            answered = set()
+            try:
+                for missing, group in self.__upstream_groups(queue, fields, partials, skip_cache).items():
+                    for remote_results in self._remote_api.query_stream(group, list(missing)):
+                        self.__store(remote_results, partials, skip_cache)
+                        yield from self._tiers.answer_remote(remote_results, fields, partials, spellings, answered)
+            except RateLimitExceeded:
+                yield from self._tiers.answer_failed(queue, answered, spellings, "upstream rate limit exceeded")
+            except Exception:
+                self._logger.exception("Upstream lookup failed while streaming %d hosts", len(queue) - len(answered))
+                yield from self._tiers.answer_failed(queue, answered, spellings, "upstream error")
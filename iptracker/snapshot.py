@@ -0,0 +1,160 @@
+import argparse
+import datetime
+import glob
+import gzip
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+from typing import TYPE_CHECKING, Generator, Iterable, Optional, Self
+from iptracker.constants import SNAPSHOT_BATCH_SIZE, SNAPSHOT_COMPRESS_LEVEL
+from iptracker.host import HostData, HostDataSource
+from iptracker.streaming import iter_chunks
+
+if TYPE_CHECKING:
+    # Stores depend on this module for their snapshot entry points
+    from iptracker.store import HostStore
+
+# Gzipped NDJSON: a header line, then one {"host", "created_at", "fields"} object per record.
+# created_at is a UNIX timestamp, so records keep their age and expire on schedule after an import.
+_FORMAT = "iptracker-snapshot"
+_VERSION = 1
+_encode = json.JSONEncoder(separators=(",", ":"), default=str).encode
+
+def hostdata_to_line(host_data: HostData) -> str:
+    fields = host_data.fields
+    return _encode({"host": host_data.host, "created_at": host_data.fetched_at.timestamp(), "fields": dict(zip(fields.names, fields.row))}) + "\n"
+
+def write_snapshot(path: str, records: Iterable[HostData], compress_level: Optional[int] = None) -> int:
+    # Written next to the target and renamed, so readers never see a partial file
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    count = 0
+    try:
+        with gzip.open(temp_path, "wt", encoding="utf-8", compresslevel=compress_level or SNAPSHOT_COMPRESS_LEVEL) as f:
+            f.write(_encode({"format": _FORMAT, "version": _VERSION, "exported_at": time.time()}) + "\n")
+            for chunk in iter_chunks(records, SNAPSHOT_BATCH_SIZE):
+                f.write("".join(hostdata_to_line(x) for x in chunk))
+                count += len(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return count
+
+def read_snapshot(path: str, max_age: Optional[float] = None) -> Generator[HostData, None, None]:
+    # Records older than max_age seconds are skipped, they would only expire again right away
+    cutoff = time.time() - max_age if max_age else None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("format") != _FORMAT:
+            raise ValueError(f"Not an iptracker snapshot: {path}")
+        if header.get("version") != _VERSION:
+            raise ValueError(f"Unsupported snapshot version: {header.get('version')}")
+
+        for line in f:
+            record = json.loads(line)
+            created_at = record["created_at"]
+            if cutoff is not None and created_at < cutoff:
+                continue
+
+            yield HostData(record["host"], datetime.datetime.fromtimestamp(created_at, datetime.UTC), HostDataSource.Local, record["fields"])
+
+def load_snapshot(path: str, limit: Optional[int] = None, max_age: Optional[float] = None) -> list[HostData]:
+    # Snapshots of the memory cache list the most recently used hosts first, so a limit keeps the hottest
+    return list(itertools.islice(read_snapshot(path, max_age), limit))
+
+def merge_hottest(snapshots: list[list[HostData]]) -> Generator[HostData, None, None]:
+    # Takes the hottest remaining record of each snapshot in turn, a host is only kept the first time it is seen
+    seen = set()
+    for records in itertools.zip_longest(*snapshots):
+        for x in records:
+            if x is not None and x.host not in seen:
+                seen.add(x.host)
+                yield x
+
+class CacheSnapshots:
+    # Each process writes its memory cache to its own file, path.<pid>, so gunicorn workers
+    # sharing the path do not overwrite each other. Starting processes merge every file, and
+    # the files a process merged are removed once it has written its own, which carries on
+    # whatever is still hot from them.
+    def __init__(self, path: str) -> Self:
+        self._path = path
+        self._logger = logging.getLogger()
+        self._loaded: dict[str, float] = {}
+
+    def __files(self) -> list[str]:
+        workers = [x for x in glob.glob(f"{glob.escape(self._path)}.*") if x.rsplit(".", 1)[1].isdigit()]
+        return ([self._path] if os.path.exists(self._path) else []) + sorted(workers)
+
+    def load(self, limit: Optional[int] = None, max_age: Optional[float] = None) -> list[HostData]:
+        snapshots = []
+        for path in self.__files():
+            try:
+                modified_at = os.path.getmtime(path)
+                snapshots.append(load_snapshot(path, limit, max_age))
+            except FileNotFoundError:
+                # Removed by a process that merged it and exited in the meantime
+                continue
+            except (OSError, EOFError, ValueError) as e:
+                self._logger.warning(f"Skipping unreadable cache snapshot {path}: {e}")
+                continue
+
+            # A plain file at the path itself, e.g. a database export, is only ever read
+            if path != self._path:
+                self._loaded[path] = modified_at
+
+        return list(itertools.islice(merge_hottest(snapshots), limit))
+
+    def write(self, records: Iterable[HostData]) -> int:
+        count = write_snapshot(f"{self._path}.{os.getpid()}", records)
+        for path, modified_at in self._loaded.items():
+            try:
+                # A file written again since it was merged belongs to a process that has not read ours
+                if os.path.getmtime(path) == modified_at:
+                    os.remove(path)
+            except OSError:
+                pass
+
+        return count
+
+def open_store(mongo_uri: Optional[str], sqlite_path: Optional[str]) -> "HostStore":
+    from iptracker.config import DS_BACKEND, MONGO_URI, SQLITE_PATH, CACHE_EXPIRATION_TIME
+    if sqlite_path or (not mongo_uri and DS_BACKEND == "sqlite"):
+        from iptracker.sqlite_db import SQLiteHostDataStore
+        return SQLiteHostDataStore(sqlite_path or SQLITE_PATH, CACHE_EXPIRATION_TIME)
+
+    if not (mongo_uri or MONGO_URI):
+        raise ValueError("No database configured, pass --mongo-uri or --sqlite-path or set MONGO_URI")
+
+    from iptracker.db import HostDataStore
+    return HostDataStore(mongo_uri or MONGO_URI, CACHE_EXPIRATION_TIME)
+
+def main(args: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m iptracker.snapshot", description="Export and import local database snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, description in (("export", "Write every live record to a snapshot file"), ("import", "Load a snapshot file into the database")):
+        command = commands.add_parser(name, help=description)
+        command.add_argument("path")
+        command.add_argument("--mongo-uri", help="Defaults to MONGO_URI")
+        command.add_argument("--sqlite-path", help="Use an SQLite database instead of MongoDB")
+    args = parser.parse_args(args)
+
+    store = open_store(args.mongo_uri, args.sqlite_path)
+    start_time = time.perf_counter()
+    if args.command == "export":
+        count = store.export_snapshot(args.path)
+        print(f"Exported {count} records to {args.path} in {time.perf_counter() - start_time:.1f} seconds")
+    else:
+        count = store.import_snapshot(args.path)
+        print(f"Imported {count} records from {args.path} in {time.perf_counter() - start_time:.1f} seconds")
+    store.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
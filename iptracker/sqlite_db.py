@@ -0,0 +1,207 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional, Self
+from iptracker.constants import DS_CACHE_EXPIRATION, DS_SIZE_REFRESH_INTERVAL, SQLITE_BULK_CHUNK_SIZE, SQLITE_BUSY_TIMEOUT, SQLITE_PURGE_INTERVAL
+from iptracker.host import HostData, HostDataSource
+from iptracker.metrics import Metrics
+from iptracker.store import HostStore
+from iptracker.writer import HostDataWriter
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    fields TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hosts_created_at ON hosts (created_at);
+"""
+
+# Same merge as the MongoDB store: fields are patched in one by one and created_at keeps the
+# oldest fetch time. A record that has expired but not been purged yet is replaced instead,
+# as it would have been deleted by MongoDB. json_patch drops null values, which ip-api does not send.
+_UPSERT = """
+INSERT INTO hosts (host, created_at, fields) VALUES (?1, ?2, ?3)
+ON CONFLICT (host) DO UPDATE SET
+    created_at = iif(created_at < ?4, excluded.created_at, min(created_at, excluded.created_at)),
+    fields = iif(created_at < ?4, excluded.fields, json_patch(fields, excluded.fields))
+"""
+
+_REFRESH = """
+INSERT INTO hosts (host, created_at, fields) VALUES (?1, ?2, ?3)
+ON CONFLICT (host) DO UPDATE SET
+    created_at = excluded.created_at,
+    fields = iif(created_at < ?4, excluded.fields, json_patch(fields, excluded.fields))
+"""
+
+def row_to_hostdata(row: tuple[str, float, str], fields: Optional[list[str]]) -> HostData:
+    host, created_at, stored_fields = row
+    stored_fields = json.loads(stored_fields)
+    if fields is not None:
+        stored_fields = {k:v for k,v in stored_fields.items() if k in fields}
+
+    return HostData(host, datetime.datetime.fromtimestamp(created_at, datetime.UTC), HostDataSource.Local, stored_fields)
+
+def hostdata_to_row(host_data: HostData) -> tuple[str, float, str]:
+    return host_data.host, host_data.fetched_at.timestamp(), json.dumps(dict(host_data.fields), separators=(",", ":"), default=str)
+
+class SQLiteHostDataStore(HostStore):
+    def __init__(self, path: str, cache_expiration_seconds: Optional[int] = None, metrics: Optional[Metrics] = None, bulk_chunk_size: Optional[int] = None, write_behind: bool = False, write_batch_size: Optional[int] = None, write_flush_interval: Optional[float] = None, defer_setup: bool = False) -> Self:
+        self._path = path
+        self._expiration = cache_expiration_seconds or DS_CACHE_EXPIRATION
+        self._metrics = metrics
+        # SQLite limits the number of parameters in a single statement
+        self._bulk_chunk_size = min(bulk_chunk_size or SQLITE_BULK_CHUNK_SIZE, SQLITE_BULK_CHUNK_SIZE)
+        self._local = threading.local()
+        self._size_updated_at = 0
+        self._purged_at = 0
+        self._writer = None
+
+        with self.__connection() as connection:
+            connection.executescript(_SCHEMA)
+        if not defer_setup:
+            self.setup()
+
+        if write_behind:
+            self._writer = HostDataWriter(
+                self.__write_many,
+                write_batch_size,
+                write_flush_interval,
+                on_idle=self.__idle
+            )
+
+    def __connection(self) -> sqlite3.Connection:
+        # Connections cannot be shared between threads, WAL lets them read while another one writes
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=SQLITE_BUSY_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+
+        return connection
+
+    def __cutoff(self) -> float:
+        return time.time() - self._expiration
+
+    def __update_metrics(self, force: bool = False):
+        if not self._metrics:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._size_updated_at < DS_SIZE_REFRESH_INTERVAL:
+            return
+
+        self._size_updated_at = now
+        self._metrics.submit_db_size(self.size())
+
+    def __purge(self, force: bool = False):
+        # Reads already skip expired records, deleting them only reclaims space
+        now = time.monotonic()
+        if not force and now - self._purged_at < SQLITE_PURGE_INTERVAL:
+            return
+
+        self._purged_at = now
+        with self.__connection() as connection:
+            connection.execute("DELETE FROM hosts WHERE created_at < ?", (self.__cutoff(),))
+
+    def __idle(self):
+        self.__purge()
+        self.__update_metrics()
+
+    def setup(self):
+        # Counting rows scans the table, which is why it is not done when the store is created
+        self.__update_metrics(force=True)
+
+    def ping(self, timeout: Optional[float] = None):
+        self.__connection().execute("SELECT 1")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        if self._writer:
+            return self._writer.flush(timeout)
+
+        return True
+
+    def close(self, timeout: Optional[float] = None):
+        if self._writer:
+            self._writer.close(timeout)
+
+    def size(self) -> int:
+        return self.__connection().execute("SELECT count(*) FROM hosts").fetchone()[0]
+
+    @property
+    def expiration(self) -> int:
+        return self._expiration
+
+    def scan(self) -> Iterator[HostData]:
+        rows = self.__connection().execute("SELECT host, created_at, fields FROM hosts WHERE created_at >= ?", (self.__cutoff(),))
+        for row in rows:
+            yield row_to_hostdata(row, None)
+
+    def get(self, address: str, fields: Optional[list[str]] = None) -> Optional[HostData]:
+        row = self.__connection().execute(
+            "SELECT host, created_at, fields FROM hosts WHERE host = ? AND created_at >= ?",
+            (address, self.__cutoff())
+        ).fetchone()
+        if not row:
+            return None
+
+        return row_to_hostdata(row, fields)
+
+    def get_many(self, addresses: list[str], fields: Optional[list[str]] = None) -> dict[str, HostData]:
+        results = {}
+        cutoff = self.__cutoff()
+        connection = self.__connection()
+        addresses = list(dict.fromkeys(addresses))
+        for i in range(0, len(addresses), self._bulk_chunk_size):
+            chunk = addresses[i:i + self._bulk_chunk_size]
+            rows = connection.execute(
+                f"SELECT host, created_at, fields FROM hosts WHERE host IN ({','.join('?' * len(chunk))}) AND created_at >= ?",
+                (*chunk, cutoff)
+            )
+            for row in rows:
+                results[row[0]] = row_to_hostdata(row, fields)
+
+        return results
+
+    def __write_many(self, host_data: list[HostData], refresh: bool = False) -> int:
+        # One transaction per call, a single commit is far cheaper than one per record
+        cutoff = self.__cutoff()
+        with self.__connection() as connection:
+            connection.executemany(_REFRESH if refresh else _UPSERT, [(*hostdata_to_row(x), cutoff) for x in host_data])
+
+        self.__purge()
+        self.__update_metrics()
+        return len(host_data)
+
+    def set_many(self, host_data: list[HostData]) -> int:
+        if not host_data:
+            return 0
+
+        if self._writer:
+            for x in host_data:
+                self._writer.submit(x)
+            return len(host_data)
+
+        return self.__write_many(host_data)
+
+    def import_many(self, host_data: list[HostData]) -> int:
+        # Upserts keep the oldest fetch time, so imported records keep their age
+        if not host_data:
+            return 0
+
+        return self.__write_many(host_data)
+
+    def refresh_many(self, host_data: list[HostData]) -> int:
+        if not host_data:
+            return 0
+
+        # Queued writes for the same hosts are older, writing around them would let them undo the refresh
+        if self._writer:
+            for x in host_data:
+                self._writer.submit(x, refresh=True)
+            return len(host_data)
+
+        return self.__write_many(host_data, refresh=True)
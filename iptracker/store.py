@@ -0,0 +1,153 @@
+import asyncio
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional, Self
+from iptracker.constants import SNAPSHOT_BATCH_SIZE
+from iptracker.host import HostData
+from iptracker.snapshot import read_snapshot, write_snapshot
+from iptracker.streaming import iter_chunks
+
+class HostStore(ABC):
+    # Writes merge fields into the stored record one by one. The record keeps the oldest
+    # fetch time, except on refreshes, which replace it. Records expire once their fetch
+    # time is older than the store's expiration time.
+
+    @abstractmethod
+    def get(self, address: str, fields: Optional[list[str]] = None) -> Optional[HostData]:
+        ...
+
+    @abstractmethod
+    def get_many(self, addresses: list[str], fields: Optional[list[str]] = None) -> dict[str, HostData]:
+        ...
+
+    @abstractmethod
+    def set_many(self, host_data: list[HostData]) -> int:
+        ...
+
+    @abstractmethod
+    def refresh_many(self, host_data: list[HostData]) -> int:
+        ...
+
+    @abstractmethod
+    def size(self) -> int:
+        ...
+
+    @property
+    @abstractmethod
+    def expiration(self) -> int:
+        ...
+
+    @abstractmethod
+    def scan(self) -> Iterator[HostData]:
+        # Every record that has not expired, in no particular order
+        ...
+
+    @abstractmethod
+    def import_many(self, host_data: list[HostData]) -> int:
+        # Bulk load that keeps fetch times, existing records are merged like any other write
+        ...
+
+    def export_snapshot(self, path: str) -> int:
+        return write_snapshot(path, self.scan())
+
+    def import_snapshot(self, path: str, batch_size: Optional[int] = None) -> int:
+        imported = 0
+        for chunk in iter_chunks(read_snapshot(path, self.expiration), batch_size or SNAPSHOT_BATCH_SIZE):
+            imported += self.import_many(chunk)
+
+        return imported
+
+    def set(self, host_data: HostData) -> bool:
+        return self.set_many([host_data]) == 1
+
+    def setup(self):
+        # One-time schema setup and first size estimate, may be run in the background
+        pass
+
+    def ping(self, timeout: Optional[float] = None):
+        # Raises when the backend cannot be reached
+        pass
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # Waits for queued writes to land, unlike close() the store stays usable.
+        # False when they did not within the timeout.
+        return True
+
+    def close(self, timeout: Optional[float] = None):
+        pass
+
+class AsyncHostStore(ABC):
+    # The HostStore contract for the asyncio stack, with the same write semantics
+
+    @abstractmethod
+    async def get(self, address: str, fields: Optional[list[str]] = None) -> Optional[HostData]:
+        ...
+
+    @abstractmethod
+    async def get_many(self, addresses: list[str], fields: Optional[list[str]] = None) -> dict[str, HostData]:
+        ...
+
+    @abstractmethod
+    async def set_many(self, host_data: list[HostData]) -> int:
+        ...
+
+    @abstractmethod
+    async def refresh_many(self, host_data: list[HostData]) -> int:
+        ...
+
+    @abstractmethod
+    async def size(self) -> int:
+        ...
+
+    @property
+    @abstractmethod
+    def expiration(self) -> int:
+        ...
+
+    async def set(self, host_data: HostData) -> bool:
+        return await self.set_many([host_data]) == 1
+
+    async def setup(self):
+        pass
+
+    async def ping(self, timeout: Optional[float] = None):
+        pass
+
+    async def close(self):
+        pass
+
+class ThreadedHostStore(AsyncHostStore):
+    # Runs a blocking store on worker threads, e.g. SQLite, which has no asyncio driver
+    def __init__(self, store: HostStore) -> Self:
+        self._store = store
+
+    @property
+    def store(self) -> HostStore:
+        return self._store
+
+    @property
+    def expiration(self) -> int:
+        return self._store.expiration
+
+    async def get(self, address: str, fields: Optional[list[str]] = None) -> Optional[HostData]:
+        return await asyncio.to_thread(self._store.get, address, fields)
+
+    async def get_many(self, addresses: list[str], fields: Optional[list[str]] = None) -> dict[str, HostData]:
+        return await asyncio.to_thread(self._store.get_many, addresses, fields)
+
+    async def set_many(self, host_data: list[HostData]) -> int:
+        return await asyncio.to_thread(self._store.set_many, host_data)
+
+    async def refresh_many(self, host_data: list[HostData]) -> int:
+        return await asyncio.to_thread(self._store.refresh_many, host_data)
+
+    async def size(self) -> int:
+        return await asyncio.to_thread(self._store.size)
+
+    async def setup(self):
+        await asyncio.to_thread(self._store.setup)
+
+    async def ping(self, timeout: Optional[float] = None):
+        await asyncio.to_thread(self._store.ping, timeout)
+
+    async def close(self):
+        await asyncio.to_thread(self._store.close)
@@ -0,0 +1,113 @@
+import codecs
+import json
+from typing import Any, AsyncGenerator, AsyncIterable, Generator, Iterable, Self
+
+class JSONArrayParser:
+    def __init__(self) -> Self:
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._state = "start"
+
+    def feed(self, data: bytes) -> list[Any]:
+        self._buffer += self._text_decoder.decode(data)
+        return self.__parse(final=False)
+
+    def close(self) -> list[Any]:
+        self._buffer += self._text_decoder.decode(b"", final=True)
+        values = self.__parse(final=True)
+        if self._state != "end":
+            raise ValueError("Unexpected end of JSON array")
+
+        return values
+
+    def __parse(self, final: bool) -> list[Any]:
+        values = []
+        buffer = self._buffer
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if self._state == "start":
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                pos += 1
+                self._state = "first"
+            elif self._state == "first":
+                if buffer[pos] == "]":
+                    pos += 1
+                    self._state = "end"
+                else:
+                    self._state = "value"
+            elif self._state == "value":
+                try:
+                    value, end = self._decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError as e:
+                    if final:
+                        raise ValueError(f"Invalid JSON array element: {e}")
+                    break
+
+                # A value not yet followed by a delimiter (e.g. a number cut mid-chunk) may be incomplete
+                if not final and (end == len(buffer) or buffer[end] not in " \t\r\n,]"):
+                    break
+
+                values.append(value)
+                pos = end
+                self._state = "separator"
+            elif self._state == "separator":
+                if buffer[pos] == ",":
+                    self._state = "value"
+                elif buffer[pos] == "]":
+                    self._state = "end"
+                else:
+                    raise ValueError("Expected ',' or ']' in JSON array")
+                pos += 1
+            else:
+                raise ValueError("Unexpected data after JSON array")
+
+        self._buffer = buffer[pos:]
+        return values
+
+def iter_json_array(chunks: Iterable[bytes]) -> Generator[Any, None, None]:
+    parser = JSONArrayParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+async def aiter_json_array(chunks: AsyncIterable[bytes]) -> AsyncGenerator[Any, None]:
+    parser = JSONArrayParser()
+    async for chunk in chunks:
+        for value in parser.feed(chunk):
+            yield value
+    for value in parser.close():
+        yield value
+
+def iter_chunks(data: Iterable[Any], size: int) -> Generator[list[Any], None, None]:
+    chunk = []
+    for x in data:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+async def aiter_chunks(data: Iterable[Any] | AsyncIterable[Any], size: int) -> AsyncGenerator[list[Any], None]:
+    if not hasattr(data, "__aiter__"):
+        for chunk in iter_chunks(data, size):
+            yield chunk
+        return
+
+    chunk = []
+    async for x in data:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
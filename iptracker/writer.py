@@ -0,0 +1,126 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional, Self
+from iptracker.constants import DS_WRITE_BATCH_SIZE, DS_WRITE_FLUSH_INTERVAL, DS_WRITE_QUEUE_SIZE
+from iptracker.host import HostData, merge_hostdata
+
+def merge_write(previous: tuple[HostData, bool], host_data: HostData, refresh: bool) -> tuple[HostData, bool]:
+    # Same result as applying both writes in order. A refresh replaces the fetch time,
+    # a regular write keeps the older one and leaves an earlier refresh in place.
+    base, refreshed = previous
+    if refresh:
+        return HostData(host_data.host, host_data.fetched_at, host_data.source, {**base.fields, **host_data.fields}), True
+
+    return merge_hostdata(base, host_data), refreshed
+
+class HostDataWriter:
+    def __init__(self, flush: Callable[[list[HostData], bool], Any], batch_size: Optional[int] = None, flush_interval: Optional[float] = None, max_queue_size: Optional[int] = None, on_idle: Optional[Callable[[], Any]] = None) -> Self:
+        self._logger = logging.getLogger()
+        self._flush = flush
+        self._on_idle = on_idle
+        self._batch_size = batch_size or DS_WRITE_BATCH_SIZE
+        self._flush_interval = flush_interval or DS_WRITE_FLUSH_INTERVAL
+        # Records, flush markers, and None once the writer is closed
+        self._queue: queue.Queue[Optional[tuple[HostData, bool] | threading.Event]] = queue.Queue(max_queue_size or DS_WRITE_QUEUE_SIZE)
+        self._closed = False
+        self._thread = threading.Thread(target=self.__run, name="iptracker-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, host_data: HostData, refresh: bool = False):
+        if self._closed:
+            raise RuntimeError("Writer is closed")
+
+        # Blocks when the queue is full, which throttles callers down to the flush rate.
+        # Refreshes share the queue, so an older write can never land after them.
+        self._queue.put((host_data, refresh))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        # Waits until everything submitted so far is written, the writer stays open
+        if self._closed:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        return flushed.wait(timeout)
+
+    def close(self, timeout: Optional[float] = None):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            self._logger.warning("Writer did not drain within %s seconds, %d records pending", timeout, self._queue.qsize())
+
+    def __write(self, batch: dict[str, tuple[HostData, bool]]):
+        for refresh in (False, True):
+            records = [x for x, refreshed in batch.values() if refreshed == refresh]
+            if not records:
+                continue
+
+            try:
+                self._flush(records, refresh)
+            except Exception:
+                self._logger.exception("Failed to flush %d records to local DB", len(records))
+
+    def __collect(self) -> tuple[dict[str, tuple[HostData, bool]], Optional[threading.Event], bool]:
+        # Writes for the same host within a batch are merged into one
+        batch = {}
+        deadline = time.monotonic() + self._flush_interval
+        while len(batch) < self._batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if item is None:
+                return batch, None, True
+            if isinstance(item, threading.Event):
+                # Everything queued before the marker is in this batch
+                return batch, item, False
+
+            host_data, refresh = item
+            previous = batch.get(host_data.host)
+            batch[host_data.host] = merge_write(previous, host_data, refresh) if previous else item
+
+        return batch, None, False
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            batch, flushed, stopping = self.__collect()
+            if batch:
+                self.__write(batch)
+            elif self._on_idle and not flushed:
+                try:
+                    self._on_idle()
+                except Exception:
+                    self._logger.exception("Writer idle callback failed")
+
+            if flushed:
+                flushed.set()
+
+        # Drain anything submitted concurrently with close()
+        remaining = {}
+        flushed = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if isinstance(item, threading.Event):
+                flushed.append(item)
+            elif item is not None:
+                host_data, refresh = item
+                previous = remaining.get(host_data.host)
+                remaining[host_data.host] = merge_write(previous, host_data, refresh) if previous else item
+
+        if remaining:
+            self.__write(remaining)
+        for x in flushed:
+            x.set()
@@ -0,0 +1,32 @@
+import datetime
+import mongomock
+import pytest
+from iptracker.db import HostDataStore
+from iptracker.host import HostData, HostDataSource
+from iptracker.sqlite_db import SQLiteHostDataStore
+
+def record(host: str, age: float = 0, **fields) -> HostData:
+    # A record fetched upstream `age` seconds ago
+    fetched_at = datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=age)
+    return HostData(host, fetched_at, HostDataSource.Remote, fields)
+
+def age(host_data: HostData) -> float:
+    return (datetime.datetime.now(datetime.UTC) - host_data.fetched_at).total_seconds()
+
+@pytest.fixture(params=["mongodb", "sqlite"])
+def make_store(request, tmp_path):
+    # Every store made in a test shares one database, like workers of one deployment
+    client = mongomock.MongoClient("mongodb://localhost/iptracker")
+    stores = []
+
+    def make(**kwargs):
+        if request.param == "mongodb":
+            store = HostDataStore(client, **kwargs)
+        else:
+            store = SQLiteHostDataStore(str(tmp_path / "hosts.sqlite3"), **kwargs)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store.close()
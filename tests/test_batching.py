@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+import pytest
+from iptracker.api import AsyncProvider, Provider, QueryResponse, dict_to_response
+from iptracker.batching import AsyncMicroBatcher, MicroBatcher, SingleFlight
+
+class Interrupted(BaseException):
+    # Stands in for anything that stops a thread without being an upstream error
+    pass
+
+class RecordingProvider(Provider):
+    def __init__(self):
+        self.calls: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return "recording"
+
+    @property
+    def rate_limiter(self):
+        return None
+
+    def query(self, hosts: str | list[str], fields: Optional[list[str]] = None) -> QueryResponse | list[QueryResponse]:
+        with self._lock:
+            self.calls.append(list(hosts))
+        return [dict_to_response({"status": "success", "query": x, "country": "Poland"}) for x in hosts]
+
+    def query_stream(self, hosts: list[str], fields: Optional[list[str]] = None):
+        yield self.query(hosts, fields)
+
+def run_concurrently(count: int, target) -> list:
+    results = [None] * count
+    def run(i: int):
+        try:
+            results[i] = target(i)
+        except BaseException as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    # Followers have to arrive while the leader is still running
+    threading.Timer(0.2, release.set).start()
+    results = run_concurrently(5, lambda i: flight.do("key", call))
+
+    assert calls == [1]
+    assert results == ["result"] * 5
+
+def test_single_flight_shares_the_exception():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+    def call():
+        calls.append(1)
+        release.wait(5)
+        raise ValueError("upstream failed")
+
+    threading.Timer(0.2, release.set).start()
+    results = run_concurrently(5, lambda i: flight.do("key", call))
+
+    assert calls == [1]
+    assert all(isinstance(x, ValueError) for x in results)
+    assert len({id(x) for x in results}) == 1
+
+def test_single_flight_forgets_finished_calls():
+    flight = SingleFlight()
+    def fail():
+        raise ValueError("first")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+
+    assert flight.do("key", lambda: "second") == "second"
+
+def test_micro_batcher_flushes_after_window():
+    provider = RecordingProvider()
+    batcher = MicroBatcher(provider, window=0.3, max_size=100)
+
+    start_time = time.monotonic()
+    results = run_concurrently(3, lambda i: batcher.query(f"8.8.8.{i}", ["country"]))
+    elapsed = time.monotonic() - start_time
+
+    assert [x.host for x in results] == ["8.8.8.0", "8.8.8.1", "8.8.8.2"]
+    assert len(provider.calls) == 1
+    assert sorted(provider.calls[0]) == ["8.8.8.0", "8.8.8.1", "8.8.8.2"]
+    assert elapsed >= 0.25
+
+def test_micro_batcher_flushes_when_full():
+    provider = RecordingProvider()
+    batcher = MicroBatcher(provider, window=10, max_size=4)
+
+    start_time = time.monotonic()
+    results = run_concurrently(8, lambda i: batcher.query(f"8.8.8.{i}", ["country"]))
+    elapsed = time.monotonic() - start_time
+
+    assert [x.host for x in results] == [f"8.8.8.{i}" for i in range(8)]
+    assert sorted(len(x) for x in provider.calls) == [4, 4]
+    assert elapsed < 5
+
+def test_micro_batcher_reports_missing_hosts():
+    class PartialProvider(RecordingProvider):
+        def query(self, hosts, fields=None):
+            return super().query(hosts[:1], fields)
+
+    batcher = MicroBatcher(PartialProvider(), window=0.2, max_size=2)
+    results = run_concurrently(2, lambda i: batcher.query(f"8.8.8.{i}", ["country"]))
+
+    assert sorted(x.status.name for x in results) == ["Fail", "Success"]
+
+def test_micro_batcher_followers_do_not_outlive_the_leader():
+    class InterruptedProvider(RecordingProvider):
+        interrupt = True
+
+        def query(self, hosts, fields=None):
+            results = super().query(hosts, fields)
+            if self.interrupt:
+                raise Interrupted()
+            return results
+
+    provider = InterruptedProvider()
+    batcher = MicroBatcher(provider, window=0.3, max_size=100)
+    results = run_concurrently(3, lambda i: batcher.query(f"8.8.8.{i}", ["country"]))
+
+    assert len(provider.calls) == 1
+    assert sorted(type(x).__name__ for x in results) == ["Interrupted", "RuntimeError", "RuntimeError"]
+
+    # The abandoned batch is not joined by later requests
+    provider.interrupt = False
+    assert batcher.query("8.8.8.8", ["country"]).host == "8.8.8.8"
+
+def test_async_micro_batcher_followers_do_not_outlive_the_batch_task():
+    class CancelledProvider(AsyncProvider):
+        name = "cancelled"
+        rate_limiter = None
+
+        async def query(self, hosts, fields=None):
+            raise asyncio.CancelledError()
+
+        async def query_stream(self, hosts, fields=None):
+            yield []
+
+    async def run():
+        batcher = AsyncMicroBatcher(CancelledProvider(), window=0.1, max_size=100)
+        return await asyncio.wait_for(
+            asyncio.gather(*(batcher.query(f"8.8.8.{i}", ["country"]) for i in range(3)), return_exceptions=True),
+            5
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(x, RuntimeError) for x in results)
@@ -0,0 +1,48 @@
+import mongomock
+import pytest
+from iptracker.db import HostDataStore
+from tests.conftest import age, record
+
+@pytest.fixture
+def store():
+    return HostDataStore(mongomock.MongoClient("mongodb://localhost/iptracker"), 3600, bulk_chunk_size=2)
+
+def test_fields_are_merged_one_by_one(store):
+    store.set_many([record("8.8.8.8", 100, country="Poland", city="Warsaw")])
+    store.set_many([record("8.8.8.8", 0, isp="ISP", city="Krakow")])
+
+    result = store.get("8.8.8.8")
+    assert dict(result.fields) == {"country": "Poland", "city": "Krakow", "isp": "ISP"}
+
+def test_record_keeps_the_oldest_fetch_time(store):
+    # A record is only as fresh as its oldest field
+    store.set_many([record("8.8.8.8", 0, country="Poland")])
+    store.set_many([record("8.8.8.8", 300, isp="ISP")])
+    assert 295 < age(store.get("8.8.8.8")) < 305
+
+    store.set_many([record("8.8.8.8", 0, city="Warsaw")])
+    assert 295 < age(store.get("8.8.8.8")) < 305
+
+def test_refresh_replaces_the_fetch_time(store):
+    store.set_many([record("8.8.8.8", 300, country="Poland", isp="Old ISP")])
+    store.refresh_many([record("8.8.8.8", 0, isp="New ISP")])
+
+    result = store.get("8.8.8.8")
+    assert dict(result.fields) == {"country": "Poland", "isp": "New ISP"}
+    assert age(result) < 5
+
+def test_get_returns_only_the_requested_fields(store):
+    store.set_many([record("8.8.8.8", country="Poland", city="Warsaw")])
+
+    assert dict(store.get("8.8.8.8", ["city", "zip"]).fields) == {"city": "Warsaw"}
+    # Names MongoDB would read as a path or an operator are skipped
+    assert dict(store.get("8.8.8.8", ["city.x", "$where"]).fields) == {}
+    assert store.get("1.1.1.1") is None
+
+def test_get_many_reads_in_chunks(store):
+    hosts = [f"8.8.8.{i}" for i in range(5)]
+    assert store.set_many([record(x, country="Poland") for x in hosts]) == 5
+
+    results = store.get_many(hosts + ["1.1.1.1", hosts[0]], ["country"])
+    assert sorted(results) == hosts
+    assert all(dict(x.fields) == {"country": "Poland"} for x in results.values())
@@ -0,0 +1,16 @@
+import pytest
+from iptracker.encoder import negotiate_stream
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, False),
+    ("", False),
+    ("*/*", False),
+    ("application/json", False),
+    ("application/x-ndjson", True),
+    ("application/json, application/x-ndjson;q=0.1", False),
+    ("application/x-ndjson, application/json;q=0.5", True),
+    ("application/json;q=0.2, application/x-ndjson;q=0.9", True),
+    ("text/html, */*;q=0.8", False),
+])
+def test_negotiate_stream(accept, expected):
+    assert negotiate_stream(accept) == expected
@@ -0,0 +1,164 @@
+import time
+import mongomock
+import pytest
+from iptracker.api import QueryResponse
+from iptracker.jobs import JobRunner, JobStore, JobTooLarge
+from iptracker.ratelimit import RateLimitExceeded
+from tests.conftest import record
+
+HOSTS = [f"8.8.8.{i}" for i in range(5)]
+
+@pytest.fixture
+def client():
+    return mongomock.MongoClient("mongodb://localhost/iptracker")
+
+@pytest.fixture
+def jobs(client):
+    return JobStore(client, chunk_size=2, max_size=10, lease_time=60, max_attempts=3)
+
+class FakeResolver:
+    def __init__(self, fail_with: type[Exception] | None = None):
+        self.fail_with = fail_with
+        self.calls = 0
+
+    def query(self, hosts, fields=None, skip_cache=False):
+        self.calls += 1
+        if self.fail_with is RateLimitExceeded:
+            raise RateLimitExceeded(0.01)
+        if self.fail_with:
+            raise self.fail_with("upstream failed")
+        return [QueryResponse.success(record(x, country="Poland")) for x in hosts]
+
+def wait_until_done(jobs: JobStore, job_id: str, timeout: float = 5) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get(job_id)
+        if job["status"] == "done":
+            return job
+        time.sleep(0.02)
+
+    raise AssertionError(f"Job did not finish: {jobs.get(job_id)}")
+
+def test_create_stores_hosts_in_chunks(jobs, client):
+    job = jobs.create(iter(HOSTS), ["country"])
+
+    assert job["status"] == "pending"
+    assert job["total"] == 5
+    assert job["processed"] == 0
+    items = list(client.get_database().job_items.find({"job_id": job["id"]}).sort("chunk"))
+    assert [x["hosts"] for x in items] == [HOSTS[0:2], HOSTS[2:4], HOSTS[4:5]]
+    assert all(x["ready"] for x in items)
+
+def test_empty_job_is_done_immediately(jobs):
+    job = jobs.create([])
+    assert job["status"] == "done"
+    assert job["finished_at"] is not None
+
+def test_job_too_large_is_removed(jobs, client):
+    with pytest.raises(JobTooLarge):
+        jobs.create(f"8.8.8.{i}" for i in range(11))
+
+    assert client.get_database().jobs.count_documents({}) == 0
+    assert client.get_database().job_items.count_documents({}) == 0
+
+def test_claims_hand_out_each_chunk_once(jobs):
+    job = jobs.create(HOSTS)
+
+    claimed = [jobs.claim("worker") for _ in range(3)]
+    assert [item["chunk"] for _, item in claimed] == [0, 1, 2]
+    assert all(item["attempts"] == 1 for _, item in claimed)
+    assert jobs.get(job["id"])["status"] == "running"
+    assert jobs.claim("worker") is None
+
+def test_expired_lease_is_claimed_again(client):
+    jobs = JobStore(client, chunk_size=10, lease_time=0.05)
+    jobs.create(HOSTS)
+    _, first = jobs.claim("dead worker")
+    assert jobs.claim("worker") is None
+
+    time.sleep(0.1)
+    _, second = jobs.claim("worker")
+    assert second["_id"] == first["_id"]
+    assert second["attempts"] == 2
+    # The first owner lost its lease and cannot complete the chunk any more
+    assert not jobs.complete(first, "dead worker", [])
+    assert jobs.complete(second, "worker", [])
+
+def test_release_is_not_an_attempt(jobs):
+    jobs.create(HOSTS[:2])
+    _, item = jobs.claim("worker")
+    jobs.release(item, "worker")
+
+    _, item = jobs.claim("worker")
+    assert item["attempts"] == 1
+
+def test_complete_counts_progress_once(jobs):
+    job = jobs.create(HOSTS)
+    claimed = [jobs.claim("worker") for _ in range(3)]
+
+    _, item = claimed[0]
+    assert jobs.complete(item, "worker", [{"query": x} for x in item["hosts"]])
+    assert not jobs.complete(item, "worker", [{"query": x} for x in item["hosts"]])
+    assert jobs.get(job["id"])["processed"] == 2
+
+    for _, item in claimed[1:]:
+        jobs.complete(item, "worker", [{"query": x} for x in item["hosts"]])
+    job = jobs.get(job["id"])
+    assert (job["status"], job["processed"]) == ("done", 5)
+    assert job["finished_at"] is not None
+
+def test_results_are_in_order_and_stop_at_the_first_unfinished_chunk(jobs):
+    job = jobs.create(HOSTS)
+    claimed = {item["chunk"]: item for _, item in (jobs.claim("worker") for _ in range(3))}
+    for chunk in (0, 2):
+        jobs.complete(claimed[chunk], "worker", [{"query": x} for x in claimed[chunk]["hosts"]])
+
+    assert [x["query"] for x in jobs.results(job["id"])] == HOSTS[0:2]
+
+    jobs.complete(claimed[1], "worker", [{"query": x} for x in claimed[1]["hosts"]])
+    assert [x["query"] for x in jobs.results(job["id"])] == HOSTS
+    assert [x["query"] for x in jobs.results(job["id"], offset=1, limit=3)] == HOSTS[1:4]
+    assert list(jobs.results(job["id"], offset=5)) == []
+    assert list(jobs.results("missing")) == []
+
+def test_runner_resolves_a_job(jobs):
+    resolver = FakeResolver()
+    job = jobs.create(HOSTS, ["country"])
+    runner = JobRunner(jobs, resolver, poll_interval=0.01)
+    try:
+        job = wait_until_done(jobs, job["id"])
+    finally:
+        runner.close(5)
+
+    results = list(jobs.results(job["id"]))
+    assert [x["query"] for x in results] == HOSTS
+    assert all(x["status"] == "success" and x["country"] == "Poland" for x in results)
+
+def test_runner_gives_up_on_chunks_that_keep_failing(client):
+    jobs = JobStore(client, chunk_size=10, lease_time=0.05, max_attempts=3)
+    resolver = FakeResolver(ValueError)
+    job = jobs.create(HOSTS)
+    runner = JobRunner(jobs, resolver, poll_interval=0.01)
+    try:
+        wait_until_done(jobs, job["id"])
+    finally:
+        runner.close(5)
+
+    assert resolver.calls == 3
+    results = list(jobs.results(job["id"]))
+    assert [(x["query"], x["status"], x["message"]) for x in results] == [(x, "fail", "lookup failed") for x in HOSTS]
+
+def test_runner_hands_back_chunks_on_rate_limit(jobs):
+    resolver = FakeResolver(RateLimitExceeded)
+    job = jobs.create(HOSTS[:2])
+    runner = JobRunner(jobs, resolver, poll_interval=0.01)
+    try:
+        deadline = time.monotonic() + 5
+        while resolver.calls <= jobs.max_attempts and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        runner.close(5)
+
+    # More tries than max_attempts, none of them counted, so the job is not given up on
+    assert resolver.calls > jobs.max_attempts
+    assert jobs.get(job["id"])["processed"] == 0
@@ -0,0 +1,195 @@
+import json
+import threading
+import time
+import pytest
+from iptracker.api import Provider, QueryResponse
+from iptracker.providers import ProviderChain, build_providers, load_provider_config
+from iptracker.ratelimit import RateLimitExceeded
+from tests.conftest import record
+
+class FakeProvider(Provider):
+    def __init__(self, name: str, fail_with: Exception | None = None, delay: float = 0, fields: list[str] | None = None):
+        self._name = name
+        self.fail_with = fail_with
+        self.delay = delay
+        self.fields = fields
+        self.calls = 0
+        self.release = threading.Event()
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def rate_limiter(self):
+        return None
+
+    def supports(self, fields: list[str]) -> bool:
+        return self.fields is None or all(x in self.fields for x in fields)
+
+    def query(self, hosts, fields=None):
+        self.calls += 1
+        if self.delay:
+            self.release.wait(self.delay)
+        if self.fail_with:
+            raise self.fail_with
+        if isinstance(hosts, str):
+            return QueryResponse.success(record(hosts, provider=self._name))
+        return [QueryResponse.success(record(x, provider=self._name)) for x in hosts]
+
+    def query_stream(self, hosts, fields=None):
+        yield self.query(hosts, fields)
+
+class FakeMetrics:
+    def __init__(self):
+        self.requests = []
+        self.hedges = []
+
+    def submit_provider_request(self, provider: str, result: str, time: float):
+        self.requests.append((provider, result))
+
+    def submit_provider_hedge(self, provider: str):
+        self.hedges.append(provider)
+
+def answered_by(response: QueryResponse) -> str:
+    return response.result.fields["provider"]
+
+@pytest.fixture(params=[0, 0.05], ids=["sequential", "hedged"])
+def hedge_delay(request):
+    return request.param
+
+def test_first_provider_answers(hedge_delay):
+    first, second = FakeProvider("first"), FakeProvider("second")
+    chain = ProviderChain([first, second], hedge_delay)
+
+    assert answered_by(chain.query("8.8.8.8")) == "first"
+    assert second.calls == 0
+
+def test_fails_over_on_error(hedge_delay):
+    first, second = FakeProvider("first", Exception("down")), FakeProvider("second")
+    metrics = FakeMetrics()
+    chain = ProviderChain([first, second], hedge_delay, metrics=metrics)
+
+    responses = chain.query(["8.8.8.8", "1.1.1.1"])
+
+    assert [answered_by(x) for x in responses] == ["second", "second"]
+    assert metrics.requests == [("first", "error"), ("second", "success")]
+    assert metrics.hedges == []
+
+def test_fails_over_on_rate_limit(hedge_delay):
+    first, second = FakeProvider("first", RateLimitExceeded(5)), FakeProvider("second")
+    metrics = FakeMetrics()
+    chain = ProviderChain([first, second], hedge_delay, metrics=metrics)
+
+    assert answered_by(chain.query("8.8.8.8")) == "second"
+    assert metrics.requests[0] == ("first", "rate_limited")
+
+def test_rate_limit_only_when_every_provider_is_out_of_budget(hedge_delay):
+    chain = ProviderChain([FakeProvider("first", RateLimitExceeded(5)), FakeProvider("second", RateLimitExceeded(2))], hedge_delay)
+
+    with pytest.raises(RateLimitExceeded) as e:
+        chain.query("8.8.8.8")
+    assert e.value.retry_after == 2
+
+def test_errors_win_over_rate_limits(hedge_delay):
+    chain = ProviderChain([FakeProvider("first", ValueError("broken")), FakeProvider("second", RateLimitExceeded(2))], hedge_delay)
+
+    with pytest.raises(ValueError, match="broken"):
+        chain.query("8.8.8.8")
+
+def test_skips_providers_missing_fields(hedge_delay):
+    first = FakeProvider("first", fields=["country"])
+    second = FakeProvider("second")
+    chain = ProviderChain([first, second], hedge_delay)
+
+    assert answered_by(chain.query("8.8.8.8", ["country", "isp"])) == "second"
+    assert first.calls == 0
+    assert chain.supports(["isp"])
+
+def test_first_provider_is_the_last_resort(hedge_delay):
+    first = FakeProvider("first", fields=["country"])
+    second = FakeProvider("second", fields=["country"])
+    chain = ProviderChain([first, second], hedge_delay)
+
+    assert answered_by(chain.query("8.8.8.8", ["isp"])) == "first"
+    assert not chain.supports(["isp"])
+
+def test_hedges_a_slow_provider():
+    first, second = FakeProvider("first", delay=5), FakeProvider("second")
+    metrics = FakeMetrics()
+    chain = ProviderChain([first, second], hedge_delay=0.05, metrics=metrics)
+
+    try:
+        start = time.monotonic()
+        assert answered_by(chain.query("8.8.8.8")) == "second"
+        assert time.monotonic() - start < 1
+        assert metrics.hedges == ["second"]
+    finally:
+        first.release.set()
+
+def test_slow_provider_can_still_win():
+    first, second = FakeProvider("first", delay=0.2), FakeProvider("second", delay=5)
+    chain = ProviderChain([first, second], hedge_delay=0.05)
+
+    try:
+        assert answered_by(chain.query("8.8.8.8")) == "first"
+        assert second.calls == 1
+    finally:
+        second.release.set()
+
+def test_hedged_provider_failing_waits_for_the_slow_one():
+    first, second = FakeProvider("first", delay=0.2), FakeProvider("second", Exception("down"))
+    chain = ProviderChain([first, second], hedge_delay=0.05)
+
+    assert answered_by(chain.query("8.8.8.8")) == "first"
+
+def test_no_hedging_without_delay():
+    first, second = FakeProvider("first", delay=0.1), FakeProvider("second")
+    chain = ProviderChain([first, second], hedge_delay=0)
+
+    assert answered_by(chain.query("8.8.8.8")) == "first"
+    assert second.calls == 0
+
+def test_stream_chunks_fail_over(hedge_delay):
+    chain = ProviderChain([FakeProvider("first", Exception("down")), FakeProvider("second")], hedge_delay)
+
+    chunks = list(chain.query_stream([f"8.8.8.{i}" for i in range(3)]))
+
+    assert [answered_by(x) for chunk in chunks for x in chunk] == ["second"] * 3
+
+def test_provider_config(tmp_path):
+    path = tmp_path / "providers.json"
+    path.write_text(json.dumps([
+        {"name": "backup", "url": "http://backup/{host}", "fields": {"country": "country_name"}, "rate_limit": "10/60"},
+        {"type": "ip-api"},
+    ]))
+    ipapi = FakeProvider("ip-api")
+
+    providers = build_providers(load_provider_config(str(path)), ipapi)
+
+    assert [x.name for x in providers] == ["backup", "ip-api"]
+    assert providers[0].supports(["country"])
+    assert not providers[0].supports(["isp"])
+    assert providers[0].rate_limiter is not None
+
+def test_ipapi_goes_first_unless_placed(tmp_path):
+    path = tmp_path / "providers.json"
+    path.write_text(json.dumps([{"name": "backup", "url": "http://backup/{host}", "fields": {"country": "country"}}]))
+
+    providers = build_providers(load_provider_config(str(path)), FakeProvider("ip-api"))
+
+    assert [x.name for x in providers] == ["ip-api", "backup"]
+
+@pytest.mark.parametrize("entries", [
+    {"name": "backup"},
+    [{"type": "grpc"}],
+    [{"name": "backup", "url": "http://backup/{host}"}],
+    [{"name": "ip-api", "url": "http://backup/{host}", "fields": {"country": "country"}}],
+    [{"name": "a", "url": "http://a/{host}", "fields": {"country": "country"}}, {"name": "a", "url": "http://b/{host}", "fields": {"country": "country"}}],
+])
+def test_invalid_provider_config(tmp_path, entries):
+    path = tmp_path / "providers.json"
+    path.write_text(json.dumps(entries))
+
+    with pytest.raises(ValueError):
+        load_provider_config(str(path))
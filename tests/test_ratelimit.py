@@ -0,0 +1,62 @@
+import multiprocessing
+import pytest
+from iptracker.ratelimit import RateLimiter, RateLimitExceeded
+
+LIMITS = {"batch": (3, 60.0), "json": (5, 60.0)}
+
+def test_budget_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "ratelimit")
+    first = RateLimiter(path, LIMITS, max_wait=0)
+    second = RateLimiter(path, LIMITS, max_wait=0)
+
+    assert first.reserve("batch") == 0
+    assert second.reserve("batch") == 0
+    assert first.reserve("batch") == 0
+    assert second.reserve("batch") > 0
+    with pytest.raises(RateLimitExceeded):
+        first.acquire("batch")
+
+    assert first.peek("batch")[0] == second.peek("batch")[0] == 0
+    # Buckets are independent
+    assert second.peek("json") == (5, 0.0)
+
+def test_upstream_headers_update_every_instance(tmp_path):
+    path = str(tmp_path / "ratelimit")
+    first = RateLimiter(path, LIMITS, max_wait=0)
+    second = RateLimiter(path, LIMITS, max_wait=0)
+
+    first.update("batch", 0, 30)
+    remaining, reset_in = second.peek("batch")
+    assert remaining == 0
+    assert 29 < reset_in <= 30
+    with pytest.raises(RateLimitExceeded) as e:
+        second.acquire("batch")
+    assert e.value.retry_after > 29
+
+def test_budget_without_a_file_is_not_shared():
+    first = RateLimiter(None, LIMITS, max_wait=0)
+    second = RateLimiter(None, LIMITS, max_wait=0)
+    for _ in range(3):
+        first.reserve("batch")
+
+    assert first.peek("batch")[0] == 0
+    assert second.peek("batch")[0] == 3
+
+def _reserve_many(path: str, attempts: int, granted):
+    limiter = RateLimiter(path, {"batch": (50, 60.0)}, max_wait=0)
+    count = sum(1 for _ in range(attempts) if limiter.reserve("batch") == 0)
+    with granted.get_lock():
+        granted.value += count
+
+def test_budget_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "ratelimit")
+    context = multiprocessing.get_context("fork")
+    granted = context.Value("i", 0)
+    processes = [context.Process(target=_reserve_many, args=(path, 40, granted)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(10)
+
+    assert all(x.exitcode == 0 for x in processes)
+    assert granted.value == 50
@@ -0,0 +1,180 @@
+import gzip
+import json
+import os
+import mongomock
+import pytest
+from iptracker.api import QueryResponse
+from iptracker.cache import HostCache
+from iptracker.db import HostDataStore
+from iptracker.snapshot import CacheSnapshots, load_snapshot, merge_hottest, read_snapshot, write_snapshot
+from iptracker.sqlite_db import SQLiteHostDataStore
+from tests.conftest import age, record
+
+def hosts(records) -> list[str]:
+    return [x.host for x in records]
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "hosts.snapshot")
+    records = [record("8.8.8.8", 100, country="United States", lat=37.4), record("2001:db8::1", 5, isp="Example")]
+
+    assert write_snapshot(path, iter(records)) == 2
+    loaded = list(read_snapshot(path))
+
+    assert hosts(loaded) == ["8.8.8.8", "2001:db8::1"]
+    assert dict(loaded[0].fields) == {"country": "United States", "lat": 37.4}
+    assert dict(loaded[1].fields) == {"isp": "Example"}
+    # Records keep their age instead of looking freshly fetched
+    assert [x.fetched_at for x in loaded] == [x.fetched_at for x in records]
+
+def test_old_records_are_skipped(tmp_path):
+    path = str(tmp_path / "hosts.snapshot")
+    write_snapshot(path, [record("8.8.8.8", 10), record("1.1.1.1", 1000)])
+
+    assert hosts(read_snapshot(path, max_age=100)) == ["8.8.8.8"]
+
+def test_limit_keeps_the_first_records(tmp_path):
+    path = str(tmp_path / "hosts.snapshot")
+    write_snapshot(path, [record(f"8.8.8.{i}") for i in range(5)])
+
+    assert hosts(load_snapshot(path, limit=2)) == ["8.8.8.0", "8.8.8.1"]
+
+@pytest.mark.parametrize("header", [
+    b"not json\n",
+    b'{"format": "something-else", "version": 1}\n',
+    b'{"format": "iptracker-snapshot", "version": 99}\n',
+])
+def test_invalid_header(tmp_path, header):
+    path = str(tmp_path / "hosts.snapshot")
+    with gzip.open(path, "wb") as f:
+        f.write(header)
+
+    with pytest.raises(ValueError):
+        list(read_snapshot(path))
+
+def test_failed_write_keeps_the_previous_file(tmp_path):
+    path = str(tmp_path / "hosts.snapshot")
+    write_snapshot(path, [record("8.8.8.8")])
+
+    def broken():
+        yield record("1.1.1.1")
+        raise RuntimeError("scan failed")
+
+    with pytest.raises(RuntimeError):
+        write_snapshot(path, broken())
+
+    assert hosts(read_snapshot(path)) == ["8.8.8.8"]
+    assert os.listdir(tmp_path) == ["hosts.snapshot"]
+
+def test_merge_hottest_interleaves_and_deduplicates():
+    first = [record("a"), record("b"), record("c")]
+    second = [record("b"), record("d")]
+
+    merged = list(merge_hottest([first, second]))
+
+    assert hosts(merged) == ["a", "b", "d", "c"]
+    # The copy ranked hotter wins
+    assert merged[1] is second[0]
+
+def test_cache_snapshots_use_one_file_per_process(tmp_path):
+    path = str(tmp_path / "cache.snapshot")
+    snapshots = CacheSnapshots(path)
+
+    assert snapshots.load() == []
+    assert snapshots.write([record("8.8.8.8")]) == 1
+
+    assert os.listdir(tmp_path) == [f"cache.snapshot.{os.getpid()}"]
+    assert hosts(CacheSnapshots(path).load()) == ["8.8.8.8"]
+
+def test_cache_snapshots_merge_every_worker(tmp_path):
+    path = str(tmp_path / "cache.snapshot")
+    write_snapshot(f"{path}.100", [record("a"), record("b")])
+    write_snapshot(f"{path}.200", [record("c"), record("a")])
+    write_snapshot(path, [record("d")])
+
+    assert hosts(CacheSnapshots(path).load()) == ["d", "a", "c", "b"]
+    assert hosts(CacheSnapshots(path).load(limit=2)) == ["d", "a"]
+
+def test_cache_snapshots_remove_merged_files(tmp_path):
+    path = str(tmp_path / "cache.snapshot")
+    write_snapshot(path, [record("exported")])
+    write_snapshot(f"{path}.100", [record("a")])
+    write_snapshot(f"{path}.200", [record("b")])
+
+    snapshots = CacheSnapshots(path)
+    snapshots.load()
+    # Worker 200 wrote again after this process merged its file
+    write_snapshot(f"{path}.200", [record("c")])
+    os.utime(f"{path}.200", (0, 0))
+    snapshots.write([record("a")])
+
+    assert sorted(os.listdir(tmp_path)) == sorted(["cache.snapshot", "cache.snapshot.200", f"cache.snapshot.{os.getpid()}"])
+
+def test_cache_snapshots_skip_unreadable_files(tmp_path):
+    path = str(tmp_path / "cache.snapshot")
+    write_snapshot(f"{path}.100", [record("a")])
+    with open(f"{path}.200", "wb") as f:
+        f.write(b"garbage")
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(b"not a worker file")
+
+    assert hosts(CacheSnapshots(path).load()) == ["a"]
+
+def test_memory_cache_round_trip(tmp_path):
+    path = str(tmp_path / "cache.snapshot")
+    cache = HostCache(10, 60)
+    for host in ("a", "b", "c"):
+        cache.set(QueryResponse.success(record(host, country="Poland")))
+    cache.get("a")
+
+    CacheSnapshots(path).write(cache.hot_entries())
+    preloaded = HostCache(2, 60)
+    preloaded.preload(CacheSnapshots(path).load(limit=2))
+
+    # The most recently used hosts survive the restart
+    assert hosts(preloaded.hot_entries()) == ["a", "c"]
+    assert dict(preloaded.get("a").result.fields) == {"country": "Poland"}
+
+def test_store_round_trip(make_store, tmp_path):
+    path = str(tmp_path / "hosts.snapshot")
+    source = make_store()
+    source.set_many([record("8.8.8.8", 100, country="United States"), record("1.1.1.1", 10, isp="Cloudflare")])
+
+    assert source.export_snapshot(path) == 2
+    with gzip.open(path, "rt") as f:
+        assert json.loads(f.readline())["format"] == "iptracker-snapshot"
+
+    # A separate database, as on another deployment
+    if isinstance(source, SQLiteHostDataStore):
+        target = SQLiteHostDataStore(str(tmp_path / "target.sqlite3"))
+    else:
+        target = HostDataStore(mongomock.MongoClient("mongodb://localhost/target"))
+    try:
+        assert target.get("8.8.8.8") is None
+        assert target.import_snapshot(path) == 2
+
+        assert dict(target.get("8.8.8.8").fields) == {"country": "United States"}
+        assert dict(target.get("1.1.1.1").fields) == {"isp": "Cloudflare"}
+        assert age(target.get("8.8.8.8")) == pytest.approx(100, abs=5)
+    finally:
+        target.close()
+
+def test_import_merges_and_keeps_age(make_store, tmp_path):
+    path = str(tmp_path / "hosts.snapshot")
+    write_snapshot(path, [record("8.8.8.8", 100, country="United States"), record("1.1.1.1", 50, isp="Cloudflare")])
+    store = make_store()
+    store.set_many([record("8.8.8.8", 10, isp="Google")])
+
+    assert store.import_snapshot(path, batch_size=1) == 2
+
+    existing = store.get("8.8.8.8")
+    assert dict(existing.fields) == {"country": "United States", "isp": "Google"}
+    assert age(existing) == pytest.approx(100, abs=5)
+    assert age(store.get("1.1.1.1")) == pytest.approx(50, abs=5)
+
+def test_import_skips_expired_records(make_store, tmp_path):
+    path = str(tmp_path / "hosts.snapshot")
+    write_snapshot(path, [record("8.8.8.8", 10), record("1.1.1.1", 1000)])
+    store = make_store(cache_expiration_seconds=100)
+
+    assert store.import_snapshot(path) == 1
+    assert store.get("1.1.1.1") is None
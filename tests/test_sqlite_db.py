@@ -0,0 +1,64 @@
+import pytest
+from iptracker.sqlite_db import SQLiteHostDataStore
+from tests.conftest import age, record
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteHostDataStore(str(tmp_path / "hosts.sqlite3"), 3600)
+    yield store
+    store.close()
+
+def test_fields_are_patched_one_by_one(store):
+    store.set_many([record("8.8.8.8", 100, country="Poland", city="Warsaw")])
+    store.set_many([record("8.8.8.8", 0, isp="ISP", city="Krakow")])
+
+    result = store.get("8.8.8.8")
+    assert dict(result.fields) == {"country": "Poland", "city": "Krakow", "isp": "ISP"}
+
+def test_record_keeps_the_oldest_fetch_time(store):
+    store.set_many([record("8.8.8.8", 0, country="Poland")])
+    store.set_many([record("8.8.8.8", 300, isp="ISP")])
+    assert 295 < age(store.get("8.8.8.8")) < 305
+
+    store.set_many([record("8.8.8.8", 0, city="Warsaw")])
+    assert 295 < age(store.get("8.8.8.8")) < 305
+
+def test_refresh_replaces_the_fetch_time(store):
+    store.set_many([record("8.8.8.8", 300, country="Poland", isp="Old ISP")])
+    store.refresh_many([record("8.8.8.8", 0, isp="New ISP")])
+
+    result = store.get("8.8.8.8")
+    assert dict(result.fields) == {"country": "Poland", "isp": "New ISP"}
+    assert age(result) < 5
+
+def test_expired_record_is_replaced_instead_of_merged(store):
+    # MongoDB would have deleted it, so none of its fields or its age carry over
+    store.set_many([record("8.8.8.8", 7200, country="Poland", city="Warsaw")])
+    assert store.get("8.8.8.8") is None
+
+    store.set_many([record("8.8.8.8", 0, country="Germany")])
+    result = store.get("8.8.8.8")
+    assert dict(result.fields) == {"country": "Germany"}
+    assert age(result) < 5
+
+def test_value_types_survive_a_round_trip(store):
+    store.set_many([record("8.8.8.8", country="Poland", lat=52.2, mobile=False, asname="")])
+    assert dict(store.get("8.8.8.8").fields) == {"country": "Poland", "lat": 52.2, "mobile": False, "asname": ""}
+
+def test_get_many_reads_in_chunks(tmp_path):
+    store = SQLiteHostDataStore(str(tmp_path / "hosts.sqlite3"), 3600, bulk_chunk_size=2)
+    hosts = [f"8.8.8.{i}" for i in range(5)]
+    store.set_many([record(x, country="Poland", city="Warsaw") for x in hosts])
+
+    results = store.get_many(hosts + ["1.1.1.1", hosts[0]], ["country"])
+    assert sorted(results) == hosts
+    assert all(dict(x.fields) == {"country": "Poland"} for x in results.values())
+    assert store.size() == 5
+
+def test_stores_on_one_file_share_records(tmp_path):
+    path = str(tmp_path / "hosts.sqlite3")
+    first = SQLiteHostDataStore(path, 3600)
+    second = SQLiteHostDataStore(path, 3600)
+    first.set_many([record("8.8.8.8", country="Poland")])
+
+    assert dict(second.get("8.8.8.8").fields) == {"country": "Poland"}
@@ -0,0 +1,69 @@
+import json
+import random
+import pytest
+from iptracker.streaming import JSONArrayParser, iter_json_array
+
+VALUES = ["1.1.1.1", "2001:db8::1", 123, -4.5e3, "xéy☃", None, True, {"a": [1, 2]}, [], "esc\"aped,]", 0]
+DOCUMENT = json.dumps(VALUES, ensure_ascii=False).encode()
+
+def split_at(data: bytes, cuts: list[int]) -> list[bytes]:
+    bounds = [0, *sorted(cuts), len(data)]
+    return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64, len(DOCUMENT)])
+def test_fixed_size_chunks(size):
+    chunks = [DOCUMENT[i:i + size] for i in range(0, len(DOCUMENT), size)]
+    assert list(iter_json_array(chunks)) == VALUES
+
+def test_every_single_split():
+    # Includes cuts inside numbers, escapes, literals and multi-byte characters
+    for i in range(len(DOCUMENT) + 1):
+        assert list(iter_json_array(split_at(DOCUMENT, [i]))) == VALUES, i
+
+def test_random_splits():
+    rng = random.Random(0)
+    for _ in range(200):
+        cuts = rng.sample(range(len(DOCUMENT) + 1), rng.randint(1, 20))
+        assert list(iter_json_array(split_at(DOCUMENT, cuts))) == VALUES, cuts
+
+def test_values_are_returned_once_complete():
+    parser = JSONArrayParser()
+    assert parser.feed(b'["1.1.1.1", "8.8') == ["1.1.1.1"]
+    assert parser.feed(b'.8.8", 12') == ["8.8.8.8"]
+    # A number is only known to be complete once something follows it
+    assert parser.feed(b"3") == []
+    assert parser.feed(b"]") == [123]
+    assert parser.close() == []
+
+@pytest.mark.parametrize("document, expected", [
+    (b"[]", []),
+    (b" \n[ \t]\r\n", []),
+    (b"[\n1 ,\n2\n]\n", [1, 2]),
+])
+def test_whitespace(document, expected):
+    assert list(iter_json_array([document])) == expected
+
+@pytest.mark.parametrize("document", [
+    b"",
+    b"   ",
+    b"[",
+    b"[1",
+    b"[1,",
+    b"[1,]",
+    b"[,1]",
+    b"[1 2]",
+    b"[truex]",
+    b'["unterminated]',
+    b"[1]x",
+    b"[1]]",
+    b"{}",
+    b'"1.1.1.1"',
+    b"[\"\xff\"]",
+])
+def test_malformed_input(document):
+    with pytest.raises(ValueError):
+        list(iter_json_array([document]))
+
+    # The outcome does not depend on how the input was split
+    with pytest.raises(ValueError):
+        list(iter_json_array([document[i:i + 1] for i in range(len(document))]))
@@ -0,0 +1,73 @@
+from iptracker.writer import HostDataWriter
+from tests.conftest import age, record
+
+def test_writes_for_a_host_are_merged_in_order():
+    flushed = []
+    writer = HostDataWriter(lambda records, refresh: flushed.append((refresh, records)), flush_interval=10)
+    writer.submit(record("8.8.8.8", 600, country="Old", isp="Old ISP"))
+    writer.submit(record("8.8.8.8", 0, country="New"), refresh=True)
+    writer.submit(record("1.1.1.1", 300, country="Australia"))
+    writer.close()
+
+    writes = {(refresh, x.host): x for refresh, records in flushed for x in records}
+    assert set(writes) == {(False, "1.1.1.1"), (True, "8.8.8.8")}
+    refreshed = writes[(True, "8.8.8.8")]
+    assert dict(refreshed.fields) == {"country": "New", "isp": "Old ISP"}
+    assert age(refreshed) < 5
+
+def test_regular_write_after_a_refresh_keeps_it_a_refresh():
+    flushed = []
+    writer = HostDataWriter(lambda records, refresh: flushed.append((refresh, records)), flush_interval=10)
+    writer.submit(record("8.8.8.8", 0, country="New"), refresh=True)
+    writer.submit(record("8.8.8.8", 300, isp="ISP"))
+    writer.close()
+
+    [(refresh, [merged])] = flushed
+    assert refresh
+    assert dict(merged.fields) == {"country": "New", "isp": "ISP"}
+    # Same as the two writes applied one after the other, the older part sets the age
+    assert 295 < age(merged) < 305
+
+def test_refresh_is_not_undone_by_queued_writes(make_store):
+    store = make_store(cache_expiration_seconds=3600, write_behind=True, write_flush_interval=10)
+    store.set_many([record("8.8.8.8", 600, country="Old", isp="Old ISP")])
+    store.refresh_many([record("8.8.8.8", 0, country="New")])
+    store.close()
+
+    result = store.get("8.8.8.8")
+    assert dict(result.fields) == {"country": "New", "isp": "Old ISP"}
+    assert age(result) < 5
+
+def test_refresh_without_write_behind(make_store):
+    store = make_store(cache_expiration_seconds=3600)
+    store.set_many([record("8.8.8.8", 600, country="Old", isp="Old ISP")])
+    store.refresh_many([record("8.8.8.8", 0, country="New")])
+
+    result = store.get("8.8.8.8")
+    assert dict(result.fields) == {"country": "New", "isp": "Old ISP"}
+    assert age(result) < 5
+
+def test_flush_waits_for_queued_writes_and_keeps_the_writer_open():
+    flushed = []
+    writer = HostDataWriter(lambda records, refresh: flushed.extend(x.host for x in records), flush_interval=10)
+    writer.submit(record("8.8.8.8", country="Poland"))
+    writer.submit(record("1.1.1.1", country="Australia"))
+
+    assert writer.flush(5)
+    assert sorted(flushed) == ["1.1.1.1", "8.8.8.8"]
+
+    writer.submit(record("9.9.9.9", country="Brazil"))
+    assert writer.flush(5)
+    assert flushed[-1] == "9.9.9.9"
+    writer.close()
+    assert writer.flush(5)
+
+def test_store_flush(make_store):
+    store = make_store(cache_expiration_seconds=3600, write_behind=True, write_flush_interval=10)
+    store.set_many([record("8.8.8.8", country="Poland")])
+    assert store.flush(5)
+    assert store.get("8.8.8.8") is not None
+
+    store.set_many([record("1.1.1.1", country="Australia")])
+    assert store.flush(5)
+    assert store.get("1.1.1.1") is not None